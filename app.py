@@ -1,6 +1,7 @@
-from flask import Flask, render_template, request, jsonify, session, Response, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, session, Response, redirect, url_for, flash, stream_with_context, g
 import sqlite3
 import json
+import contextvars
 import os
 from datetime import datetime, timedelta
 import requests
@@ -8,32 +9,29 @@ import uuid
 import hashlib
 import time
 import random
-from functools import wraps
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import wraps, partial
 from werkzeug.security import generate_password_hash, check_password_hash
 from config import config, Config
-
-# 分层缓存策略
-api_cache = {}
-security_cache = {}
-
-# 不同类型请求的缓存时间配置（秒）
-CACHE_DURATIONS = {
-    'character_generation': 1800,    # 角色生成：30分钟
-    'chat_response': 900,           # 聊天回复：15分钟
-    'game_content': 1800,           # 游戏内容：30分钟
-    'security_check': 7200,         # 安全检测：2小时
-    'system_prompt': 3600,          # 系统提示：1小时
-    'default': 900                  # 默认：15分钟
-}
-
-# 缓存大小限制
-CACHE_LIMITS = {
-    'api_cache': 500,              # API缓存：500条
-    'security_cache': 1000,        # 安全缓存：1000条
-}
-
-# 向后兼容的缓存时间
-CACHE_DURATION = CACHE_DURATIONS['default']  # 默认15分钟缓存
+import database
+import http_client
+import migrations
+import request_timing
+from user_stats import UserStatsBuffer
+from game_state import GameStateStore
+from context_builder import ConversationSummarizer, fit_messages, max_fitting_messages
+import prompt_templates
+import chat_sessions
+import search
+import game_records
+from llm_gateway import (
+    LLMGateway, ResponseCachePolicy, RetryPolicy, TimeoutPolicy, ResponseCleaner, GatewayMetrics,
+    SingleFlight,
+    CACHE_DURATIONS, CACHE_LIMITS, CACHE_BYTE_LIMITS
+)
+from response_cache import LRUTTLCache, SharedSQLiteCache, TieredCache
 
 # 创建统一的JSON响应函数
 def json_response(data, status_code=200):
@@ -54,196 +52,123 @@ app.secret_key = app.config['SECRET_KEY']
 # 设置JSON编码，确保中文字符正确显示
 app.config['JSON_AS_ASCII'] = False
 
+# 请求耗时统计：开启 SERVER_TIMING 后，在响应头中输出数据库和上游调用耗时（供压测脚本使用）
+@app.before_request
+def start_request_timing():
+    if app.config['SERVER_TIMING']:
+        g.request_timing_token = request_timing.start()
+
+@app.after_request
+def add_server_timing(response):
+    token = g.pop('request_timing_token', None)
+    if token is not None:
+        timing = request_timing.finish(token)
+        # 流式响应的主体尚未生成，此时的耗时没有意义
+        if not response.is_streamed:
+            response.headers['Server-Timing'] = timing.server_timing()
+    return response
+
+# 数据库连接管理：每个线程复用一个持久连接（WAL模式），请求内的所有查询共用
+db_manager = database.ConnectionManager(app.config)
+
+def get_db_connection():
+    """取得当前线程的数据库连接，用完调用 close() 归还；开启 SERVER_TIMING 时查询和提交耗时会计入当前请求"""
+    return db_manager.acquire()
+
+@app.teardown_request
+def release_db_connection(exc):
+    # 回滚请求中遗留的未提交事务，连接留给下一个请求复用
+    db_manager.release()
+
+# 分层缓存策略：进程内LRU淘汰，每个条目按缓存类型设置过期时间；
+# 配置了 SHARED_CACHE_PATH 时，再叠加一层所有 worker 共享的 SQLite 缓存
+def create_cache(name, default_ttl):
+    local = LRUTTLCache(CACHE_LIMITS[name], CACHE_BYTE_LIMITS[name], default_ttl)
+    shared_path = app.config.get('SHARED_CACHE_PATH')
+    if not shared_path:
+        return TieredCache(local)
+    return TieredCache(local, SharedSQLiteCache(shared_path, name))
+
+api_cache = create_cache('api_cache', CACHE_DURATIONS['default'])
+security_cache = create_cache('security_cache', CACHE_DURATIONS['security_check'])
+
+# 默认游戏词库
+DEFAULT_GAME_WORDS = [
+    ('玻璃杯', '水杯', 'easy'),
+    ('火锅', '汤锅', 'medium'),
+    ('铅笔', '毛笔', 'hard'),
+    ('飞机', '火箭', 'medium'),
+    ('魔法', '科技', 'hard'),
+    ('猫', '狮子', 'hard'),
+    ('手机', '电话', 'easy'),
+    ('汽车', '自行车', 'medium'),
+    ('医生', '护士', 'medium'),
+    ('老师', '学生', 'easy')
+]
+
+# system_config 中记录数据库初始化版本的键
+DB_INIT_VERSION_KEY = 'db_init_version'
+
+def get_db_init_version():
+    """当前代码对应的初始化版本：迁移版本 + 初始数据（默认角色、词库）的指纹"""
+    seed_data = json.dumps({
+        'characters': app.config['DEFAULT_CHARACTERS'],
+        'words': DEFAULT_GAME_WORDS
+    }, sort_keys=True, ensure_ascii=False)
+    return f"{migrations.LATEST_VERSION}:{hashlib.md5(seed_data.encode('utf-8')).hexdigest()[:12]}"
+
+def read_db_init_version(cursor):
+    """读取数据库中记录的初始化版本，尚未初始化时返回None"""
+    try:
+        cursor.execute('SELECT config_value FROM system_config WHERE config_key = ?', (DB_INIT_VERSION_KEY,))
+    except sqlite3.OperationalError:
+        return None  # system_config 表还不存在
+    result = cursor.fetchone()
+    return result[0] if result else None
+
 # 数据库初始化
 def init_db():
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
-    cursor = conn.cursor()
-    
-    # 创建角色表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS characters (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            personality TEXT NOT NULL,
-            description TEXT,
-            system_prompt TEXT NOT NULL,
-            avatar_type TEXT DEFAULT 'initial',
-            avatar_value TEXT,
-            user_id INTEGER,
-            is_default BOOLEAN DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # 创建聊天记录表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chat_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            character_id INTEGER,
-            message TEXT NOT NULL,
-            sender TEXT NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (character_id) REFERENCES characters (id)
-        )
-    ''')
-    
-    # 创建API配置表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS api_config (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_session TEXT,
-            api_key TEXT,
-            model_name TEXT DEFAULT 'qwen-plus',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 创建游戏词库表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS game_words (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            public_word TEXT NOT NULL,
-            undercover_word TEXT NOT NULL,
-            difficulty TEXT DEFAULT 'medium',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 创建游戏记录表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS game_sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            game_state TEXT NOT NULL,
-            current_round INTEGER DEFAULT 1,
-            max_rounds INTEGER DEFAULT 3,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 创建ChatSanctuary会话表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sanctuary_sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            user_session TEXT,
-            original_emotion TEXT NOT NULL,
-            character_ids TEXT NOT NULL,
-            conversation_rounds INTEGER DEFAULT 0,
-            status TEXT DEFAULT 'active',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 创建心情图册表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sanctuary_images (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_session TEXT NOT NULL,
-            session_id TEXT NOT NULL,
-            title TEXT NOT NULL,
-            image_url TEXT NOT NULL,
-            prompt TEXT,
-            original_emotion TEXT NOT NULL,
-            ai_messages TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 创建用户表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            role TEXT DEFAULT 'user',
-            is_active BOOLEAN DEFAULT 1,
-            api_key TEXT,
-            model_config TEXT,
-            access_count INTEGER DEFAULT 0,
-            model_call_count INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_login TIMESTAMP,
-            profile_info TEXT
-        )
-    ''')
-    
-    # 创建登录失败记录表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS login_failures (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ip_address TEXT NOT NULL,
-            username TEXT,
-            failure_count INTEGER DEFAULT 1,
-            blocked_until TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 创建用户会话表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            session_token TEXT UNIQUE NOT NULL,
-            ip_address TEXT,
-            user_agent TEXT,
-            expires_at TIMESTAMP NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # 创建模型配置表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS model_configs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            config_name TEXT NOT NULL,
-            llm_model TEXT DEFAULT 'qwen-plus',
-            security_model TEXT DEFAULT 'deepseek-v3',
-            image_model TEXT DEFAULT 'wanx2.1-t2i-turbo',
-            is_default BOOLEAN DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 创建系统配置表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS system_config (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            config_key TEXT UNIQUE NOT NULL,
-            config_value TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    """初始化数据库
     
-    # 检查并添加缺失的列（用于数据库升级）
-    try:
-        cursor.execute('ALTER TABLE characters ADD COLUMN avatar_type TEXT DEFAULT "initial"')
-    except sqlite3.OperationalError:
-        pass  # 列已存在
+    数据库已是当前版本时只做一次按唯一索引的读取；否则执行迁移和初始数据写入。
+    写入在 BEGIN IMMEDIATE 事务中进行，拿到写锁后重新检查版本，多个进程同时启动时只有一个会执行。
+    初始化和迁移自己管理事务，使用独立连接，不与当前线程的共享连接混用。
+    """
+    conn = db_manager.open_dedicated()
+    cursor = conn.cursor()
+    expected_version = get_db_init_version()
     
-    try:
-        cursor.execute('ALTER TABLE characters ADD COLUMN avatar_value TEXT')
-    except sqlite3.OperationalError:
-        pass  # 列已存在
+    if read_db_init_version(cursor) == expected_version:
+        # 全文索引可能因旧版 SQLite 不支持而被跳过，升级后在这里补建
+        migrations.ensure_fulltext_indexes(conn)
+        conn.close()
+        return
     
-    try:
-        cursor.execute('ALTER TABLE characters ADD COLUMN user_id INTEGER')
-    except sqlite3.OperationalError:
-        pass  # 列已存在
+    # 按版本执行尚未应用的数据库迁移（建表、补列、索引）
+    migrations.migrate(conn)
+    migrations.ensure_fulltext_indexes(conn)
     
+    cursor.execute('BEGIN IMMEDIATE')
     try:
-        cursor.execute('ALTER TABLE characters ADD COLUMN is_default BOOLEAN DEFAULT 0')
-    except sqlite3.OperationalError:
-        pass  # 列已存在
-    
+        if read_db_init_version(cursor) != expected_version:
+            seed_db(cursor)
+            cursor.execute('''
+                UPDATE system_config SET config_value = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE config_key = ?
+            ''', (expected_version, DB_INIT_VERSION_KEY))
+            if cursor.rowcount == 0:
+                cursor.execute('INSERT INTO system_config (config_key, config_value) VALUES (?, ?)',
+                               (DB_INIT_VERSION_KEY, expected_version))
+            print(f"数据库初始化完成，版本: {expected_version}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def seed_db(cursor):
+    """写入默认角色、词库、管理员和系统配置（已存在时跳过）"""
     # 插入默认角色
     default_characters = app.config['DEFAULT_CHARACTERS']
     
@@ -274,23 +199,12 @@ def init_db():
             GROUP BY name
         ) AND is_default = 1
     ''')
+    bump_characters_version(cursor)
     
     # 插入默认游戏词库
     cursor.execute('SELECT COUNT(*) FROM game_words')
     if cursor.fetchone()[0] == 0:
-        default_words = [
-            ('玻璃杯', '水杯', 'easy'),
-            ('火锅', '汤锅', 'medium'),
-            ('铅笔', '毛笔', 'hard'),
-            ('飞机', '火箭', 'medium'),
-            ('魔法', '科技', 'hard'),
-            ('猫', '狮子', 'hard'),
-            ('手机', '电话', 'easy'),
-            ('汽车', '自行车', 'medium'),
-            ('医生', '护士', 'medium'),
-            ('老师', '学生', 'easy')
-        ]
-        for word_pair in default_words:
+        for word_pair in DEFAULT_GAME_WORDS:
             cursor.execute('''
                 INSERT INTO game_words (public_word, undercover_word, difficulty)
                 VALUES (?, ?, ?)
@@ -320,9 +234,6 @@ def init_db():
             INSERT INTO system_config (config_key, config_value)
             VALUES (?, ?)
         ''', ('admin_api_key', 'sk-8963ec64f16a4bd8a9a91221d6049f20'))
-    
-    conn.commit()
-    conn.close()
 
 # 用户认证相关函数
 def get_client_ip():
@@ -334,7 +245,7 @@ def get_client_ip():
 
 def is_ip_blocked(ip_address):
     """检查IP是否被拉黑"""
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -349,7 +260,7 @@ def is_ip_blocked(ip_address):
 
 def record_login_failure(ip_address, username=None):
     """记录登录失败"""
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 检查是否已有记录
@@ -391,7 +302,7 @@ def record_login_failure(ip_address, username=None):
 
 def clear_login_failures(ip_address):
     """清除登录失败记录"""
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -406,7 +317,7 @@ def create_user_session(user_id, ip_address, user_agent):
     session_token = str(uuid.uuid4())
     expires_at = datetime.now() + timedelta(days=7)
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -419,19 +330,49 @@ def create_user_session(user_id, ip_address, user_agent):
     
     return session_token
 
+# 登录用户的进程级短期缓存（按用户ID），资料、角色或启用状态变化时失效
+user_cache = LRUTTLCache(app.config['USER_CACHE_SIZE'], default_ttl=app.config['USER_CACHE_TTL'])
+
+def invalidate_user_cache(user_id):
+    """用户信息被修改后调用，使进程缓存和当前请求中的缓存失效"""
+    user_cache.delete(user_id)
+    if g.get('current_user') and g.current_user[0] == user_id:
+        g.pop('current_user')
+
 def get_current_user():
-    """获取当前登录用户"""
+    """获取当前登录用户
+    
+    同一请求内只查询一次（缓存在 g 上）；开启 USER_CACHE_TTL 时跨请求复用短期缓存。
+    """
     if 'user_id' not in session:
         return None
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    user_id = session['user_id']
+    cached = g.get('current_user')
+    if cached is not None and cached[0] == user_id:
+        return cached[1]
+    
+    user = user_cache.get(user_id) if app.config['USER_CACHE_TTL'] > 0 else None
+    if user is None:
+        user = load_user(user_id)
+        if user and app.config['USER_CACHE_TTL'] > 0:
+            user_cache.put(user_id, user)
+    
+    # 返回副本，调用方修改字典不会影响缓存
+    user = dict(user) if user else None
+    g.current_user = (user_id, user)
+    return user
+
+def load_user(user_id):
+    """从数据库读取启用状态的用户"""
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
         SELECT id, username, email, role, is_active, api_key, model_config, 
                access_count, model_call_count, profile_info
         FROM users WHERE id = ? AND is_active = 1
-    ''', (session['user_id'],))
+    ''', (user_id,))
     
     result = cursor.fetchone()
     conn.close()
@@ -475,21 +416,23 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# 用户统计写缓冲：计数先在内存中累加，由后台线程批量写入
+user_stats_buffer = UserStatsBuffer(
+    get_db_connection,
+    flush_interval=app.config['USER_STATS_FLUSH_INTERVAL'],
+    flush_threshold=app.config['USER_STATS_FLUSH_THRESHOLD']
+)
+
+# 游戏状态存储：每局一把锁；GAME_STATE_FLUSH_INTERVAL 大于0时游戏常驻内存并定时写回数据库
+game_store = GameStateStore(
+    get_db_connection,
+    flush_interval=app.config['GAME_STATE_FLUSH_INTERVAL'],
+    idle_ttl=app.config['GAME_STATE_IDLE_TTL']
+)
+
 def update_user_stats(user_id, access_increment=0, model_call_increment=0):
-    """更新用户统计信息"""
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        UPDATE users 
-        SET access_count = access_count + ?, 
-            model_call_count = model_call_count + ?,
-            last_login = datetime('now')
-        WHERE id = ?
-    ''', (access_increment, model_call_increment, user_id))
-    
-    conn.commit()
-    conn.close()
+    """更新用户统计信息（批量异步写入，最迟 USER_STATS_FLUSH_INTERVAL 秒后落库）"""
+    user_stats_buffer.add(user_id, access_increment, model_call_increment)
 
 # 生成角色被淘汰时的话语
 def generate_elimination_speech(character, is_undercover, game_context, retries=2):
@@ -527,25 +470,25 @@ def generate_elimination_speech(character, is_undercover, game_context, retries=
             'content': prompt
         }]
         
-        # 调用API生成话语
-        for attempt in range(retries + 1):
-            response = call_qwen_api(messages)
-            if response and response.strip():
-                # 清理响应，确保是纯粹的角色话语
-                speech = response.strip()
-                
-                # 去除可能的引号
-                if speech.startswith('"') and speech.endswith('"'):
-                    speech = speech[1:-1]
-                if speech.startswith('"') and speech.endswith('"'):
-                    speech = speech[1:-1]
-                
-                # 验证长度和内容
-                if 10 <= len(speech) <= 150 and speech:
-                    return speech
-            
-            if attempt < retries:
-                time.sleep(1)  # 重试前等待
+        def clean_speech(text):
+            # 清理响应，去除可能的引号，确保是纯粹的角色话语
+            speech = text.strip()
+            if speech.startswith('"') and speech.endswith('"'):
+                speech = speech[1:-1]
+            if speech.startswith('"') and speech.endswith('"'):
+                speech = speech[1:-1]
+            return speech
+        
+        # 调用API生成话语，长度不合适时重试
+        response = llm_gateway.complete(
+            messages,
+            retries=retries + 1,
+            retry_delay=1,
+            validate=lambda text: 10 <= len(clean_speech(text)) <= 150,
+            label=f"角色{character['name']}淘汰话语"
+        )
+        if response:
+            return clean_speech(response)
         
         # 如果API调用失败，返回默认的情绪化话语
         if is_undercover:
@@ -573,262 +516,141 @@ def generate_elimination_speech(character, is_undercover, game_context, retries=
         else:
             return f"我{character['name']}是无辜的！你们都搞错了！"
 
-def get_cache_type_and_duration(messages, context_hint=None):
-    """根据消息内容和上下文提示确定缓存类型和时间"""
-    if context_hint:
-        # 如果有明确的上下文提示，直接使用
-        return context_hint, CACHE_DURATIONS.get(context_hint, CACHE_DURATIONS['default'])
-    
-    # 分析消息内容确定缓存类型
-    message_text = ' '.join([msg.get('content', '') for msg in messages if isinstance(msg, dict)])
-    message_lower = message_text.lower()
-    
-    # 角色生成相关
-    if any(keyword in message_lower for keyword in ['角色', '人物', '性格', '描述', 'character', 'personality']):
-        return 'character_generation', CACHE_DURATIONS['character_generation']
-    
-    # 游戏内容相关
-    if any(keyword in message_lower for keyword in ['游戏', '卧底', '投票', 'game', 'undercover', 'vote']):
-        return 'game_content', CACHE_DURATIONS['game_content']
-    
-    # 系统提示相关
-    if any(keyword in message_lower for keyword in ['系统', 'system', '规则', 'rule']):
-        return 'system_prompt', CACHE_DURATIONS['system_prompt']
-    
-    # 默认为聊天回复
-    return 'chat_response', CACHE_DURATIONS['chat_response']
-
-def get_enhanced_cache_key(messages, model, temperature, cache_type):
-    """生成增强的缓存键，包含缓存类型信息"""
-    base_content = json.dumps(messages, sort_keys=True).encode() + model.encode() + str(temperature).encode()
-    cache_key = hashlib.md5(base_content).hexdigest()
-    return f"{cache_type}:{cache_key}"
+def get_http_client():
+    """获取进程级共享的DashScope HTTP客户端"""
+    return http_client.get_client(app.config['HTTP_POOL_SIZE'])
+
+# 阿里云百炼API调用网关：所有文本生成调用的唯一入口
+llm_gateway = LLMGateway(
+    app.config,
+    get_http_client,
+    cache=ResponseCachePolicy(api_cache),
+    retry=RetryPolicy(),
+    timeout=TimeoutPolicy(app.config),
+    cleaner=ResponseCleaner(),
+    metrics=GatewayMetrics(),
+    single_flight=SingleFlight()
+)
+
+# 进程级LLM并发线程池（所有请求共享，max_workers即进程内上游调用的并发上限）
+_llm_executor = None
+_llm_executor_lock = threading.Lock()
+
+def get_llm_executor():
+    """获取进程级LLM线程池，首次使用时按当前配置创建"""
+    global _llm_executor
+    if _llm_executor is None:
+        with _llm_executor_lock:
+            if _llm_executor is None:
+                _llm_executor = ThreadPoolExecutor(
+                    max_workers=app.config['LLM_MAX_CONCURRENCY'],
+                    thread_name_prefix='llm'
+                )
+    return _llm_executor
+
+# 提示词模板：每个角色的静态前缀只编译一次，并保持在系统提示的最前面
+prompt_registry = prompt_templates.create_registry()
+
+# 对话滚动摘要：旧消息在后台线程中合并进每个会话的摘要
+conversation_summarizer = ConversationSummarizer(
+    get_db_connection,
+    lambda messages, api_key: llm_gateway.complete(messages, api_key, retries=2, label='对话摘要'),
+    lambda task: get_llm_executor().submit(task),
+    batch_size=app.config['CHAT_SUMMARY_BATCH_SIZE'],
+    max_chars=app.config['CHAT_SUMMARY_MAX_CHARS']
+)
+
+def iter_concurrently(tasks, max_concurrency=None):
+    """在共享线程池中并发执行无参任务，按完成顺序逐个产出 (任务序号, 结果)
+    
+    max_concurrency 限制本次调用同时在途的任务数，默认取 CHAT_MAX_CONCURRENCY_PER_REQUEST。
+    任务抛出的异常会被记录，对应的结果为 None。
+    """
+    if max_concurrency is None:
+        max_concurrency = app.config['CHAT_MAX_CONCURRENCY_PER_REQUEST']
+    max_concurrency = max(1, max_concurrency)
+    
+    executor = get_llm_executor()
+    pending = {}
+    next_index = 0
+    
+    while next_index < len(tasks) or pending:
+        # 保持在途任务数不超过单次请求的并发上限
+        while next_index < len(tasks) and len(pending) < max_concurrency:
+            # 在当前上下文的副本中执行，使任务内的耗时记到发起它的请求上
+            pending[executor.submit(contextvars.copy_context().run, tasks[next_index])] = next_index
+            next_index += 1
+        
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"并发任务执行异常: {e}")
+                result = None
+            yield index, result
+
+def run_concurrently(tasks, max_concurrency=None):
+    """在共享线程池中并发执行无参任务，按传入顺序返回结果（参数含义见 iter_concurrently）"""
+    results = [None] * len(tasks)
+    for index, result in iter_concurrently(tasks, max_concurrency):
+        results[index] = result
+    return results
+
+# 所有重试都失败时的备用聊天响应
+CHAT_FALLBACK_RESPONSES = [
+    "抱歉，我现在有点网络问题，不过我很想和你聊天。",
+    "网络似乎不太稳定，但我还是想回应你的话。",
+    "虽然遇到了一些技术问题，但我很高兴能和你交流。",
+    "系统有点卡顿，不过我会继续努力回应你的。"
+]
 
-# 阿里云百炼API调用
-def call_qwen_api_with_timeout(messages, api_key=None, model=None, timeout=None, cache_type_hint=None):
-    """带超时参数的API调用函数"""
-    if not api_key:
-        api_key = app.config['QWEN_API_KEY']
-    
-    if not model:
-        model = app.config['DEFAULT_MODEL']
-    
-    if not timeout:
-        timeout = app.config['API_TIMEOUT']
-    
-    # 确定缓存类型和时间
-    cache_type, cache_duration = get_cache_type_and_duration(messages, cache_type_hint)
-    
-    # 生成增强的缓存键
-    cache_key = get_enhanced_cache_key(messages, model, app.config['TEMPERATURE'], cache_type)
-    
-    # 检查缓存
-    current_time = time.time()
-    if cache_key in api_cache:
-        cached_data, timestamp = api_cache[cache_key]
-        if current_time - timestamp < cache_duration:
-            return cached_data
-    
-    url = app.config['QWEN_API_URL']
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json',
-        'Connection': 'keep-alive'  # 启用连接复用
-    }
+def generate_chat_reply(char_name, messages, api_key):
+    """为单个角色生成聊天回复，带重试和备用响应"""
+    response = llm_gateway.complete(messages, api_key, retries=3, retry_delay=0.5, label=f"角色{char_name}聊天")
     
-    data = {
-        'model': model,
-        'input': {
-            'messages': messages
-        },
-        'parameters': {
-            'temperature': app.config['TEMPERATURE'],
-            'max_tokens': app.config['MAX_TOKENS'],
-            'stream': False  # 确保非流式响应以提高速度
-        }
-    }
+    # 如果所有重试都失败，提供备用响应
+    if not response:
+        response = random.choice(CHAT_FALLBACK_RESPONSES)
+        print(f"角色{char_name}使用备用聊天响应: {response}")
     
-    try:
-        # 使用Session以启用连接池，应用自定义超时
-        with requests.Session() as session:
-            response = session.post(url, headers=headers, json=data, timeout=timeout)
-            
-        if response.status_code == 200:
-            result = response.json()
-            
-            # 检查响应结构是否正确
-            if 'output' not in result:
-                print(f"API响应结构异常: {result}")
-                return None
-            
-            # 兼容两种API响应格式
-            response_text = None
-            if 'text' in result['output']:
-                # 旧格式
-                response_text = result['output']['text']
-            elif 'choices' in result['output'] and len(result['output']['choices']) > 0:
-                # 新格式
-                choice = result['output']['choices'][0]
-                if 'message' in choice and 'content' in choice['message']:
-                    response_text = choice['message']['content']
-            
-            if not response_text:
-                print(f"API响应结构异常: {result}")
-                return None
-            
-            # 验证响应内容不为空
-            if not response_text or not response_text.strip():
-                print("API返回空内容")
-                return None
-            
-            # 清理响应文本，去除可能的前缀和格式化问题
-            response_text = response_text.strip()
-            # 去除常见的AI回复前缀
-            prefixes_to_remove = ['我的描述是：', '我想说：', '描述：', '我觉得：', '我认为：', '答：', '回答：']
-            for prefix in prefixes_to_remove:
-                if response_text.startswith(prefix):
-                    response_text = response_text[len(prefix):].strip()
-                    break
-            
-            # 最终验证清理后的内容不为空
-            if not response_text:
-                print("清理后内容为空")
-                return None
-            
-            # 缓存结果
-            api_cache[cache_key] = (response_text, current_time)
-            
-            # 智能缓存清理
-            if len(api_cache) > CACHE_LIMITS['api_cache']:
-                # 清理过期缓存
-                expired_keys = []
-                for k, (_, t) in api_cache.items():
-                    # 根据缓存键中的类型确定过期时间
-                    cache_type_from_key = k.split(':')[0] if ':' in k else 'default'
-                    cache_duration_for_key = CACHE_DURATIONS.get(cache_type_from_key, CACHE_DURATIONS['default'])
-                    if current_time - t > cache_duration_for_key:
-                        expired_keys.append(k)
-                
-                for k in expired_keys:
-                    del api_cache[k]
-                
-                # 如果清理后仍然超过限制，删除最旧的缓存
-                if len(api_cache) > CACHE_LIMITS['api_cache']:
-                    sorted_cache = sorted(api_cache.items(), key=lambda x: x[1][1])
-                    excess_count = len(api_cache) - CACHE_LIMITS['api_cache'] + 50  # 多删除50个以避免频繁清理
-                    for i in range(min(excess_count, len(sorted_cache))):
-                        del api_cache[sorted_cache[i][0]]
-            
-            return response_text
-        else:
-            print(f"API调用失败: {response.status_code}, 响应: {response.text}")
-            return None
-    except Exception as e:
-        print(f"API调用异常: {str(e)}")
-        return None
+    return response
 
-def call_qwen_api(messages, api_key=None, model=None, cache_type_hint=None):
-    if not api_key:
-        api_key = app.config['QWEN_API_KEY']
-    
-    if not model:
-        model = app.config['DEFAULT_MODEL']
-    
-    # 确定缓存类型和时间
-    cache_type, cache_duration = get_cache_type_and_duration(messages, cache_type_hint)
-    
-    # 生成增强的缓存键
-    cache_key = get_enhanced_cache_key(messages, model, app.config['TEMPERATURE'], cache_type)
-    
-    # 检查缓存
-    current_time = time.time()
-    if cache_key in api_cache:
-        cached_data, timestamp = api_cache[cache_key]
-        if current_time - timestamp < cache_duration:
-            return cached_data
-    
-    url = app.config['QWEN_API_URL']
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json',
-        'Connection': 'keep-alive'  # 启用连接复用
-    }
-    
-    data = {
-        'model': model,
-        'input': {
-            'messages': messages
-        },
-        'parameters': {
-            'temperature': app.config['TEMPERATURE'],
-            'max_tokens': app.config['MAX_TOKENS'],
-            'stream': False  # 确保非流式响应以提高速度
-        }
-    }
+def stream_chat_reply(index, char_name, messages, api_key, events):
+    """流式生成单个角色的回复，把增量文本和最终回复放入事件队列
     
+    流式调用中途出错时丢弃已收到的部分内容，和没有产出内容时一样退回到带重试和
+    备用响应的非流式生成；此时 done 事件标记 replaced，客户端用它替换已显示的增量文本。
+    无论发生什么异常，都会放入该角色的 done 事件。
+    """
+    chunks = []
+    response = None
+    streamed = False  # 最终回复是否来自完整的流式输出
     try:
-        # 使用Session以启用连接池
-        with requests.Session() as session:
-            response = session.post(url, headers=headers, json=data, timeout=app.config['API_TIMEOUT'])
-            
-        if response.status_code == 200:
-            result = response.json()
-            
-            # 检查响应结构是否正确
-            if 'output' not in result:
-                print(f"API响应结构异常: {result}")
-                return None
-            
-            # 兼容两种API响应格式
-            response_text = None
-            if 'text' in result['output']:
-                # 旧格式
-                response_text = result['output']['text']
-            elif 'choices' in result['output'] and len(result['output']['choices']) > 0:
-                # 新格式
-                choice = result['output']['choices'][0]
-                if 'message' in choice and 'content' in choice['message']:
-                    response_text = choice['message']['content']
-            
-            if not response_text:
-                print(f"API响应结构异常: {result}")
-                return None
-            
-            # 验证响应内容不为空
-            if not response_text or not response_text.strip():
-                print("API返回空内容")
-                return None
-            
-            # 清理响应文本，去除可能的前缀和格式化问题
-            response_text = response_text.strip()
-            # 去除常见的AI回复前缀
-            prefixes_to_remove = ['我的描述是：', '我想说：', '描述：', '我觉得：', '我认为：', '答：', '回答：']
-            for prefix in prefixes_to_remove:
-                if response_text.startswith(prefix):
-                    response_text = response_text[len(prefix):].strip()
-                    break
-            
-            # 最终验证清理后的内容不为空
-            if not response_text:
-                print("清理后内容为空")
-                return None
-            
-            # 缓存结果
-            api_cache[cache_key] = (response_text, current_time)
-            
-            # 清理过期缓存
-            if len(api_cache) > 100:  # 限制缓存大小
-                expired_keys = [k for k, (_, t) in api_cache.items() if current_time - t > CACHE_DURATION]
-                for k in expired_keys:
-                    del api_cache[k]
-            
-            return response_text
-        else:
-            print(f"API调用失败: {response.status_code}, 响应: {response.text}")
-            return None
+        try:
+            for delta in llm_gateway.stream(messages, api_key):
+                chunks.append(delta)
+                events.put(('delta', index, delta))
+            response = llm_gateway.cleaner.clean(''.join(chunks))
+            streamed = bool(response)
+        except Exception as e:
+            print(f"角色{char_name}流式聊天中断，丢弃已收到的{len(chunks)}段内容: {e}")
+        
+        if not response:
+            response = generate_chat_reply(char_name, messages, api_key)
     except Exception as e:
-        print(f"API调用异常: {str(e)}")
-        return None
+        print(f"角色{char_name}生成回复异常: {e}")
+        response = None
+    finally:
+        events.put(('done', index, {
+            'message': response or random.choice(CHAT_FALLBACK_RESPONSES),
+            'replaced': bool(chunks) and not streamed
+        }))
+
+def sse_event(event, data):
+    """格式化一条Server-Sent Events消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 # 安全检测函数
 # 安全检测结果缓存
@@ -841,12 +663,9 @@ def check_prompt_injection(user_input):
     cache_key = f"security_check:{hashlib.md5(user_input.encode('utf-8')).hexdigest()}"
     
     # 检查缓存
-    current_time = time.time()
-    security_cache_duration = CACHE_DURATIONS['security_check']
-    if cache_key in security_cache:
-        cached_result, timestamp = security_cache[cache_key]
-        if current_time - timestamp < security_cache_duration:
-            return cached_result
+    cached_result = security_cache.get(cache_key)
+    if cached_result is not None:
+        return cached_result
     
     # 先进行基础规则检测
     dangerous_patterns = [
@@ -894,11 +713,12 @@ def check_prompt_injection(user_input):
     
     try:
         # 使用轻量模型进行快速检测，应用安全检测专用超时
-        result = call_qwen_api_with_timeout(
-            messages=security_prompt,
+        result = llm_gateway.complete(
+            security_prompt,
             api_key=app.config['QWEN_API_KEY'],
             model=app.config['SECURITY_MODEL'],
-            timeout=app.config['SECURITY_CHECK_TIMEOUT']
+            timeout=app.config['SECURITY_CHECK_TIMEOUT'],
+            label='安全检测'
         )
         
         if result:
@@ -907,27 +727,7 @@ def check_prompt_injection(user_input):
             detection_result = (is_dangerous, result)
             
             # 缓存结果
-            security_cache[cache_key] = (detection_result, current_time)
-            
-            # 智能缓存清理
-            security_cache_limit = CACHE_LIMITS['security_cache']
-            if len(security_cache) > security_cache_limit:
-                # 首先清理过期条目
-                expired_keys = []
-                for k, (_, timestamp) in security_cache.items():
-                    cache_duration = CACHE_DURATIONS['security_check']
-                    if current_time - timestamp > cache_duration:
-                        expired_keys.append(k)
-                
-                for k in expired_keys:
-                    del security_cache[k]
-                
-                # 如果仍然超过限制，删除最旧的条目
-                if len(security_cache) > security_cache_limit:
-                    sorted_items = sorted(security_cache.items(), key=lambda x: x[1][1])
-                    excess_count = len(security_cache) - security_cache_limit
-                    for i in range(excess_count):
-                        del security_cache[sorted_items[i][0]]
+            security_cache.put(cache_key, detection_result, ttl=CACHE_DURATIONS['security_check'])
             
             return detection_result
         else:
@@ -1002,7 +802,7 @@ def login():
     if is_ip_blocked(ip_address):
         return json_response({'error': 'IP地址已被拉黑，请24小时后再试'}, 403)
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -1058,7 +858,7 @@ def register():
     if len(password) < 6:
         return json_response({'error': '密码长度至少6位'}, 400)
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 检查用户名是否已存在
@@ -1112,8 +912,9 @@ def profile():
     if request.method == 'GET':
         # 检查是否是AJAX请求
         if request.headers.get('Content-Type') == 'application/json' or request.args.get('format') == 'json':
-            # 返回JSON格式的用户数据
-            conn = sqlite3.connect(app.config['DATABASE_PATH'])
+            # 返回JSON格式的用户数据（先写入缓冲中的统计，保证计数是最新的）
+            user_stats_buffer.flush()
+            conn = get_db_connection()
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -1145,7 +946,7 @@ def profile():
     api_key = data.get('api_key')
     profile_info = data.get('profile_info')
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 检查邮箱是否被其他用户使用
@@ -1163,6 +964,7 @@ def profile():
     
     conn.commit()
     conn.close()
+    invalidate_user_cache(user['id'])
     
     return json_response({'success': True, 'message': '个人信息更新成功'})
 
@@ -1181,7 +983,7 @@ def change_password():
     if len(new_password) < 6:
         return json_response({'error': '新密码长度至少6位'}, 400)
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('SELECT password_hash FROM users WHERE id = ?', (user['id'],))
@@ -1209,7 +1011,8 @@ def admin_dashboard():
 @app.route('/api/admin/users', methods=['GET'])
 @admin_required
 def admin_get_users():
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    user_stats_buffer.flush()  # 先写入缓冲中的统计，保证列表中的计数是最新的
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -1240,7 +1043,7 @@ def admin_get_users():
 def admin_update_user(user_id):
     data = request.get_json()
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 构建更新语句
@@ -1268,6 +1071,7 @@ def admin_update_user(user_id):
     
     conn.commit()
     conn.close()
+    invalidate_user_cache(user_id)
     
     return json_response({'success': True, 'message': '用户信息更新成功'})
 
@@ -1279,7 +1083,7 @@ def admin_reset_password(user_id):
     
     password_hash = generate_password_hash(new_password)
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('UPDATE users SET password_hash = ? WHERE id = ?', (password_hash, user_id))
@@ -1292,7 +1096,7 @@ def admin_reset_password(user_id):
 @app.route('/api/admin/users/<int:user_id>', methods=['DELETE'])
 @admin_required
 def admin_delete_user(user_id):
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 检查用户是否存在
@@ -1309,17 +1113,20 @@ def admin_delete_user(user_id):
         return json_response({'success': False, 'error': '不能删除管理员账户'}, 400)
     
     try:
-        # 删除用户相关的聊天历史
-        cursor.execute('DELETE FROM chat_history WHERE user_id = ?', (user_id,))
+        # 删除用户的群聊会话及聊天历史
+        chat_sessions.delete_user_sessions(cursor, user_id)
         
         # 删除用户创建的角色
         cursor.execute('DELETE FROM characters WHERE user_id = ?', (user_id,))
+        bump_characters_version(cursor)
         
         # 删除用户
         cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
         
         conn.commit()
         conn.close()
+        invalidate_user_cache(user_id)
+        invalidate_characters_cache(user_id)
         
         return json_response({'success': True, 'message': f'用户 {user[1]} 删除成功'})
         
@@ -1331,7 +1138,7 @@ def admin_delete_user(user_id):
 @app.route('/api/admin/model-config', methods=['GET', 'POST'])
 @admin_required
 def admin_model_config():
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     if request.method == 'GET':
@@ -1376,7 +1183,7 @@ def admin_model_config():
 @app.route('/api/admin/model-config/<int:config_id>', methods=['PUT', 'DELETE'])
 @admin_required
 def admin_model_config_detail(config_id):
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     if request.method == 'PUT':
@@ -1447,7 +1254,7 @@ def admin_model_config_detail(config_id):
 @app.route('/api/admin/api-config', methods=['GET', 'POST'])
 @admin_required
 def admin_api_config():
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     if request.method == 'GET':
@@ -1489,10 +1296,37 @@ def admin_api_config():
         
         return json_response({'success': True, 'message': 'API密钥保存成功'})
 
+@app.route('/api/admin/chat/archive', methods=['POST'])
+@admin_required
+def admin_archive_chat_sessions():
+    """立即归档不活跃的群聊会话，可传 max_age_days 覆盖默认天数"""
+    data = request.get_json(silent=True) or {}
+    max_age_days = data.get('max_age_days')
+    if max_age_days is not None and (not isinstance(max_age_days, int) or max_age_days < 0):
+        return json_response({'success': False, 'error': 'max_age_days 必须是非负整数'}, 400)
+    archived = run_chat_archive(max_age_days)
+    return json_response({'success': True, 'archived_sessions': archived})
+
+@app.route('/api/admin/metrics', methods=['GET'])
+@admin_required
+def admin_metrics():
+    """运行时性能指标"""
+    return json_response({
+        'http': get_http_client().stats(),
+        'database': db_manager.stats.snapshot(),
+        'user_stats': user_stats_buffer.stats(),
+        'game_state': game_store.stats(),
+        'user_cache': user_cache.stats(),
+        'characters_cache': characters_cache.stats(),
+        'prompts': prompt_registry.stats(),
+        'llm': llm_gateway.stats(),
+        'security_cache': security_cache.stats()
+    })
+
 @app.route('/api/admin/characters', methods=['GET'])
 @admin_required
 def admin_get_characters():
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 获取所有角色信息
@@ -1528,7 +1362,7 @@ def admin_get_characters():
 @app.route('/api/admin/characters/<int:character_id>', methods=['GET'])
 @admin_required
 def admin_get_character(character_id):
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 获取角色信息
@@ -1579,7 +1413,7 @@ def admin_update_character(character_id):
     
     # 管理员后台不需要安全检测，管理员有完全权限
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 检查角色是否存在
@@ -1595,16 +1429,18 @@ def admin_update_character(character_id):
             avatar_type = ?, avatar_value = ?
         WHERE id = ?
     ''', (name, personality, description, system_prompt, avatar_type, avatar_value, character_id))
+    bump_characters_version(cursor)
     
     conn.commit()
     conn.close()
+    invalidate_characters_cache()
     
     return json_response({'success': True, 'message': '角色更新成功'})
 
 @app.route('/api/admin/characters/<int:character_id>', methods=['DELETE'])
 @admin_required
 def admin_delete_character(character_id):
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 检查角色是否存在
@@ -1620,102 +1456,133 @@ def admin_delete_character(character_id):
         conn.close()
         return json_response({'success': False, 'error': '不能删除默认角色'}, 400)
     
-    # 删除相关的聊天历史
+    # 删除相关的聊天历史（包括已归档的）
     cursor.execute('DELETE FROM chat_history WHERE character_id = ?', (character_id,))
+    cursor.execute('DELETE FROM chat_history_archive WHERE character_id = ?', (character_id,))
     
     # 删除角色
     cursor.execute('DELETE FROM characters WHERE id = ?', (character_id,))
+    bump_characters_version(cursor)
     
     conn.commit()
     conn.close()
+    invalidate_characters_cache()
     
     return json_response({'success': True, 'message': '角色删除成功'})
 
-@app.route('/api/characters', methods=['GET'])
+@app.route('/api/characters/search', methods=['GET'])
 @login_required
-def get_characters():
-    user = get_current_user()
-    user_id = session.get('user_id')
+def search_characters_api():
+    """全文搜索角色库（名称、性格、描述、提示词），按相关度排序，用 page / limit 分页"""
+    query, limit, offset, scope_user_id = parse_search_args()
+    if not query:
+        return json_response({'error': '搜索关键词不能为空'}, 400)
+    
+    conn = get_db_connection()
+    results, has_more = search.search_characters(conn.cursor(), query, scope_user_id, limit, offset)
+    conn.close()
+    return json_response({'characters': results, 'page': offset // limit + 1, 'has_more': has_more})
+
+# 角色列表缓存：按用户缓存序列化后的响应体和ETag，重复加载页面时不再查询角色表；
+# 缓存条目记录生成时的角色数据版本，版本存放在数据库中，其他进程写入角色后本进程也能立即发现
+characters_cache = LRUTTLCache(app.config['CHARACTERS_CACHE_SIZE'], default_ttl=app.config['CHARACTERS_CACHE_TTL'])
+
+# system_config 中记录角色数据版本的键
+CHARACTERS_VERSION_KEY = 'characters_version'
+
+def bump_characters_version(cursor):
+    """递增角色数据版本，在写入角色的同一事务中调用"""
+    cursor.execute('''
+        UPDATE system_config SET config_value = CAST(config_value AS INTEGER) + 1, updated_at = CURRENT_TIMESTAMP
+        WHERE config_key = ?
+    ''', (CHARACTERS_VERSION_KEY,))
+    if cursor.rowcount == 0:
+        cursor.execute('INSERT INTO system_config (config_key, config_value) VALUES (?, ?)',
+                       (CHARACTERS_VERSION_KEY, '1'))
+
+def read_characters_version(cursor):
+    """读取角色数据版本（按唯一索引的单行查询）"""
+    cursor.execute('SELECT config_value FROM system_config WHERE config_key = ?', (CHARACTERS_VERSION_KEY,))
+    result = cursor.fetchone()
+    return result[0] if result else '0'
+
+def invalidate_characters_cache(user_id=None):
+    """角色被创建、修改或删除后调用，立即释放本进程中的旧条目
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
-    cursor = conn.cursor()
+    只影响某个用户自己的角色时传入该用户ID；默认角色或归属不确定的角色变化时清空所有用户的缓存。
+    其他进程的缓存通过角色数据版本失效。
+    """
+    if user_id is None:
+        characters_cache.clear()
+    else:
+        characters_cache.delete(user_id)
+
+def load_character_list(cursor, user_id):
+    """查询默认角色和该用户创建的角色"""
+    # 从最早的表结构升级的数据库还保留 avatar_url 列，上传的头像存放在其中
+    cursor.execute('PRAGMA table_info(characters)')
+    has_avatar_url = 'avatar_url' in [column[1] for column in cursor.fetchall()]
     
-    # 获取默认角色和当前用户创建的角色
-    cursor.execute('''
-        SELECT * FROM characters 
+    cursor.execute(f'''
+        SELECT id, name, personality, description, system_prompt, avatar_type, avatar_value,
+               created_at, is_default, user_id, {'avatar_url' if has_avatar_url else 'NULL'}
+        FROM characters 
         WHERE is_default = 1 OR user_id = ? 
         ORDER BY is_default DESC, created_at DESC
     ''', (user_id,))
     
     characters = []
     for row in cursor.fetchall():
-        # 处理数据库结构: id, name, personality, description, system_prompt, avatar_url, created_at, avatar_type, avatar_value, user_id, is_default
-        if len(row) >= 11:  # 新结构包含user_id和is_default
-            characters.append({
-                'id': row[0],
-                'name': row[1],
-                'personality': row[2],
-                'description': row[3],
-                'system_prompt': row[4],
-                'avatar_type': row[7] or 'emoji',
-                'avatar_value': row[8] or row[1][0],  # 如果没有avatar_value，使用名字首字母
-                'created_at': row[6],
-                'is_default': bool(row[10]),
-                'user_id': row[9]
-            })
-        elif len(row) == 9:  # 旧结构但可能有avatar_type和avatar_value
-            characters.append({
-                'id': row[0],
-                'name': row[1],
-                'personality': row[2],
-                'description': row[3],
-                'system_prompt': row[4],
-                'avatar_type': row[7] or 'emoji',
-                'avatar_value': row[8] or row[1][0],
-                'created_at': row[6],
-                'is_default': False,
-                'user_id': None
-            })
-        elif len(row) == 7:  # 最旧结构: id, name, personality, description, system_prompt, avatar_url, created_at
-            avatar_url = row[5]
-            if avatar_url:
-                avatar_type = 'upload'
-                avatar_value = avatar_url
-            else:
-                avatar_type = 'emoji'
-                avatar_value = row[1][0]  # 使用名字首字母
-            characters.append({
-                'id': row[0],
-                'name': row[1],
-                'personality': row[2],
-                'description': row[3],
-                'system_prompt': row[4],
-                'avatar_type': avatar_type,
-                'avatar_value': avatar_value,
-                'created_at': row[6],
-                'is_default': False,
-                'user_id': None
-            })
-        else:  # 其他结构，使用默认值
-            characters.append({
-                'id': row[0],
-                'name': row[1],
-                'personality': row[2] if len(row) > 2 else '',
-                'description': row[3] if len(row) > 3 else '',
-                'system_prompt': row[4] if len(row) > 4 else '',
-                'avatar_type': 'emoji',
-                'avatar_value': row[1][0] if len(row) > 1 else '?',
-                'created_at': row[-1] if len(row) > 5 else '',
-                'is_default': False,
-                'user_id': None
-            })
+        avatar_type, avatar_value = row[5], row[6]
+        if not avatar_type and row[10]:
+            avatar_type, avatar_value = 'upload', row[10]
+        characters.append({
+            'id': row[0],
+            'name': row[1],
+            'personality': row[2],
+            'description': row[3],
+            'system_prompt': row[4],
+            'avatar_type': avatar_type or 'emoji',
+            'avatar_value': avatar_value or row[1][0],  # 如果没有avatar_value，使用名字首字母
+            'created_at': row[7],
+            'is_default': bool(row[8]),
+            'user_id': row[9]
+        })
+    return characters
+
+@app.route('/api/characters', methods=['GET'])
+@login_required
+def get_characters():
+    """角色列表：响应带强ETag，If-None-Match 匹配时返回304
     
+    每次请求读取一次角色数据版本，缓存的版本一致时不再查询角色表。
+    """
+    user_id = session.get('user_id')
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    version = read_characters_version(cursor)
+    cached = characters_cache.get(user_id)
+    if cached is None or cached[0] != version:
+        # 先读版本再查询：查询期间角色发生变化时，缓存的版本偏旧，下次请求会重新加载
+        characters = load_character_list(cursor, user_id)
+        body = json.dumps(characters, ensure_ascii=False, indent=2)
+        cached = (version, body, hashlib.md5(body.encode('utf-8')).hexdigest())
+        characters_cache.put(user_id, cached)
     conn.close()
-    return json_response(characters)
+    
+    _, body, etag = cached
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, content_type='application/json; charset=utf-8')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/api/characters/<int:character_id>', methods=['GET'])
 def get_character(character_id):
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM characters WHERE id = ?', (character_id,))
     row = cursor.fetchone()
@@ -1790,7 +1657,7 @@ def update_character(character_id):
     avatar_value = data.get('avatar_value')
     
     # 检查角色是否为默认角色
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT system_prompt, is_default FROM characters WHERE id = ?', (character_id,))
     result = cursor.fetchone()
@@ -1828,7 +1695,7 @@ def update_character(character_id):
     
     conn.close()
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 检查角色是否存在
@@ -1858,15 +1725,17 @@ def update_character(character_id):
             SET name = ?, personality = ?, description = ?, system_prompt = ?, avatar_url = ?
             WHERE id = ?
         ''', (name, personality, description, system_prompt, avatar_url, character_id))
+    bump_characters_version(cursor)
     
     conn.commit()
     conn.close()
+    invalidate_characters_cache()
     
     return json_response({'message': '角色更新成功'})
 
 @app.route('/api/characters/<int:character_id>', methods=['DELETE'])
 def delete_character(character_id):
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 检查角色是否存在
@@ -1877,8 +1746,10 @@ def delete_character(character_id):
     
     # 删除角色
     cursor.execute('DELETE FROM characters WHERE id = ?', (character_id,))
+    bump_characters_version(cursor)
     conn.commit()
     conn.close()
+    invalidate_characters_cache()
     
     return json_response({'message': '角色删除成功'})
 
@@ -1912,15 +1783,17 @@ def create_character_api():
                 'message': '为了保护系统安全，您的系统提示词已被拦截。请避免使用可能的恶意指令。'
             }, 400)
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO characters (name, personality, description, system_prompt, avatar_type, avatar_value, user_id, is_default)
         VALUES (?, ?, ?, ?, ?, ?, ?, 0)
     ''', (name, personality, description, system_prompt, avatar_type, avatar_value, user_id))
     character_id = cursor.lastrowid
+    bump_characters_version(cursor)
     conn.commit()
     conn.close()
+    invalidate_characters_cache(user_id)
     
     return json_response({'id': character_id, 'message': '角色创建成功'})
 
@@ -1945,7 +1818,7 @@ def generate_preview():
     user_session = session.get('user_id', str(uuid.uuid4()))
     session['user_id'] = user_session
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT api_key FROM api_config WHERE user_session = ?', (user_session,))
     result = cursor.fetchone()
@@ -1957,23 +1830,8 @@ def generate_preview():
         {'role': 'user', 'content': '你好，请简单介绍一下自己'}
     ]
     
-    # 多次重试机制
-    max_retries = 3
-    response = None
-    
-    for attempt in range(max_retries):
-        try:
-            response = call_qwen_api(messages, api_key)
-            if response:
-                break
-            else:
-                print(f"角色预览第{attempt + 1}次API调用失败")
-                if attempt < max_retries - 1:
-                    time.sleep(1)
-        except Exception as e:
-            print(f"角色预览第{attempt + 1}次API调用异常: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(1)
+    # 调用网关，失败时自动重试
+    response = llm_gateway.complete(messages, api_key, retries=3, retry_delay=1, label='角色预览')
     
     # 如果所有重试都失败，提供备用预览
     if not response:
@@ -1982,18 +1840,20 @@ def generate_preview():
     
     return json_response({'preview': response})
 
-@app.route('/api/chat', methods=['POST'])
-@login_required
-def chat_api():
-    user = get_current_user()
-    data = request.json
+def parse_chat_request(user, data):
+    """校验群聊请求，返回 (错误响应, 请求参数)，校验通过时错误响应为None"""
     character_ids = data.get('character_ids', [])
     user_message = data.get('message')
-    topic = data.get('topic', user_message)
-    session_id = data.get('session_id', str(uuid.uuid4()))
+    params = {
+        'character_ids': character_ids,
+        'user_message': user_message,
+        'topic': data.get('topic', user_message),
+        'session_id': data.get('session_id', str(uuid.uuid4())),
+        'api_key': user['api_key']
+    }
     
     if not character_ids or not user_message:
-        return json_response({'error': '角色ID和消息不能为空'}, 400)
+        return json_response({'error': '角色ID和消息不能为空'}, 400), params
     
     # 安全检测：检查用户输入是否包含提示词注入
     is_dangerous, detection_result = check_prompt_injection(user_message)
@@ -2002,116 +1862,342 @@ def chat_api():
             'error': '检测到不安全的输入内容，请重新输入',
             'security_warning': True,
             'message': '为了保护系统安全，您的输入已被拦截。请避免使用可能的恶意指令。'
-        }, 400)
+        }, 400), params
     
     # 使用用户的API Key
-    api_key = user['api_key']
-    if not api_key:
-        return json_response({'error': '请先在个人资料中配置您的阿里云百炼API密钥'}, 400)
+    if not params['api_key']:
+        return json_response({'error': '请先在个人资料中配置您的阿里云百炼API密钥'}, 400), params
     
-    # 更新用户统计
-    update_user_stats(user['id'], model_call_increment=len(character_ids))
-    
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
-    cursor = conn.cursor()
+    return None, params
+
+def prepare_chat_round(cursor, session_id, character_ids, user_message, topic, user_id, api_key):
+    """保存用户消息并为每个有权限的角色构建消息列表
     
+    历史消息取摘要之后的全部消息，只按 CHAT_CONTEXT_TOKEN_BUDGET 从新到旧裁剪；更早的对话
+    以滚动摘要的形式放在系统提示中。最近 CHAT_CONTEXT_MAX_MESSAGES 条之前的消息积累到
+    CHAT_SUMMARY_BATCH_SIZE 条，或有消息因预算被裁掉时，在后台并入摘要。
+    返回 [(角色ID, 角色名, 消息列表)]，顺序与 character_ids 一致。
+    """
     # 保存用户消息到聊天历史
     cursor.execute('''
         INSERT INTO chat_history (session_id, character_id, message, sender)
         VALUES (?, NULL, ?, 'user')
     ''', (session_id, user_message))
+    chat_sessions.touch_session(cursor, session_id, user_id, topic)
+    
+    summary, summarized_until_id = conversation_summarizer.load(cursor, session_id)
+    max_messages = app.config['CHAT_CONTEXT_MAX_MESSAGES']
+    
+    budget = app.config['CHAT_CONTEXT_TOKEN_BUDGET']
+    history_limit = max_fitting_messages(budget)
     
-    # 获取该会话的聊天历史（最近10条消息）
+    # 获取摘要之后的全部聊天历史，连同发言角色的名字一次查出；超过预算能容纳的条数的部分一定会被裁掉，不必读取
     cursor.execute('''
-        SELECT message, sender, character_id FROM chat_history 
-        WHERE session_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT 10
-    ''', (session_id,))
+        SELECT h.message, h.sender, h.character_id, c.name
+        FROM chat_history h
+        LEFT JOIN characters c ON c.id = h.character_id
+        WHERE h.session_id = ? AND h.id > ?
+        ORDER BY h.id DESC 
+        LIMIT ?
+    ''', (session_id, summarized_until_id, history_limit))
     history_records = cursor.fetchall()
     history_records.reverse()  # 按时间正序排列
     
-    # 获取角色信息并验证权限
-    character_responses = []
-    user_id = session.get('user_id')
+    # 一次查询所有目标角色，同时验证权限：只能使用默认角色或当前用户创建的角色
+    unique_ids = list(dict.fromkeys(character_ids))
+    placeholders = ','.join('?' * len(unique_ids))
+    cursor.execute(f'''
+        SELECT id, name, system_prompt FROM characters 
+        WHERE id IN ({placeholders}) AND (is_default = 1 OR user_id = ?)
+    ''', (*unique_ids, user_id))
+    # 按字符串比较ID，兼容前端传入字符串形式的角色ID
+    allowed_characters = {str(row[0]): (row[1], row[2]) for row in cursor.fetchall()}
     
+    summary_section = f"\n\n【之前的对话摘要】\n{summary}" if summary else ""
+    
+    prepared_characters = []
+    kept_records = len(history_records)  # 所有角色的上下文中都包含的最近消息条数
     for char_id in character_ids:
-        # 验证角色权限：只能使用默认角色或当前用户创建的角色
-        cursor.execute('''
-            SELECT name, system_prompt FROM characters 
-            WHERE id = ? AND (is_default = 1 OR user_id = ?)
-        ''', (char_id, user_id))
-        char_result = cursor.fetchone()
-        if char_result:
-            char_name, system_prompt = char_result
+        if str(char_id) in allowed_characters:
+            char_name, system_prompt = allowed_characters[str(char_id)]
             
-            # 构建包含历史对话的消息列表
-            messages = [
-                {'role': 'system', 'content': f"{system_prompt}\n\n当前话题：{topic}\n\n【重要对话规则】\n\n1. 禁止使用叙述性描述（如'我点点头'、'我看着'、'我想起'等）\n2. 用你的独特语气和性格表达\n3. 保持角色一致性，基于之前的对话历史自然参与讨论\n4. 回复控制在100字左右，保持简洁而有趣"}
-            ]
+            system_message = {'role': 'system', 'content': prompt_registry.render(
+                'chat', {'system_prompt': system_prompt}, topic=topic, summary_section=summary_section
+            )}
             
-            # 添加历史对话（排除当前用户消息，因为已经在最后添加）
-            for msg, sender, msg_char_id in history_records[:-1]:
+            # 历史对话（排除当前用户消息，因为已经在最后添加）
+            history = []
+            for msg, sender, msg_char_id, msg_char_name in history_records[:-1]:
                 if sender == 'user':
-                    messages.append({'role': 'user', 'content': msg})
+                    history.append({'role': 'user', 'content': msg})
                 elif msg_char_id == char_id:
-                    messages.append({'role': 'assistant', 'content': msg})
+                    history.append({'role': 'assistant', 'content': msg})
                 else:
                     # 其他角色的消息作为用户消息处理，但标注角色名
-                    cursor.execute('SELECT name FROM characters WHERE id = ?', (msg_char_id,))
-                    other_char = cursor.fetchone()
-                    other_name = other_char[0] if other_char else '其他角色'
-                    messages.append({'role': 'user', 'content': f"{other_name}说：{msg}"})
-            
-            # 添加当前用户消息
-            messages.append({'role': 'user', 'content': user_message})
-            
-            # 多次重试机制
-            max_retries = 3
-            response = None
-            
-            for attempt in range(max_retries):
-                try:
-                    response = call_qwen_api(messages, api_key)
-                    if response:
-                        break
-                    else:
-                        print(f"角色{char_name}第{attempt + 1}次聊天API调用失败")
-                        if attempt < max_retries - 1:
-                            time.sleep(0.5)
-                except Exception as e:
-                    print(f"角色{char_name}第{attempt + 1}次聊天异常: {e}")
-                    if attempt < max_retries - 1:
-                        time.sleep(0.5)
-            
-            # 如果所有重试都失败，提供备用响应
-            if not response:
-                fallback_responses = [
-                    "抱歉，我现在有点网络问题，不过我很想和你聊天。",
-                    "网络似乎不太稳定，但我还是想回应你的话。",
-                    "虽然遇到了一些技术问题，但我很高兴能和你交流。",
-                    "系统有点卡顿，不过我会继续努力回应你的。"
-                ]
-                response = random.choice(fallback_responses)
-                print(f"角色{char_name}使用备用聊天响应: {response}")
+                    other_name = msg_char_name or '其他角色'
+                    history.append({'role': 'user', 'content': f"{other_name}说：{msg}"})
+            
+            # 按 token 预算保留最近的历史，再加上当前用户消息
+            messages, dropped = fit_messages(
+                system_message, history, {'role': 'user', 'content': user_message},
+                budget=budget
+            )
+            kept_records = min(kept_records, len(history_records) - dropped)
+            prepared_characters.append((char_id, char_name, messages))
+    
+    # 较早的消息积累够一批，或有消息因预算没有放进上下文时，在后台更新摘要
+    conversation_summarizer.maybe_refresh(
+        cursor, session_id, summarized_until_id, min(max_messages, kept_records), api_key,
+        force=kept_records < len(history_records) or len(history_records) >= history_limit
+    )
+    
+    return prepared_characters
+
+def save_chat_replies(cursor, session_id, prepared_characters, replies):
+    """按角色顺序保存回复到聊天历史，返回接口使用的回复列表"""
+    character_responses = []
+    for (char_id, char_name, _), response in zip(prepared_characters, replies):
+        if response:  # 确保有响应内容才保存
+            cursor.execute('''
+                INSERT INTO chat_history (session_id, character_id, message, sender)
+                VALUES (?, ?, ?, ?)
+            ''', (session_id, char_id, response, char_name))
             
-            # 保存角色回复到聊天历史
-            if response:  # 确保有响应内容才保存
-                cursor.execute('''
-                    INSERT INTO chat_history (session_id, character_id, message, sender)
-                    VALUES (?, ?, ?, ?)
-                ''', (session_id, char_id, response, char_name))
-                
-                character_responses.append({
-                    'character_id': char_id,
-                    'character_name': char_name,
-                    'message': response
-                })
+            character_responses.append({
+                'character_id': char_id,
+                'character_name': char_name,
+                'message': response
+            })
+    if character_responses:
+        chat_sessions.count_messages(cursor, session_id, len(character_responses))
+    return character_responses
+
+def run_chat_archive(max_age_days=None):
+    """归档超过 max_age_days 天未活跃的群聊会话，返回归档的会话数"""
+    if max_age_days is None:
+        max_age_days = app.config['CHAT_ARCHIVE_AFTER_DAYS']
+    # 归档按批次自行提交，使用独立连接
+    conn = db_manager.open_dedicated()
+    try:
+        archived = chat_sessions.archive_sessions(conn, max_age_days, app.config['CHAT_ARCHIVE_BATCH_SIZE'])
+        if archived:
+            print(f"已归档 {archived} 个超过 {max_age_days} 天未活跃的群聊会话")
+        return archived
+    except Exception as e:
+        print(f"归档群聊会话失败: {e}")
+        return 0
+    finally:
+        conn.close()
+
+_chat_archive_lock = threading.Lock()
+_last_chat_archive = 0.0
+_chat_archive_thread = None
+
+def maybe_archive_chat_sessions():
+    """距离上次归档超过 CHAT_ARCHIVE_INTERVAL 秒时，在后台线程中归档不活跃的会话
+    
+    归档只写数据库，使用单独的守护线程，不占用大模型调用的线程池；上一次归档还没结束时跳过。
+    """
+    global _last_chat_archive, _chat_archive_thread
+    if app.config['CHAT_ARCHIVE_AFTER_DAYS'] <= 0:
+        return
+    now = time.time()
+    with _chat_archive_lock:
+        if now - _last_chat_archive < app.config['CHAT_ARCHIVE_INTERVAL']:
+            return
+        if _chat_archive_thread is not None and _chat_archive_thread.is_alive():
+            return
+        _last_chat_archive = now
+        _chat_archive_thread = threading.Thread(target=run_chat_archive, name='chat-archive', daemon=True)
+        _chat_archive_thread.start()
+
+@app.route('/api/chat', methods=['POST'])
+@login_required
+def chat_api():
+    user = get_current_user()
+    error, params = parse_chat_request(user, request.json)
+    if error:
+        return error
+    
+    character_ids = params['character_ids']
+    session_id = params['session_id']
+    api_key = params['api_key']
     
+    # 更新用户统计
+    update_user_stats(user['id'], model_call_increment=len(character_ids))
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    # 获取角色信息并验证权限，先在请求线程内准备好每个角色的消息列表
+    prepared_characters = prepare_chat_round(
+        cursor, session_id, character_ids, params['user_message'], params['topic'], session.get('user_id'), api_key
+    )
+    # 用户消息先提交，等待大模型回复期间不持有数据库写锁
     conn.commit()
     conn.close()
+    
+    # 所有角色同时生成回复，总耗时约等于最慢的那个角色
+    replies = run_concurrently([
+        partial(generate_chat_reply, char_name, messages, api_key)
+        for _, char_name, messages in prepared_characters
+    ])
+    
+    # 按请求中的角色顺序保存回复到聊天历史（单独的短事务）
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    character_responses = save_chat_replies(cursor, session_id, prepared_characters, replies)
+    conn.commit()
+    conn.close()
+    maybe_archive_chat_sessions()
     return json_response({'responses': character_responses})
 
+@app.route('/api/chat/stream', methods=['POST'])
+@login_required
+def chat_stream_api():
+    """群聊流式接口：通过SSE推送各角色的增量回复
+    
+    事件依次为 start（参与角色）、delta（某角色的增量文本）、
+    done（某角色的完整回复，replaced 为 true 时替换该角色已显示的增量文本）
+    和 end（全部回复，已写入聊天历史）。
+    """
+    user = get_current_user()
+    error, params = parse_chat_request(user, request.json)
+    if error:
+        return error
+    
+    character_ids = params['character_ids']
+    session_id = params['session_id']
+    api_key = params['api_key']
+    
+    # 更新用户统计
+    update_user_stats(user['id'], model_call_increment=len(character_ids))
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    prepared_characters = prepare_chat_round(
+        cursor, session_id, character_ids, params['user_message'], params['topic'], session.get('user_id'), api_key
+    )
+    conn.commit()
+    conn.close()
+    
+    max_concurrency = max(1, app.config['CHAT_MAX_CONCURRENCY_PER_REQUEST'])
+    idle_timeout = app.config['CHAT_STREAM_IDLE_TIMEOUT']
+    
+    def generate():
+        events = queue.Queue()
+        executor = get_llm_executor()
+        replies = [None] * len(prepared_characters)
+        finished = 0
+        next_index = 0
+        
+        yield sse_event('start', {
+            'session_id': session_id,
+            'characters': [
+                {'character_id': char_id, 'character_name': char_name}
+                for char_id, char_name, _ in prepared_characters
+            ]
+        })
+        
+        while finished < len(prepared_characters):
+            # 保持在途角色数不超过单次请求的并发上限
+            while next_index < len(prepared_characters) and next_index - finished < max_concurrency:
+                _, char_name, messages = prepared_characters[next_index]
+                executor.submit(stream_chat_reply, next_index, char_name, messages, api_key, events)
+                next_index += 1
+            
+            try:
+                kind, index, payload = events.get(timeout=idle_timeout)
+            except queue.Empty:
+                # 长时间没有任何角色产出内容：尚未完成的角色全部使用备用回复
+                print(f"流式聊天超过{idle_timeout}秒无响应，剩余角色使用备用回复")
+                for index, (char_id, char_name, _) in enumerate(prepared_characters):
+                    if replies[index] is None:
+                        replies[index] = random.choice(CHAT_FALLBACK_RESPONSES)
+                        yield sse_event('done', {'character_id': char_id, 'character_name': char_name,
+                                                 'message': replies[index], 'replaced': True})
+                break
+            
+            char_id, char_name, _ = prepared_characters[index]
+            if kind == 'delta':
+                yield sse_event('delta', {'character_id': char_id, 'character_name': char_name, 'delta': payload})
+            else:
+                replies[index] = payload['message']
+                finished += 1
+                yield sse_event('done', {'character_id': char_id, 'character_name': char_name, **payload})
+        
+        # 全部回复完成后按请求中的角色顺序写入聊天历史
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        character_responses = save_chat_replies(cursor, session_id, prepared_characters, replies)
+        conn.commit()
+        conn.close()
+        maybe_archive_chat_sessions()
+        
+        yield sse_event('end', {'responses': character_responses})
+    
+    return Response(
+        stream_with_context(generate()),
+        content_type='text/event-stream; charset=utf-8',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/chat/sessions', methods=['GET'])
+@login_required
+def chat_sessions_api():
+    """当前用户的群聊会话列表，按最后活跃时间倒序，用 cursor 参数翻页"""
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    conn = get_db_connection()
+    sessions, next_cursor = chat_sessions.list_sessions(
+        conn.cursor(), session['user_id'], limit, request.args.get('cursor')
+    )
+    conn.close()
+    return json_response({'sessions': sessions, 'next_cursor': next_cursor})
+
+@app.route('/api/chat/sessions/<session_id>/messages', methods=['GET'])
+@login_required
+def chat_session_messages_api(session_id):
+    """会话的聊天记录，从新到旧分页：before_id 传上一页返回的 next_before_id"""
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    chat_session = chat_sessions.get_session(cursor, session_id, session['user_id'])
+    if not chat_session:
+        conn.close()
+        return json_response({'error': '会话不存在'}, 404)
+    
+    messages, next_before_id = chat_sessions.list_messages(
+        cursor, chat_session, limit, request.args.get('before_id', type=int)
+    )
+    conn.close()
+    return json_response({'session': chat_session, 'messages': messages, 'next_before_id': next_before_id})
+
+def parse_search_args():
+    """解析搜索参数，返回 (关键词, 每页条数, 偏移量, 搜索范围的用户ID)
+
+    管理员传 scope=all 时搜索全部用户的数据（用户ID为None）。
+    """
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 50)
+    page = min(max(request.args.get('page', 1, type=int), 1), 50)
+    user = get_current_user()
+    scope_user_id = session['user_id']
+    if request.args.get('scope') == 'all' and user and user['role'] == 'admin':
+        scope_user_id = None
+    return request.args.get('q', '').strip(), limit, (page - 1) * limit, scope_user_id
+
+@app.route('/api/chat/search', methods=['GET'])
+@login_required
+def chat_search_api():
+    """全文搜索聊天记录，按相关度排序，用 page / limit 分页"""
+    query, limit, offset, scope_user_id = parse_search_args()
+    if not query:
+        return json_response({'error': '搜索关键词不能为空'}, 400)
+    
+    conn = get_db_connection()
+    results, has_more = search.search_messages(conn.cursor(), query, scope_user_id, limit, offset)
+    conn.close()
+    return json_response({'results': results, 'page': offset // limit + 1, 'has_more': has_more})
+
 @app.route('/api/set-api-key', methods=['POST'])
 def set_api_key():
     data = request.json
@@ -2123,7 +2209,7 @@ def set_api_key():
     user_session = session.get('user_id', str(uuid.uuid4()))
     session['user_id'] = user_session
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 检查是否已存在配置
@@ -2191,7 +2277,7 @@ def sanctuary_discuss():
     user_session = session.get('user_id', str(uuid.uuid4()))
     session['user_id'] = user_session
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT api_key FROM api_config WHERE user_session = ?', (user_session,))
     result = cursor.fetchone()
@@ -2212,66 +2298,32 @@ def sanctuary_discuss():
         if char_result:
             char_name, base_system_prompt = char_result
             
-            # 构建专门的情绪陪伴系统提示词
-            sanctuary_prompt = f"""{base_system_prompt}
-
-你现在是ChatSanctuary心灵小屋的陪伴者。用户{user_name}分享了他们的情绪困扰："{emotion}"
-
-作为第{round_num + 1}轮对话，你需要：
-
-【核心任务】
-1. 深度理解用户的情绪根源和具体困扰
-2. 提供实用的解决建议或应对策略
-3. 与其他AI角色协作，形成一致的支持方案
-4. 针对其他角色的观点表达同意/补充/不同看法
-
-【回应要求】
-- 如果是第1-2轮：重点共情和理解，挖掘问题核心
-- 如果是第3-5轮：提供具体建议和解决方案
-- 如果是第6-8轮：总结共识，给出最终建议和赠语
-
-【互动规则】
-- 认真阅读其他角色的发言，避免重复
-- 可以说"我同意XX的观点"或"我觉得还可以..."来呼应其他角色
-- 保持你的角色特色，但要专业和治愈导向
-- 每次回复50-80字，要有实质内容
-- 可以偶尔自然地称呼用户的名字，但不要每次都提及，保持对话自然流畅
-- 如果是最后几轮对话，可以给用户一些温暖的赠语或祝福
-- 禁止使用叙述性描述（如"我点点头"、"我看着"等）
-
-请给出你的专业建议："""
-            
-            # 构建消息历史
-            messages = [{'role': 'system', 'content': sanctuary_prompt}]
+            # 构建专门的情绪陪伴系统提示词（角色设定和固定规则在前，本次对话信息在后）
+            sanctuary_prompt = prompt_registry.render(
+                'sanctuary', {'base_system_prompt': base_system_prompt},
+                user_name=user_name, emotion=emotion, round_number=round_num + 1
+            )
             
-            # 添加对话历史
-            for msg in chat_history[-6:]:  # 只取最近6条消息
+            # 构建对话历史
+            history = []
+            for msg in chat_history[-6:]:  # 最多取最近6条消息
                 if msg['type'] == 'user':
-                    messages.append({'role': 'user', 'content': msg['message']})
+                    history.append({'role': 'user', 'content': msg['message']})
                 elif msg['character_id'] == char_id:
-                    messages.append({'role': 'assistant', 'content': msg['message']})
+                    history.append({'role': 'assistant', 'content': msg['message']})
                 else:
                     # 其他角色的消息
                     other_name = msg['sender']
-                    messages.append({'role': 'user', 'content': f"{other_name}说：{msg['message']}"})
+                    history.append({'role': 'user', 'content': f"{other_name}说：{msg['message']}"})
             
-            # 调用API
-            max_retries = 3
-            response = None
+            # 按 token 预算从新到旧保留历史，避免长消息撑大提示
+            messages, _ = fit_messages(
+                {'role': 'system', 'content': sanctuary_prompt}, history,
+                budget=app.config['CHAT_CONTEXT_TOKEN_BUDGET']
+            )
             
-            for attempt in range(max_retries):
-                try:
-                    response = call_qwen_api(messages, api_key)
-                    if response:
-                        break
-                    else:
-                        print(f"Sanctuary角色{char_name}第{attempt + 1}次API调用失败")
-                        if attempt < max_retries - 1:
-                            time.sleep(0.5)
-                except Exception as e:
-                    print(f"Sanctuary角色{char_name}第{attempt + 1}次API调用异常: {e}")
-                    if attempt < max_retries - 1:
-                        time.sleep(0.5)
+            # 调用网关，失败时自动重试
+            response = llm_gateway.complete(messages, api_key, retries=3, retry_delay=0.5, label=f"Sanctuary角色{char_name}")
             
             # 备用回复
             if not response:
@@ -2318,7 +2370,7 @@ def sanctuary_generate_image():
     user_session = session.get('user_id', str(uuid.uuid4()))
     session['user_id'] = user_session
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT api_key FROM api_config WHERE user_session = ?', (user_session,))
     result = cursor.fetchone()
@@ -2350,7 +2402,7 @@ def sanctuary_generate_image():
             {'role': 'user', 'content': analysis_prompt}
         ]
         
-        analysis_response = call_qwen_api(analysis_messages, api_key)
+        analysis_response = llm_gateway.complete(analysis_messages, api_key, label='图像提示词分析')
         
         if not analysis_response:
             # 备用方案
@@ -2409,8 +2461,8 @@ def sanctuary_generate_image():
                 try:
                     # 步骤1: 创建异步任务
                     print(f"正在创建图像生成任务...")
-                    dashscope_response = requests.post(
-                        'https://dashscope.aliyuncs.com/api/v1/services/aigc/text2image/image-synthesis',
+                    dashscope_response = get_http_client().post(
+                        app.config['IMAGE_SYNTHESIS_URL'],
                         headers=dashscope_headers,
                         json=dashscope_data,
                         timeout=30
@@ -2425,13 +2477,13 @@ def sanctuary_generate_image():
                             print(f"阿里云图像生成任务创建成功，task_id: {task_id}")
                             
                             # 步骤2: 轮询查询任务结果
-                            max_attempts = 30  # 最多等待30次，每次2秒
+                            max_attempts = 30  # 最多等待30次，默认每次2秒
                             for attempt in range(max_attempts):
-                                time.sleep(2)  # 等待2秒
+                                time.sleep(app.config['IMAGE_TASK_POLL_INTERVAL'])
                                 
                                 # 查询任务状态
-                                query_url = f'https://dashscope.aliyuncs.com/api/v1/tasks/{task_id}'
-                                query_response = requests.get(
+                                query_url = app.config['TASK_QUERY_URL'].format(task_id=task_id)
+                                query_response = get_http_client().get(
                                     query_url,
                                     headers={'Authorization': f'Bearer {dashscope_api_key}'},
                                     timeout=10
@@ -2566,7 +2618,7 @@ def sanctuary_generate_image():
                 ]
                 
                 # 调用API生成个性化赠语
-                blessing_response = call_qwen_api(blessing_messages, api_key)
+                blessing_response = llm_gateway.complete(blessing_messages, api_key, label=f"角色{char_name}赠语")
                 
                 if blessing_response:
                     blessing = blessing_response.strip()
@@ -2585,7 +2637,7 @@ def sanctuary_generate_image():
         
         # 4. 保存图像到数据库
         user_session = session.get('user_id', str(uuid.uuid4()))
-        conn = sqlite3.connect(app.config['DATABASE_PATH'])
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         try:
@@ -2634,7 +2686,7 @@ def get_sanctuary_gallery():
     if not user_session:
         return json_response({'error': '用户会话无效'}, 401)
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -2679,7 +2731,7 @@ def delete_sanctuary_image(image_id):
     if not user_session:
         return json_response({'error': '用户会话无效'}, 401)
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -2727,7 +2779,7 @@ def generate_character_prompt():
     user_session = session.get('user_id', str(uuid.uuid4()))
     session['user_id'] = user_session
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT api_key FROM api_config WHERE user_session = ?', (user_session,))
     result = cursor.fetchone()
@@ -2755,23 +2807,8 @@ def generate_character_prompt():
         {'role': 'user', 'content': f'请为以下角色描述生成系统提示词：{description}（生成时间：{timestamp}）'}
     ]
     
-    # 多次重试机制
-    max_retries = 3
-    response = None
-    
-    for attempt in range(max_retries):
-        try:
-            response = call_qwen_api(messages, api_key, cache_type_hint='character_generation')
-            if response:
-                break
-            else:
-                print(f"角色提示词生成第{attempt + 1}次API调用失败")
-                if attempt < max_retries - 1:
-                    time.sleep(1)
-        except Exception as e:
-            print(f"角色提示词生成第{attempt + 1}次API调用异常: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(1)
+    # 调用网关，失败时自动重试
+    response = llm_gateway.complete(messages, api_key, cache_type_hint='character_generation', retries=3, retry_delay=1, label='角色提示词生成')
     
     # 如果所有重试都失败，提供备用提示词模板
     if not response:
@@ -2807,7 +2844,7 @@ def start_game():
     if len(selected_characters) < 3 or len(selected_characters) > 6:
         return json_response({'error': '角色数量必须在3-6个之间'}, 400)
     
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # 验证所有选择的角色权限
@@ -2864,20 +2901,18 @@ def start_game():
         'max_rounds': max_rounds,
         'eliminated': [],
         'game_over': False,
-        'winner': None,
-        'descriptions': []
+        'winner': None
     }
     
-    # 保存游戏状态
-    session_id = str(uuid.uuid4())
-    cursor.execute('''
-        INSERT INTO game_sessions (session_id, game_state, current_round, max_rounds)
-        VALUES (?, ?, ?, ?)
-    ''', (session_id, json.dumps(game_state), 1, max_rounds))
-    
-    conn.commit()
     conn.close()
     
+    # 保存游戏状态和玩家（立即写入数据库，之后的状态修改在内存中进行）
+    session_id = str(uuid.uuid4())
+    game_store.create(
+        session_id, game_state, max_rounds,
+        on_insert=lambda cursor: game_records.insert_players(cursor, session_id, selected_characters, undercover_index)
+    )
+    
     return json_response({
         'session_id': session_id,
         'public_word': public_word,
@@ -2888,80 +2923,37 @@ def start_game():
         'max_rounds': max_rounds
     })
 
-@app.route('/api/game/describe', methods=['POST'])
-def character_describe():
-    """AI角色描述词汇"""
-    data = request.json
-    session_id = data.get('session_id')
-    character_index = data.get('character_index')
-    
-    if not session_id:
-        return json_response({'error': '游戏会话ID不能为空'}, 400)
-    
-    # 获取游戏状态
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
-    cursor = conn.cursor()
-    cursor.execute('SELECT game_state FROM game_sessions WHERE session_id = ?', (session_id,))
-    result = cursor.fetchone()
-    
-    if not result:
-        conn.close()
-        return json_response({'error': '游戏会话不存在'}, 404)
-    
-    game_state = json.loads(result[0])
-    
-    if character_index >= len(game_state['characters']):
-        conn.close()
-        return json_response({'error': '角色索引无效'}, 400)
-    
-    character = game_state['characters'][character_index]
-    is_undercover = character_index == game_state['undercover_index']
-    target_word = game_state['undercover_word'] if is_undercover else game_state['public_word']
-    
-    # 获取角色详细信息
-    cursor.execute('SELECT system_prompt FROM characters WHERE id = ?', (character['id'],))
-    char_result = cursor.fetchone()
-    
-    if not char_result:
-        conn.close()
-        return json_response({'error': '角色不存在'}, 404)
-    
-    character_prompt = char_result[0]
-    
-    # 获取API Key
+def get_session_api_key(cursor):
+    """读取当前会话在 api_config 中保存的API Key，没有时返回None"""
     user_session = session.get('user_id', str(uuid.uuid4()))
     session['user_id'] = user_session
     
     cursor.execute('SELECT api_key FROM api_config WHERE user_session = ?', (user_session,))
     api_result = cursor.fetchone()
-    api_key = api_result[0] if api_result else None
+    return api_result[0] if api_result else None
+
+def build_describe_context(game_state, character_index, round_descriptions):
+    """构建描述提示词中的上下文：本轮排在前面的角色的发言，以及之前轮次的描述
     
-    # 获取当前轮次已有的描述（用于上下文参考）
+    round_descriptions 为本轮已有的描述列表（按角色索引，未发言或已淘汰的位置为None）。
+    """
     current_round = game_state.get('current_round', 1)
-    previous_descriptions = []
+    characters = game_state['characters']
     
-    # 获取本轮前面角色的描述
-    for i in range(character_index):
-        if i < len(game_state.get('descriptions', [])) and len(game_state['descriptions']) > 0:
-            if current_round <= len(game_state['descriptions']) and i < len(game_state['descriptions'][current_round-1]):
-                desc_info = game_state['descriptions'][current_round-1][i]
-                char_name = game_state['characters'][i]['name']
-                previous_descriptions.append(f"{char_name}: {desc_info['description']}")
+    # 本轮前面角色的描述
+    previous_descriptions = []
+    for i, desc_info in enumerate(round_descriptions[:character_index]):
+        if desc_info:
+            previous_descriptions.append(f"{characters[i]['name']}: {desc_info['description']}")
     
-    # 获取之前轮次的描述（如果不是第一轮）
+    # 之前轮次的描述（如果不是第一轮）
     previous_rounds_context = ""
-    if current_round > 1 and 'descriptions' in game_state:
-        for round_idx in range(current_round - 1):
-            if round_idx < len(game_state['descriptions']):
-                round_descs = []
-                for char_idx, desc_info in enumerate(game_state['descriptions'][round_idx]):
-                    if char_idx < len(game_state['characters']):
-                        char_name = game_state['characters'][char_idx]['name']
-                        round_descs.append(f"{char_name}: {desc_info['description']}")
-                if round_descs:
-                    previous_rounds_context += f"\n第{round_idx + 1}轮描述:\n" + "\n".join(round_descs)
-    
-    conn.close()
+    for round_idx, round_descs in enumerate(game_state.get('descriptions', [])[:current_round - 1]):
+        lines = [f"{characters[char_idx]['name']}: {desc_info['description']}"
+                 for char_idx, desc_info in enumerate(round_descs)
+                 if desc_info and char_idx < len(characters)]
+        if lines:
+            previous_rounds_context += f"\n第{round_idx + 1}轮描述:\n" + "\n".join(lines)
     
     # 构建上下文信息 - 简化格式避免前分句问题
     context_info = ""
@@ -2969,80 +2961,24 @@ def character_describe():
         context_info += f"\n\n【本轮其他角色已发言】:\n" + "\n".join(previous_descriptions)
     if previous_rounds_context:
         context_info += f"\n\n【历史轮次参考】:{previous_rounds_context}"
-    
-    # 构建提示词
-    if is_undercover:
-        system_message = f'''{character_prompt}
-
-你是本局游戏的卧底，你拿到的词是：「{target_word}」。
-你不知道其他人的词是什么，只知道它可能是同类事物（如：同属"文具"、同属"食物"等）。
-
-**重要约束**：
-1. **绝对禁止**直接说出你的目标词「{target_word}」或其任何变形
-2. **绝对禁止**使用目标词的拼音、首字母、谐音
-3. **绝对禁止**明确描述外观、颜色、质地等精确特征
-4. **绝对禁止**明确说出类别名称
-
-你的目标是：在维持角色性格的基础上，尽可能模糊描述你拿到的词，**不要暴露关键特征**，但要让别人觉得你和他们是同一类。
-
-**参考策略**：
-- 如果前面有人发言，要从**不同角度**描述，避免重复相同的表达方式
-- 可以描述使用感受、使用情境、联想印象、童年记忆、情感体验
-- 保持模糊性：用"那种感觉"、"某种体验"等模糊表达
-- 情绪化表达：引发共鸣但不暴露具体信息
-- 保持你的角色性格和语气习惯{context_info}
-- 禁止使用叙述性描述（如"我点点头"、"我看着"等）
-
-**要求**：请直接说出你的描述，用1句自然的话语表达（35~50字），不要重复他人的角度，保持你的角色特色。
-'''
-    else:
-        system_message = f'''{character_prompt}
-
-你是本局游戏的平民，你拿到的关键词是：「{target_word}」。
-
-**重要约束**：
-1. **绝对禁止**直接说出目标词「{target_word}」或其任何变形
-2. **绝对禁止**使用目标词的拼音、首字母、谐音
-3. **绝对禁止**明确描述外观、材质等过于明显的特征
-4. **绝对禁止**暗示字数、读音、发音结构
-
-你需要在不暴露关键词的前提下，以**角色性格风格**进行表达，帮助同阵营的人理解你指的是什么，同时迷惑卧底。
-
-**参考策略**：
-- 如果前面有人发言，要从**不同角度**描述，避免重复
-- 情境化：在哪些时候会用到它，但要模糊表达
-- 联想型：它让你想到什么东西或回忆，但不要太直接
-- 抽象感受：它给你带来的情绪或氛围
-- 功能暗示：用模糊的方式暗示用途，但不要太明显{context_info}
+    return context_info
 
-**重要对话规则**：
-- 禁止使用叙述性描述（如"我点点头"、"我看着"等）
-
-**要求**：请直接说出你的描述，用1句符合角色性格的自然话语（35~50字），避免重复他人的表达方式。
-'''
+def generate_description(character, is_undercover, target_word, character_prompt, context_info, api_key):
+    """生成单个角色的描述，所有重试都失败时使用备用描述"""
+    # 构建提示词：角色设定和固定规则在前，本局词语和其他角色的发言在后
+    system_message = prompt_registry.render(
+        'describe_undercover' if is_undercover else 'describe_civilian',
+        {'character_prompt': character_prompt},
+        target_word=target_word, context_info=context_info
+    )
     
     messages = [
         {'role': 'system', 'content': system_message},
         {'role': 'user', 'content': '请开始你的描述。'}
     ]
     
-    # 多次重试机制
-    max_retries = 3
-    response = None
-    
-    for attempt in range(max_retries):
-        try:
-            response = call_qwen_api(messages, api_key)
-            if response:
-                break
-            else:
-                print(f"第{attempt + 1}次API调用失败，准备重试...")
-                if attempt < max_retries - 1:
-                    time.sleep(1)  # 等待1秒后重试
-        except Exception as e:
-            print(f"第{attempt + 1}次API调用异常: {str(e)}")
-            if attempt < max_retries - 1:
-                time.sleep(1)
+    # 调用网关，失败时自动重试
+    response = llm_gateway.complete(messages, api_key, retries=3, retry_delay=1, label=f"角色{character['name']}描述")
     
     # 如果所有重试都失败，提供备用描述
     if not response:
@@ -3062,63 +2998,272 @@ def character_describe():
                 f"大家对这个应该都有共同的认知吧。"
             ]
         
-        import random
         response = random.choice(fallback_descriptions)
         print(f"使用备用描述: {response}")
     
+    return response
+
+def load_game_descriptions(cursor, session_id, game_state):
+    """从 game_descriptions 表读取到当前轮次为止的描述，填入游戏状态副本的 descriptions"""
+    game_state['descriptions'] = game_records.load_descriptions(
+        cursor, game_state, session_id, game_state.get('current_round', 1)
+    )
+
+def current_round_descriptions(game_state):
+    """返回当前轮次的描述列表（不存在时创建），长度补齐到角色数"""
+    descriptions = game_state.setdefault('descriptions', [])
+    current_round = game_state.get('current_round', 1)
+    while len(descriptions) < current_round:
+        descriptions.append([])
+    round_descriptions = descriptions[current_round - 1]
+    while len(round_descriptions) < len(game_state['characters']):
+        round_descriptions.append(None)
+    return round_descriptions
+
+def save_round_descriptions(session_id, round_number, new_descriptions):
+    """把 {角色索引: 描述} 追加到 game_descriptions 表的指定轮次"""
+    conn = get_db_connection()
+    try:
+        game_records.add_descriptions(conn.cursor(), session_id, round_number, new_descriptions)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def record_votes(session_id, round_number, votes, source, eliminated_index=None):
+    """追加一轮的投票记录，并记录被淘汰的角色"""
+    conn = get_db_connection()
     try:
-        # 保存描述到游戏状态
-        conn = sqlite3.connect(app.config['DATABASE_PATH'])
         cursor = conn.cursor()
-        cursor.execute('SELECT game_state FROM game_sessions WHERE session_id = ?', (session_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            game_state = json.loads(result[0])
-            
-            # 初始化descriptions结构
-            if 'descriptions' not in game_state:
-                game_state['descriptions'] = []
-            
-            # 确保当前轮次的描述列表存在
-            current_round = game_state.get('current_round', 1)
-            while len(game_state['descriptions']) < current_round:
-                game_state['descriptions'].append([])
-            
-            # 保存当前角色的描述
-            current_round_descriptions = game_state['descriptions'][current_round - 1]
-            while len(current_round_descriptions) <= character_index:
-                current_round_descriptions.append(None)
-            
-            current_round_descriptions[character_index] = {
-                'character_name': character['name'],
-                'description': response,
-                'is_undercover': is_undercover
-            }
-            
-            # 更新游戏状态
-            cursor.execute('UPDATE game_sessions SET game_state = ? WHERE session_id = ?', 
-                           (json.dumps(game_state), session_id))
-            conn.commit()
-        
+        game_records.add_votes(cursor, session_id, round_number, votes, source)
+        if eliminated_index is not None:
+            game_records.mark_eliminated(cursor, session_id, eliminated_index, round_number)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         conn.close()
-        
-        return json_response({
-            'character_name': character['name'],
-            'description': response,
-            'is_undercover': is_undercover,
-            'target_word': target_word
-        })
-        
+
+@app.route('/api/game/describe', methods=['POST'])
+def character_describe():
+    """AI角色描述词汇"""
+    data = request.json
+    session_id = data.get('session_id')
+    character_index = data.get('character_index')
+    
+    if not session_id:
+        return json_response({'error': '游戏会话ID不能为空'}, 400)
+    
+    # 获取游戏状态
+    game_state = game_store.snapshot(session_id)
+    if game_state is None:
+        return json_response({'error': '游戏会话不存在'}, 404)
+    
+    if character_index >= len(game_state['characters']):
+        return json_response({'error': '角色索引无效'}, 400)
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    character = game_state['characters'][character_index]
+    is_undercover = character_index == game_state['undercover_index']
+    target_word = game_state['undercover_word'] if is_undercover else game_state['public_word']
+    
+    # 获取角色详细信息
+    cursor.execute('SELECT system_prompt FROM characters WHERE id = ?', (character['id'],))
+    char_result = cursor.fetchone()
+    
+    if not char_result:
+        conn.close()
+        return json_response({'error': '角色不存在'}, 404)
+    
+    character_prompt = char_result[0]
+    api_key = get_session_api_key(cursor)
+    load_game_descriptions(cursor, session_id, game_state)
+    conn.close()
+    
+    context_info = build_describe_context(game_state, character_index, current_round_descriptions(game_state))
+    response = generate_description(character, is_undercover, target_word, character_prompt, context_info, api_key)
+    
+    try:
+        # 保存描述
+        save_round_descriptions(session_id, game_state.get('current_round', 1), {character_index: response})
     except Exception as e:
         print(f"保存描述时发生错误: {str(e)}")
         # 即使保存失败，也要返回生成的描述
-        return json_response({
+    
+    return json_response({
+        'character_name': character['name'],
+        'description': response,
+        'is_undercover': is_undercover,
+        'target_word': target_word
+    })
+
+@app.route('/api/game/describe-round', methods=['POST'])
+def describe_round():
+    """一次生成本轮所有存活角色的描述，通过SSE逐个推送
+    
+    默认按角色顺序依次生成，后发言的角色能看到本轮前面角色的描述；parallel 为 true 时
+    所有角色同时生成（只参考之前轮次的描述），按完成顺序推送。
+    事件依次为 start（本轮发言角色）、thinking（顺序模式下某角色开始思考）、
+    description（某角色的描述）和 end（本轮全部描述）。每条描述生成后先写入
+    game_descriptions 再推送，客户端中途断开也不会丢失；重新请求同一轮时，
+    已有描述的角色不再生成。
+    """
+    data = request.json or {}
+    session_id = data.get('session_id')
+    parallel = bool(data.get('parallel', False))
+    
+    if not session_id:
+        return json_response({'error': '游戏会话ID不能为空'}, 400)
+    
+    # 游戏状态、API Key 和所有角色设定只读取一次
+    game_state = game_store.snapshot(session_id)
+    if game_state is None:
+        return json_response({'error': '游戏会话不存在'}, 404)
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    speakers = [i for i in range(len(game_state['characters'])) if i not in game_state.get('eliminated', [])]
+    
+    character_ids = list(dict.fromkeys(game_state['characters'][i]['id'] for i in speakers))
+    character_prompts = {}
+    if character_ids:
+        placeholders = ','.join('?' * len(character_ids))
+        cursor.execute(f'SELECT id, system_prompt FROM characters WHERE id IN ({placeholders})', character_ids)
+        # 按字符串比较ID，兼容游戏状态中字符串形式的角色ID
+        character_prompts = {str(row[0]): row[1] for row in cursor.fetchall()}
+    api_key = get_session_api_key(cursor)
+    load_game_descriptions(cursor, session_id, game_state)
+    conn.close()
+    
+    speakers = [i for i in speakers if str(game_state['characters'][i]['id']) in character_prompts]
+    round_descriptions = list(current_round_descriptions(game_state))
+    current_round = game_state.get('current_round', 1)
+    
+    # 本轮已经发言（之前的请求已保存）的角色直接沿用原描述
+    results = {}
+    for i in speakers:
+        if round_descriptions[i] is not None:
+            results[i] = {
+                'character_index': i,
+                'character_name': round_descriptions[i]['character_name'],
+                'description': round_descriptions[i]['description'],
+                'is_undercover': round_descriptions[i]['is_undercover'],
+                'target_word': game_state['undercover_word'] if round_descriptions[i]['is_undercover'] else game_state['public_word']
+            }
+    pending = [i for i in speakers if i not in results]
+    
+    def describe(character_index, context_info):
+        character = game_state['characters'][character_index]
+        is_undercover = character_index == game_state['undercover_index']
+        target_word = game_state['undercover_word'] if is_undercover else game_state['public_word']
+        response = generate_description(
+            character, is_undercover, target_word,
+            character_prompts[str(character['id'])], context_info, api_key
+        )
+        return {
+            'character_index': character_index,
             'character_name': character['name'],
             'description': response,
             'is_undercover': is_undercover,
             'target_word': target_word
+        }
+    
+    def save(result):
+        # 推送前先写入，客户端断开时已推送的描述都已保存
+        try:
+            save_round_descriptions(session_id, current_round, {result['character_index']: result['description']})
+        except Exception as e:
+            print(f"保存角色{result['character_name']}的描述时发生错误: {str(e)}")
+        results[result['character_index']] = result
+    
+    def generate():
+        yield sse_event('start', {
+            'session_id': session_id,
+            'round': current_round,
+            'parallel': parallel,
+            'characters': [
+                {'character_index': i, 'character_name': game_state['characters'][i]['name']}
+                for i in pending
+            ]
         })
+        
+        if parallel:
+            # 只参考之前轮次的描述，所有角色同时生成
+            empty_round = [None] * len(game_state['characters'])
+            tasks = [partial(describe, i, build_describe_context(game_state, i, empty_round)) for i in pending]
+            for _, result in iter_concurrently(tasks):
+                if result:
+                    save(result)
+                    yield sse_event('description', result)
+        else:
+            # 按顺序生成，每个角色都能看到本轮前面角色的描述
+            for i in pending:
+                yield sse_event('thinking', {'character_index': i, 'character_name': game_state['characters'][i]['name']})
+                result = describe(i, build_describe_context(game_state, i, round_descriptions))
+                round_descriptions[i] = {
+                    'character_name': result['character_name'],
+                    'description': result['description'],
+                    'is_undercover': result['is_undercover']
+                }
+                save(result)
+                yield sse_event('description', result)
+        
+        yield sse_event('end', {'round': current_round, 'descriptions': [results[i] for i in speakers if i in results]})
+    
+    return Response(
+        stream_with_context(generate()),
+        content_type='text/event-stream; charset=utf-8',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def generate_ai_vote(game_state, char_index, character, is_undercover, messages, api_key):
+    """生成单个AI角色的投票，失败时使用备用投票；没有可投票的目标时返回None"""
+    # 调用网关，失败时自动重试
+    response = llm_gateway.complete(messages, api_key, retries=3, retry_delay=0.5, label=f"角色{character['name']}投票")
+    
+    # 如果API调用失败，生成备用投票
+    if not response:
+        # 获取可投票的角色列表（排除自己）
+        available_targets = []
+        for i, char in enumerate(game_state['characters']):
+            if i != char_index:  # 不能投票给自己
+                available_targets.append((i, char['name']))
+        
+        if available_targets:
+            # 根据角色身份选择不同的备用策略
+            if is_undercover:
+                # 卧底倾向于随机投票或投票给看起来最可疑的平民
+                target_idx, target_name = random.choice(available_targets)
+                reasons = [
+                    "感觉这个人的描述有些奇怪",
+                    "直觉告诉我应该投这个人", 
+                    "这个人的表达方式让我怀疑",
+                    "综合考虑后选择这个人"
+                ]
+            else:
+                # 平民可能更倾向于投票给真正的卧底，但由于不知道谁是卧底，也是随机
+                target_idx, target_name = random.choice(available_targets)
+                reasons = [
+                    "这个人的描述和我理解的不太一样",
+                    "感觉这个人可能是卧底",
+                    "这个人的表达有些可疑",
+                    "基于分析选择投票给这个人"
+                ]
+            
+            reason = random.choice(reasons)
+            response = f"投票给：{target_name}，理由：{reason}"
+            print(f"角色{character['name']}使用备用投票: {response}")
+        else:
+            # 如果没有可投票的目标，跳过这个角色
+            print(f"角色{character['name']}没有可投票的目标，跳过")
+            return None
+    
+    return response
 
 @app.route('/api/game/ai-vote', methods=['POST'])
 def ai_vote():
@@ -3130,16 +3275,12 @@ def ai_vote():
         return json_response({'error': '游戏会话ID不能为空'}, 400)
     
     # 获取游戏状态
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
-    cursor = conn.cursor()
-    cursor.execute('SELECT game_state FROM game_sessions WHERE session_id = ?', (session_id,))
-    result = cursor.fetchone()
-    
-    if not result:
-        conn.close()
+    game_state = game_store.snapshot(session_id)
+    if game_state is None:
         return json_response({'error': '游戏会话不存在'}, 404)
     
-    game_state = json.loads(result[0])
+    conn = get_db_connection()
+    cursor = conn.cursor()
     
     # 获取API Key
     user_session = session.get('user_id', str(uuid.uuid4()))
@@ -3150,248 +3291,157 @@ def ai_vote():
     api_key = api_result[0] if api_result else None
     
     # 获取当前轮次的描述
-    current_round = game_state.get('current_round', 1)
+    load_game_descriptions(cursor, session_id, game_state)
     current_descriptions = []
-    if 'descriptions' in game_state and current_round <= len(game_state['descriptions']):
-        for i, desc_info in enumerate(game_state['descriptions'][current_round - 1]):
-            if desc_info and i not in game_state['eliminated']:
-                current_descriptions.append(f"{desc_info['character_name']}: {desc_info['description']}")
+    for i, desc_info in enumerate(current_round_descriptions(game_state)):
+        if desc_info and i not in game_state['eliminated']:
+            current_descriptions.append(f"{desc_info['character_name']}: {desc_info['description']}")
     
-    # 生成每个AI角色的投票
-    vote_results = []
+    # 一次查询所有存活角色的设定
     remaining_characters = [i for i in range(len(game_state['characters'])) if i not in game_state['eliminated']]
+    character_ids = list(dict.fromkeys(game_state['characters'][i]['id'] for i in remaining_characters))
+    character_prompts = {}
+    if character_ids:
+        placeholders = ','.join('?' * len(character_ids))
+        cursor.execute(f'SELECT id, system_prompt FROM characters WHERE id IN ({placeholders})', character_ids)
+        # 按字符串比较ID，兼容游戏状态中字符串形式的角色ID
+        character_prompts = {str(row[0]): row[1] for row in cursor.fetchall()}
+    conn.close()
     
+    # 先为每个AI角色构建投票提示词
+    vote_tasks = []
     for char_index in remaining_characters:
         character = game_state['characters'][char_index]
         is_undercover = char_index == game_state['undercover_index']
+        character_prompt = character_prompts.get(str(character['id']))
+        if character_prompt is None:
+            continue
         
-        # 获取角色详细信息
-        cursor.execute('SELECT system_prompt FROM characters WHERE id = ?', (character['id'],))
-        char_result = cursor.fetchone()
+        # 构建投票提示词
+        descriptions_text = "\n".join(current_descriptions)
+        other_characters = [game_state['characters'][i]['name'] for i in remaining_characters if i != char_index]
         
-        if char_result:
-            character_prompt = char_result[0]
-            
-            # 构建投票提示词
-            descriptions_text = "\n".join(current_descriptions)
-            other_characters = [game_state['characters'][i]['name'] for i in remaining_characters if i != char_index]
-            
-            if is_undercover:
-                # 为卧底添加多样化的策略选择
-                import random
-                
-                undercover_strategies = [
-                    "选择一个描述中等可疑的平民，避免过于明显",
-                    "投票给描述最详细的平民，暗示其过度解释", 
-                    "选择描述风格与众不同的平民进行投票",
-                    "投票给之前轮次表现突出的平民角色",
-                    "选择一个相对安全的目标，避免引起注意",
-
-                ]
-                undercover_strategy = random.choice(undercover_strategies)
-                
-                # 卧底的伪装风格
-                disguise_styles = [
-                    "表现得像一个谨慎的平民",
-                    "模仿一个有些困惑但努力分析的平民",
-                    "装作一个直觉型的平民",
-                    "伪装成逻辑分析型的平民"
-                ]
-                disguise_style = random.choice(disguise_styles)
-                
-                # 卧底的风险控制
-                risk_controls = [
-                    "保持低调，避免成为焦点",
-                    "适度参与讨论，不过分积极也不过分消极",
-                    "在投票理由中展现'平民思维'"
-                ]
-                risk_control = random.choice(risk_controls)
-                
-                vote_prompt = f'''{character_prompt}
-
-你是本局游戏的卧底，你的目标词是「{game_state['undercover_word']}」。
-平民们的目标词是「{game_state['public_word']}」。
-
-现在是投票环节，你需要巧妙地引导投票，避免自己被淘汰。
-
-本轮所有人的描述：
-{descriptions_text}
-
-可投票的角色：{', '.join(other_characters)}
-
-**你的卧底策略**：{undercover_strategy}
-**你的伪装风格**：{disguise_style}
-**你的风险控制**：{risk_control}
-
-**卧底投票要求**：
-1. 绝对不能暴露自己的卧底身份
-2. 投票理由要符合平民的思维逻辑
-3. 避免投票过于明显或过于隐蔽
-4. 保持角色性格的一致性
-5. 可以适当误导其他玩家的判断
-6. 在必要时可以牺牲一个平民来保护自己
-7. 投票理由中不要包含你拿到的目标词「{game_state['public_word']}」
-
-请选择一个角色进行投票，并简要说明理由（30字以内）。
-格式：投票给：[角色名]，理由：[理由]'''
-            else:
-                # 为平民角色添加随机性和个性化投票策略
-                import random
-                
-                # 扩展投票策略，增加更多随机性
-                base_strategies = [
-                    "重点关注描述过于模糊的角色",
-                    "重点关注描述与主流不符的角色", 
-                    "重点关注描述过于详细可能在掩饰的角色",
-                    "重点关注描述用词奇怪的角色",
-                    "重点关注描述逻辑不通的角色",
-                    "重点关注描述过于简单的角色",
-                    "重点关注描述过于复杂的角色",
-                    "重点关注描述风格突兀的角色",
-                    "重点关注描述内容重复的角色",
-                    "重点关注描述角度独特的角色"
-                ]
-                
-                # 根据角色性格调整策略倾向
-                character_personality = character.get('personality', '')
-                if '谨慎' in character_personality or '细心' in character_personality:
-                    strategy_weights = [2, 3, 2, 3, 3, 1, 1, 2, 2, 1]  # 更关注细节
-                elif '直觉' in character_personality or '冲动' in character_personality:
-                    strategy_weights = [1, 3, 1, 2, 1, 2, 1, 3, 1, 3]  # 更关注感觉
-                elif '理性' in character_personality or '逻辑' in character_personality:
-                    strategy_weights = [1, 2, 3, 1, 3, 2, 3, 1, 3, 1]  # 更关注逻辑
-                else:
-                    strategy_weights = [1] * len(base_strategies)  # 均等权重
-                
-                # 加权随机选择策略
-                strategy_hint = random.choices(base_strategies, weights=strategy_weights)[0]
-                
-                # 添加随机的个性化分析角度
-                analysis_angles = [
-                    "从语言习惯角度分析",
-                    "从描述深度角度判断", 
-                    "从情感表达角度观察",
-                    "从逻辑连贯性角度思考",
-                    "从用词选择角度评估",
-                    "从表达方式角度考虑"
-                ]
-                analysis_angle = random.choice(analysis_angles)
-                
-                # 添加随机的思考深度和风险偏好
-                risk_preferences = [
-                    "倾向于保守投票，选择最明显可疑的角色",
-                    "愿意冒险投票，可能选择不太明显的目标", 
-                    "中等风险偏好，平衡考虑各种因素"
-                ]
-                risk_preference = random.choice(risk_preferences)
-                
-                # 随机的投票信心度
-                confidence_levels = [
-                    "对自己的判断很有信心",
-                    "对判断有些不确定，但会坚持选择",
-                    "感到有些困惑，但会尽力分析"
-                ]
-                confidence_level = random.choice(confidence_levels)
-                
-                vote_prompt = f'''{character_prompt}
-
-你是本局游戏的平民，你的目标词是「{game_state['public_word']}」。
-卧底的目标词是「{game_state['undercover_word']}」（你不知道这个词）。
-
-现在是投票环节，你需要分析所有人的描述，找出最可能是卧底的人。
-
-本轮所有人的描述：
-{descriptions_text}
-
-可投票的角色：{', '.join(other_characters)}
-
-**你的分析方式**：{analysis_angle}
-**你的投票策略**：{strategy_hint}
-**你的风险偏好**：{risk_preference}
-**你的信心状态**：{confidence_level}
-
-**投票要求**：
-1. 根据你的个人判断和上述策略进行独立分析
-2. 每个平民的怀疑对象可能不同，这很正常
-3. 结合你的角色性格和思维方式进行判断
-4. 不要完全跟随他人的选择，保持独立思考
-5. 可以适当考虑心理博弈和反向思维
-6. 在不确定时，可以选择相对安全的投票策略
-7. 投票理由中不要包含你拿到的目标词「{game_state['public_word']}」
-
-请选择一个角色进行投票，并简要说明理由（30字以内）。
-格式：投票给：[角色名]，理由：[理由]'''
+        if is_undercover:
+            # 为卧底添加多样化的策略选择
+            undercover_strategies = [
+                "选择一个描述中等可疑的平民，避免过于明显",
+                "投票给描述最详细的平民，暗示其过度解释", 
+                "选择描述风格与众不同的平民进行投票",
+                "投票给之前轮次表现突出的平民角色",
+                "选择一个相对安全的目标，避免引起注意",
             
-            messages = [
-                {'role': 'system', 'content': vote_prompt},
-                {'role': 'user', 'content': '请开始你的投票。'}
             ]
+            undercover_strategy = random.choice(undercover_strategies)
+            
+            # 卧底的伪装风格
+            disguise_styles = [
+                "表现得像一个谨慎的平民",
+                "模仿一个有些困惑但努力分析的平民",
+                "装作一个直觉型的平民",
+                "伪装成逻辑分析型的平民"
+            ]
+            disguise_style = random.choice(disguise_styles)
             
-            # 多次重试机制
-            max_retries = 3
-            response = None
+            # 卧底的风险控制
+            risk_controls = [
+                "保持低调，避免成为焦点",
+                "适度参与讨论，不过分积极也不过分消极",
+                "在投票理由中展现'平民思维'"
+            ]
+            risk_control = random.choice(risk_controls)
+            
+            vote_prompt = prompt_registry.render(
+                'vote_undercover', {'character_prompt': character_prompt},
+                undercover_word=game_state['undercover_word'], public_word=game_state['public_word'],
+                descriptions_text=descriptions_text, candidates=', '.join(other_characters),
+                undercover_strategy=undercover_strategy, disguise_style=disguise_style, risk_control=risk_control
+            )
+        else:
+            # 为平民角色添加随机性和个性化投票策略
+            # 扩展投票策略，增加更多随机性
+            base_strategies = [
+                "重点关注描述过于模糊的角色",
+                "重点关注描述与主流不符的角色", 
+                "重点关注描述过于详细可能在掩饰的角色",
+                "重点关注描述用词奇怪的角色",
+                "重点关注描述逻辑不通的角色",
+                "重点关注描述过于简单的角色",
+                "重点关注描述过于复杂的角色",
+                "重点关注描述风格突兀的角色",
+                "重点关注描述内容重复的角色",
+                "重点关注描述角度独特的角色"
+            ]
             
-            for attempt in range(max_retries):
-                try:
-                    response = call_qwen_api(messages, api_key)
-                    if response:
-                        break
-                    else:
-                        print(f"角色{character['name']}第{attempt + 1}次投票API调用失败")
-                        if attempt < max_retries - 1:
-                            time.sleep(0.5)
-                except Exception as e:
-                    print(f"角色{character['name']}第{attempt + 1}次投票异常: {e}")
-                    if attempt < max_retries - 1:
-                        time.sleep(0.5)
+            # 根据角色性格调整策略倾向
+            character_personality = character.get('personality', '')
+            if '谨慎' in character_personality or '细心' in character_personality:
+                strategy_weights = [2, 3, 2, 3, 3, 1, 1, 2, 2, 1]  # 更关注细节
+            elif '直觉' in character_personality or '冲动' in character_personality:
+                strategy_weights = [1, 3, 1, 2, 1, 2, 1, 3, 1, 3]  # 更关注感觉
+            elif '理性' in character_personality or '逻辑' in character_personality:
+                strategy_weights = [1, 2, 3, 1, 3, 2, 3, 1, 3, 1]  # 更关注逻辑
+            else:
+                strategy_weights = [1] * len(base_strategies)  # 均等权重
+            
+            # 加权随机选择策略
+            strategy_hint = random.choices(base_strategies, weights=strategy_weights)[0]
+            
+            # 添加随机的个性化分析角度
+            analysis_angles = [
+                "从语言习惯角度分析",
+                "从描述深度角度判断", 
+                "从情感表达角度观察",
+                "从逻辑连贯性角度思考",
+                "从用词选择角度评估",
+                "从表达方式角度考虑"
+            ]
+            analysis_angle = random.choice(analysis_angles)
             
-            # 如果API调用失败，生成备用投票
-            if not response:
-                # 获取可投票的角色列表（排除自己）
-                available_targets = []
-                for i, char in enumerate(game_state['characters']):
-                    if i != char_index:  # 不能投票给自己
-                        available_targets.append((i, char['name']))
-                
-                if available_targets:
-                    # 根据角色身份选择不同的备用策略
-                    if is_undercover:
-                        # 卧底倾向于随机投票或投票给看起来最可疑的平民
-                        target_idx, target_name = random.choice(available_targets)
-                        reasons = [
-                            "感觉这个人的描述有些奇怪",
-                            "直觉告诉我应该投这个人", 
-                            "这个人的表达方式让我怀疑",
-                            "综合考虑后选择这个人"
-                        ]
-                    else:
-                        # 平民可能更倾向于投票给真正的卧底，但由于不知道谁是卧底，也是随机
-                        target_idx, target_name = random.choice(available_targets)
-                        reasons = [
-                            "这个人的描述和我理解的不太一样",
-                            "感觉这个人可能是卧底",
-                            "这个人的表达有些可疑",
-                            "基于分析选择投票给这个人"
-                        ]
-                    
-                    reason = random.choice(reasons)
-                    response = f"投票给：{target_name}，理由：{reason}"
-                    print(f"角色{character['name']}使用备用投票: {response}")
-                else:
-                    # 如果没有可投票的目标，跳过这个角色
-                    print(f"角色{character['name']}没有可投票的目标，跳过")
-                    continue
+            # 添加随机的思考深度和风险偏好
+            risk_preferences = [
+                "倾向于保守投票，选择最明显可疑的角色",
+                "愿意冒险投票，可能选择不太明显的目标", 
+                "中等风险偏好，平衡考虑各种因素"
+            ]
+            risk_preference = random.choice(risk_preferences)
             
-            # 添加投票结果
-            if response:
-                vote_results.append({
-                    'character_name': character['name'],
-                    'character_index': char_index,
-                    'vote_response': response,
-                    'is_undercover': is_undercover
-                })
+            # 随机的投票信心度
+            confidence_levels = [
+                "对自己的判断很有信心",
+                "对判断有些不确定，但会坚持选择",
+                "感到有些困惑，但会尽力分析"
+            ]
+            confidence_level = random.choice(confidence_levels)
+            
+            vote_prompt = prompt_registry.render(
+                'vote_civilian', {'character_prompt': character_prompt},
+                public_word=game_state['public_word'], undercover_word=game_state['undercover_word'],
+                descriptions_text=descriptions_text, candidates=', '.join(other_characters),
+                analysis_angle=analysis_angle, strategy_hint=strategy_hint,
+                risk_preference=risk_preference, confidence_level=confidence_level
+            )
+        
+        messages = [
+            {'role': 'system', 'content': vote_prompt},
+            {'role': 'user', 'content': '请开始你的投票。'}
+        ]
+        vote_tasks.append((char_index, character, is_undercover, messages))
     
-    conn.close()
+    # 所有角色同时投票，总耗时约等于最慢的那次调用；结果按角色顺序排列
+    responses = run_concurrently([
+        partial(generate_ai_vote, game_state, char_index, character, is_undercover, messages, api_key)
+        for char_index, character, is_undercover, messages in vote_tasks
+    ])
+    
+    vote_results = []
+    for (char_index, character, is_undercover, _), response in zip(vote_tasks, responses):
+        if response:
+            vote_results.append({
+                'character_name': character['name'],
+                'character_index': char_index,
+                'vote_response': response,
+                'is_undercover': is_undercover
+            })
     
     return json_response({
         'vote_results': vote_results,
@@ -3408,73 +3458,100 @@ def process_ai_votes():
     if not session_id:
         return json_response({'error': '游戏会话ID不能为空'}, 400)
     
-    # 获取游戏状态
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
-    cursor = conn.cursor()
-    cursor.execute('SELECT game_state FROM game_sessions WHERE session_id = ?', (session_id,))
-    result = cursor.fetchone()
+    # 持有该局游戏的锁统计投票并淘汰角色，同一局的重复提交依次处理
+    with game_store.open(session_id, write=True) as game_state:
+        if game_state is None:
+            return json_response({'error': '游戏会话不存在'}, 404)
+        applied = apply_ai_votes(session_id, game_state, vote_results)
     
-    if not result:
-        conn.close()
-        return json_response({'error': '游戏会话不存在'}, 404)
+    if applied is None:
+        return json_response({'error': '投票解析失败'}, 400)
+    
+    # 淘汰话语需要调用大模型，在释放游戏锁之后生成
+    result, speech_args = applied
+    eliminated = result['eliminated_character']
+    eliminated['elimination_speech'] = add_elimination_speech(session_id, eliminated['index'], *speech_args)
+    return json_response(result)
+
+def add_elimination_speech(session_id, character_index, character, is_undercover, game_context):
+    """在游戏锁外生成被淘汰角色的话语，再短暂持锁记入游戏状态"""
+    speech = generate_elimination_speech(character, is_undercover, game_context)
+    with game_store.open(session_id, write=True) as game_state:
+        if game_state is not None:
+            game_state.setdefault('elimination_speeches', {})[str(character_index)] = speech
+    return speech
+
+# 多种投票格式的解析，按顺序尝试
+VOTE_PATTERNS = [
+    r'投票给：([^，,。！？\n]+)',
+    r'投票：([^，,。！？\n]+)', 
+    r'选择：([^，,。！？\n]+)',
+    r'我投([^，,。！？\n]+)',
+    r'投([^，,。！？\n]+)'
+]
+
+def parse_vote(vote_response, game_state):
+    """从投票回复中解析被投票的存活角色
+    
+    返回 (角色索引, 角色名, 匹配方式)，匹配方式为命中的 VOTE_PATTERNS 中的正则、
+    'name_mention'（回复中直接提到了角色名）或 None；解析不出存活角色时角色索引为 None。
+    """
+    import re
+    voted_for = None
+    matched_by = None
+    
+    for pattern in VOTE_PATTERNS:
+        match = re.search(pattern, vote_response)
+        if match:
+            voted_for = match.group(1).strip()
+            matched_by = pattern if voted_for else None
+            break
+    
+    # 如果没有找到明确的投票格式，尝试从文本中提取角色名
+    if not voted_for:
+        for i, char in enumerate(game_state['characters']):
+            if i not in game_state['eliminated'] and char['name'] in vote_response:
+                voted_for = char['name']
+                matched_by = 'name_mention'
+                break
     
-    game_state = json.loads(result[0])
+    if voted_for:
+        # 找到被投票角色的索引，支持模糊匹配
+        for i, char in enumerate(game_state['characters']):
+            if i not in game_state['eliminated']:
+                if char['name'] == voted_for or voted_for in char['name'] or char['name'] in voted_for:
+                    return i, char['name'], matched_by  # 使用标准名称
+    return None, voted_for, matched_by
+
+def apply_ai_votes(session_id, game_state, vote_results):
+    """统计AI投票结果，在 game_state 上淘汰得票最多的角色并推进轮次（调用方持有游戏锁）
     
+    返回 (响应内容, 生成淘汰话语的参数)；所有投票都无法解析时返回 None。
+    """
     # 统计投票结果
+    round_number = game_state.get('current_round', 1)
     vote_counts = {}
     vote_details = []
+    vote_records = []  # (投票者索引, 被投票者索引, 投票原文)
     
     for vote in vote_results:
         vote_response = vote['vote_response']
         character_name = vote['character_name']
+        voted_character_index, voted_for, _ = parse_vote(vote_response, game_state)
+        
+        if voted_character_index is not None:
+            if voted_character_index not in vote_counts:
+                vote_counts[voted_character_index] = 0
+            vote_counts[voted_character_index] += 1
+            
+            vote_details.append({
+                'voter': character_name,
+                'voted_for': voted_for,
+                'voted_for_index': voted_character_index,
+                'reason': vote_response
+            })
         
-        # 增强投票解析逻辑，提高容错性
-        import re
-        voted_character_index = None
-        voted_for = None
-        
-        # 多种投票格式的解析
-        patterns = [
-            r'投票给：([^，,。！？\n]+)',
-            r'投票：([^，,。！？\n]+)', 
-            r'选择：([^，,。！？\n]+)',
-            r'我投([^，,。！？\n]+)',
-            r'投([^，,。！？\n]+)'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, vote_response)
-            if match:
-                voted_for = match.group(1).strip()
-                break
-        
-        # 如果没有找到明确的投票格式，尝试从文本中提取角色名
-        if not voted_for:
-            for i, char in enumerate(game_state['characters']):
-                if i not in game_state['eliminated'] and char['name'] in vote_response:
-                    voted_for = char['name']
-                    break
-        
-        if voted_for:
-            # 找到被投票角色的索引，支持模糊匹配
-            for i, char in enumerate(game_state['characters']):
-                if i not in game_state['eliminated']:
-                    if char['name'] == voted_for or voted_for in char['name'] or char['name'] in voted_for:
-                        voted_character_index = i
-                        voted_for = char['name']  # 使用标准名称
-                        break
-            
-            if voted_character_index is not None:
-                if voted_character_index not in vote_counts:
-                    vote_counts[voted_character_index] = 0
-                vote_counts[voted_character_index] += 1
-                
-                vote_details.append({
-                    'voter': character_name,
-                    'voted_for': voted_for,
-                    'voted_for_index': voted_character_index,
-                    'reason': vote_response
-                })
+        vote_records.append((vote.get('character_index'), voted_character_index, vote_response))
     
     # 找出得票最多的角色
     if vote_counts:
@@ -3525,12 +3602,13 @@ def process_ai_votes():
         # 淘汰角色
         game_state['eliminated'].append(eliminated_character_index)
         eliminated_character = game_state['characters'][eliminated_character_index]
+        record_votes(session_id, round_number, vote_records, 'ai', eliminated_character_index)
         
-        # 生成角色被淘汰时的话语
+        # 淘汰话语的参数（话语在释放游戏锁后生成）
         is_undercover = eliminated_character_index == game_state['undercover_index']
-        elimination_speech = generate_elimination_speech(
-            eliminated_character, 
-            is_undercover, 
+        speech_args = (
+            dict(eliminated_character),
+            is_undercover,
             {
                 'current_round': game_state.get('current_round', 1),
                 'public_word': game_state.get('public_word', ''),
@@ -3559,18 +3637,11 @@ def process_ai_votes():
             # 进入下一轮
             game_state['current_round'] += 1
         
-        # 更新数据库
-        cursor.execute('UPDATE game_sessions SET game_state = ? WHERE session_id = ?', 
-                      (json.dumps(game_state), session_id))
-        conn.commit()
-        conn.close()
-        
-        return json_response({
+        return {
             'eliminated_character': {
                 'name': eliminated_character['name'],
                 'index': eliminated_character_index,
-                'is_undercover': eliminated_character_index == game_state['undercover_index'],
-                'elimination_speech': elimination_speech
+                'is_undercover': is_undercover
             },
             'vote_details': vote_details,
             'vote_counts': vote_counts,
@@ -3578,10 +3649,11 @@ def process_ai_votes():
             'winner': winner,
             'current_round': game_state.get('current_round', 1),
             'session_id': session_id
-        })
+        }, speech_args
     else:
-        conn.close()
-        return json_response({'error': '投票解析失败'}, 400)
+        # 无法解析的投票也记录下来，便于分析投票格式
+        record_votes(session_id, round_number, vote_records, 'ai')
+        return None
 
 @app.route('/api/game/vote', methods=['POST'])
 def vote_character():
@@ -3593,66 +3665,62 @@ def vote_character():
     if not session_id:
         return json_response({'error': '游戏会话ID不能为空'}, 400)
     
-    # 获取并更新游戏状态
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
-    cursor = conn.cursor()
-    cursor.execute('SELECT game_state FROM game_sessions WHERE session_id = ?', (session_id,))
-    result = cursor.fetchone()
-    
-    if not result:
-        conn.close()
-        return json_response({'error': '游戏会话不存在'}, 404)
-    
-    game_state = json.loads(result[0])
-    
-    # 淘汰角色
-    elimination_speech = None
-    if voted_character_index not in game_state['eliminated']:
+    # 获取并更新游戏状态（持有该局游戏的锁）
+    with game_store.open(session_id, write=True) as game_state:
+        if game_state is None:
+            return json_response({'error': '游戏会话不存在'}, 404)
+        
+        # 修改状态前检查投票对象
+        if (not isinstance(voted_character_index, int) or isinstance(voted_character_index, bool)
+                or voted_character_index not in range(len(game_state['characters']))):
+            return json_response({'error': '角色索引无效'}, 400)
+        if voted_character_index in game_state['eliminated']:
+            return json_response({'error': '该角色已被淘汰'}, 400)
+        
+        # 淘汰角色
         game_state['eliminated'].append(voted_character_index)
+        record_votes(session_id, game_state.get('current_round', 1),
+                     [(None, voted_character_index, None)], 'user', voted_character_index)
         
-        # 生成角色被淘汰时的话语
+        # 淘汰话语的参数（话语在释放游戏锁后生成）
         eliminated_character = game_state['characters'][voted_character_index]
-        is_undercover = voted_character_index == game_state['undercover_index']
-        elimination_speech = generate_elimination_speech(
-            eliminated_character, 
-            is_undercover, 
+        speech_args = (
+            dict(eliminated_character),
+            voted_character_index == game_state['undercover_index'],
             {
                 'current_round': game_state.get('current_round', 1),
                 'public_word': game_state.get('public_word', ''),
                 'undercover_word': game_state.get('undercover_word', '')
             }
         )
+        
+        # 检查游戏结束条件
+        remaining_characters = [i for i in range(len(game_state['characters'])) if i not in game_state['eliminated']]
+        undercover_eliminated = game_state['undercover_index'] in game_state['eliminated']
+        
+        if undercover_eliminated:
+            game_state['game_over'] = True
+            game_state['winner'] = 'public'
+        elif len(remaining_characters) <= 2 and game_state['undercover_index'] in remaining_characters:
+            game_state['game_over'] = True
+            game_state['winner'] = 'undercover'
+        
+        result = {
+            'eliminated': list(game_state['eliminated']),
+            'game_over': game_state['game_over'],
+            'winner': game_state.get('winner'),
+            'undercover_index': game_state['undercover_index'] if game_state['game_over'] else None,
+            'eliminated_character_name': eliminated_character['name']
+        }
     
-    # 检查游戏结束条件
-    remaining_characters = [i for i in range(len(game_state['characters'])) if i not in game_state['eliminated']]
-    undercover_eliminated = game_state['undercover_index'] in game_state['eliminated']
-    
-    if undercover_eliminated:
-        game_state['game_over'] = True
-        game_state['winner'] = 'public'
-    elif len(remaining_characters) <= 2 and game_state['undercover_index'] in remaining_characters:
-        game_state['game_over'] = True
-        game_state['winner'] = 'undercover'
-    
-    # 更新游戏状态
-    cursor.execute('UPDATE game_sessions SET game_state = ? WHERE session_id = ?', 
-                   (json.dumps(game_state), session_id))
-    conn.commit()
-    conn.close()
-    
-    return json_response({
-        'eliminated': game_state['eliminated'],
-        'game_over': game_state['game_over'],
-        'winner': game_state.get('winner'),
-        'undercover_index': game_state['undercover_index'] if game_state['game_over'] else None,
-        'elimination_speech': elimination_speech,
-        'eliminated_character_name': game_state['characters'][voted_character_index]['name'] if voted_character_index < len(game_state['characters']) else None
-    })
+    # 生成角色被淘汰时的话语（不持有游戏锁）
+    result['elimination_speech'] = add_elimination_speech(session_id, voted_character_index, *speech_args)
+    return json_response(result)
 
 @app.route('/api/game/words', methods=['GET'])
 def get_game_words():
     """获取游戏词库"""
-    conn = sqlite3.connect(app.config['DATABASE_PATH'])
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM game_words ORDER BY difficulty, created_at')
     words = []
@@ -3700,7 +3768,7 @@ def add_game_word():
         if difficulty not in ['easy', 'medium', 'hard']:
             return json_response({'error': '难度必须是 easy、medium 或 hard'}, 400)
         
-        conn = sqlite3.connect(app.config['DATABASE_PATH'])
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         # 检查是否已存在相同的词汇对
@@ -3744,7 +3812,7 @@ def batch_add_words():
         if not word_pairs or not isinstance(word_pairs, list):
             return json_response({'error': '请提供词汇对列表'}, 400)
         
-        conn = sqlite3.connect(app.config['DATABASE_PATH'])
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         added_count = 0
@@ -3804,7 +3872,7 @@ def batch_add_words():
 def delete_game_word(word_id):
     """删除游戏词汇对"""
     try:
-        conn = sqlite3.connect(app.config['DATABASE_PATH'])
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         # 检查词汇对是否存在
@@ -3870,7 +3938,7 @@ def generate_word_pairs():
         
         # 调用AI API
         messages = [{'role': 'user', 'content': prompt}]
-        ai_response = call_qwen_api(messages)
+        ai_response = llm_gateway.complete(messages, label='词汇对生成')
         
         if not ai_response:
             return json_response({'error': 'AI生成失败，请稍后重试'}, 500)
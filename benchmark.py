@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ChatPersona 端到端压测脚本
+
+按场景并发请求各个接口，统计每个路由的 p50/p95/p99 延迟、吞吐量，以及服务端
+通过 Server-Timing 响应头报告的数据库耗时和上游（大模型/图像）耗时，结果写入 JSON。
+
+默认在进程内启动 DashScope 模拟服务（mock_dashscope.py）和使用临时数据库的应用，
+结果可重复、无需联网；也可以用 --target 压测已经运行的实例（需设置 SERVER_TIMING=true
+才能拿到数据库和上游耗时）。
+
+使用方法:
+    python benchmark.py                                    # 全部场景，4并发，每个并发5轮
+    python benchmark.py --concurrency 16 --iterations 20 --scenarios chat,game
+    python benchmark.py --latency lognormal:-1.2,0.5 --error-rate 0.02
+    python benchmark.py --output results.json --baseline last.json
+    python benchmark.py --target http://127.0.0.1:5001 --username admin --password admin123
+
+场景:
+    characters   GET  /api/characters
+    chat         POST /api/chat
+    chat_stream  POST /api/chat/stream（额外统计首个事件到达时间）
+    game         POST /api/game/start → describe × N → ai-vote → process-ai-votes
+    sanctuary    POST /api/sanctuary/discuss → generate-image
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+SCENARIOS = ['characters', 'chat', 'chat_stream', 'game', 'sanctuary']
+
+
+def percentile(values, p):
+    """线性插值百分位数，values 需已排序"""
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def parse_server_timing(header):
+    """解析 Server-Timing 头，返回 {名称: (毫秒, 次数)}"""
+    timings = {}
+    for item in (header or '').split(','):
+        parts = [p.strip() for p in item.split(';') if p.strip()]
+        if not parts:
+            continue
+        name, duration, count = parts[0], 0.0, 1
+        for part in parts[1:]:
+            key, _, value = part.partition('=')
+            if key == 'dur':
+                duration = float(value)
+            elif key == 'desc':
+                count = int(value.strip('"') or 1)
+        timings[name] = (duration, count)
+    return timings
+
+
+class Recorder:
+    """按路由收集请求样本（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, route, sample):
+        with self._lock:
+            self.samples.setdefault(route, []).append(sample)
+
+    def summarize(self, wall_seconds):
+        routes = {}
+        for route, samples in sorted(self.samples.items()):
+            latencies = sorted(s['latency_ms'] for s in samples)
+            ok = [s for s in samples if s['ok']]
+            summary = {
+                'count': len(samples),
+                'errors': len(samples) - len(ok),
+                'throughput_rps': round(len(samples) / wall_seconds, 2) if wall_seconds else 0,
+                'mean_ms': round(sum(latencies) / len(latencies), 2),
+                'p50_ms': round(percentile(latencies, 50), 2),
+                'p95_ms': round(percentile(latencies, 95), 2),
+                'p99_ms': round(percentile(latencies, 99), 2),
+                'max_ms': round(latencies[-1], 2)
+            }
+            for metric in ('db_ms', 'db_queries', 'upstream_ms', 'upstream_calls', 'ttfb_ms'):
+                values = sorted(s[metric] for s in ok if metric in s)
+                if values:
+                    summary[f'{metric}_mean'] = round(sum(values) / len(values), 2)
+                    summary[f'{metric}_p95'] = round(percentile(values, 95), 2)
+            routes[route] = summary
+        return routes
+
+
+class BenchmarkClient:
+    """单个并发用户：独立的会话（Cookie）和连接"""
+
+    def __init__(self, base_url, recorder, timeout):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.timeout = timeout
+        self.http = requests.Session()
+
+    def login(self, username, password):
+        response = self.http.post(f'{self.base_url}/login', json={'username': username, 'password': password},
+                                  timeout=self.timeout)
+        if response.status_code != 200 or not response.json().get('success'):
+            raise RuntimeError(f'登录失败: {response.status_code} {response.text[:200]}')
+
+    def call(self, method, path, payload=None, record=True):
+        """发送请求并记录样本，返回解析后的 JSON（失败时为 None）"""
+        started = time.perf_counter()
+        try:
+            response = self.http.request(method, f'{self.base_url}{path}', json=payload, timeout=self.timeout)
+            latency = (time.perf_counter() - started) * 1000
+            ok = response.status_code < 400
+            body = response.json() if ok else None
+        except (requests.exceptions.RequestException, ValueError) as e:
+            latency = (time.perf_counter() - started) * 1000
+            print(f'请求失败 {method} {path}: {e}')
+            response, ok, body = None, False, None
+
+        if record:
+            sample = {'latency_ms': latency, 'ok': ok}
+            if response is not None:
+                timings = parse_server_timing(response.headers.get('Server-Timing'))
+                if 'total' in timings:
+                    sample['db_ms'], sample['db_queries'] = timings.get('db', (0.0, 0))
+                    sample['upstream_ms'], sample['upstream_calls'] = timings.get('upstream', (0.0, 0))
+            self.recorder.add(f'{method} {path}', sample)
+        return body
+
+    def call_stream(self, path, payload, record=True):
+        """请求SSE接口，读完整个事件流，额外记录首个事件的到达时间"""
+        started = time.perf_counter()
+        first_event = None
+        ok = False
+        try:
+            with self.http.post(f'{self.base_url}{path}', json=payload, timeout=self.timeout,
+                                stream=True) as response:
+                ok = response.status_code < 400
+                for line in response.iter_lines():
+                    if first_event is None and line.startswith(b'event:'):
+                        first_event = time.perf_counter()
+        except requests.exceptions.RequestException as e:
+            print(f'请求失败 POST {path}: {e}')
+            ok = False
+
+        if record:
+            ended = time.perf_counter()
+            sample = {'latency_ms': (ended - started) * 1000, 'ok': ok}
+            if first_event is not None:
+                sample['ttfb_ms'] = (first_event - started) * 1000
+            self.recorder.add(f'POST {path}', sample)
+
+
+class Scenarios:
+    """各压测场景；默认每次请求使用不同的输入，避免命中响应缓存"""
+
+    def __init__(self, characters, repeat_inputs):
+        self.characters = characters
+        self.repeat_inputs = repeat_inputs
+
+    def token(self):
+        return 'bench' if self.repeat_inputs else uuid.uuid4().hex[:8]
+
+    def characters_list(self, client, record):
+        client.call('GET', '/api/characters', record=record)
+
+    def chat(self, client, record):
+        ids = [c['id'] for c in self.characters[:3]]
+        client.call('POST', '/api/chat', {
+            'character_ids': ids,
+            'message': f'大家觉得周末去哪里玩比较好？{self.token()}',
+            'session_id': f'bench-{uuid.uuid4().hex}'
+        }, record=record)
+
+    def chat_stream(self, client, record):
+        ids = [c['id'] for c in self.characters[:3]]
+        client.call_stream('/api/chat/stream', {
+            'character_ids': ids,
+            'message': f'今天的天气怎么样？{self.token()}',
+            'session_id': f'bench-{uuid.uuid4().hex}'
+        }, record=record)
+
+    def game(self, client, record):
+        token = self.token()
+        players = [{'id': c['id'], 'name': c['name'], 'personality': f"{c.get('personality') or '开朗'}{token}"}
+                   for c in self.characters[:4]]
+        started = client.call('POST', '/api/game/start', {'characters': players}, record=record)
+        if not started:
+            return
+        session_id = started['session_id']
+        for index in range(len(players)):
+            client.call('POST', '/api/game/describe', {'session_id': session_id, 'character_index': index},
+                        record=record)
+        voted = client.call('POST', '/api/game/ai-vote', {'session_id': session_id}, record=record)
+        if voted:
+            client.call('POST', '/api/game/process-ai-votes',
+                        {'session_id': session_id, 'vote_results': voted.get('vote_results', [])}, record=record)
+
+    def sanctuary(self, client, record):
+        ids = [c['id'] for c in self.characters[:3]]
+        session_id = f'bench-{uuid.uuid4().hex}'
+        emotion = f'最近工作压力有点大，晚上睡不好。{self.token()}'
+        discussed = client.call('POST', '/api/sanctuary/discuss', {
+            'character_ids': ids,
+            'emotion': emotion,
+            'session_id': session_id,
+            'round': 0
+        }, record=record)
+        history = [{'sender': '我', 'message': emotion}]
+        for reply in (discussed or {}).get('responses', []):
+            if isinstance(reply, dict):
+                history.append({'sender': reply.get('character_name', '角色'), 'message': reply.get('message', '')})
+        client.call('POST', '/api/sanctuary/generate-image', {
+            'emotion': emotion,
+            'chat_history': history,
+            'character_ids': ids,
+            'session_id': session_id
+        }, record=record)
+
+    def get(self, name):
+        return {
+            'characters': self.characters_list,
+            'chat': self.chat,
+            'chat_stream': self.chat_stream,
+            'game': self.game,
+            'sanctuary': self.sanctuary
+        }[name]
+
+
+def start_local_stack(args):
+    """启动模拟服务和使用临时数据库的应用，返回应用的 base URL"""
+    import mock_dashscope
+
+    _, mock_url = mock_dashscope.start_in_thread(
+        port=0,
+        latency=args.latency,
+        stream_chunk_delay=args.stream_chunk_delay,
+        error_rate=args.error_rate,
+        image_latency=args.image_latency,
+        result_format=args.format
+    )
+
+    # 配置在导入时读取环境变量，因此需在导入 app 之前设置
+    os.environ['DASHSCOPE_BASE_URL'] = mock_url
+    os.environ['SERVER_TIMING'] = 'true'
+    os.environ['IMAGE_TASK_POLL_INTERVAL'] = str(args.image_poll_interval)
+    os.environ.setdefault('FLASK_CONFIG', 'production')
+
+    from werkzeug.serving import make_server
+    from app import app, init_db
+
+    app.config['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='chatpersona-bench-'), 'bench.db')
+    init_db()
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # 不输出每个请求的访问日志
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'🧪 模拟服务: {mock_url}  应用: http://127.0.0.1:{server.server_port}')
+    print(f'   临时数据库: {app.config["DATABASE_PATH"]}')
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_with_baseline(routes, baseline_path, threshold):
+    """与基线结果比较 p95 延迟，返回退化的路由列表"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f).get('routes', {})
+
+    regressions = []
+    print(f'\n与基线 {baseline_path} 比较（p95，阈值 {threshold:.0%}）:')
+    for route, summary in routes.items():
+        old = baseline.get(route)
+        if not old or not old.get('p95_ms'):
+            print(f'  {route:<36} 无基线数据')
+            continue
+        change = summary['p95_ms'] / old['p95_ms'] - 1
+        flag = '⚠️ ' if change > threshold else '  '
+        print(f'{flag}{route:<36} {old["p95_ms"]:>9.1f} → {summary["p95_ms"]:>9.1f} ms ({change:+.1%})')
+        if change > threshold:
+            regressions.append(route)
+    return regressions
+
+
+def print_table(routes):
+    header = f'{"路由":<36}{"次数":>6}{"错误":>6}{"rps":>8}{"p50":>9}{"p95":>9}{"p99":>9}{"DB ms":>9}{"上游 ms":>10}'
+    print('\n' + header)
+    print('-' * 103)
+    for route, s in routes.items():
+        print(f'{route:<36}{s["count"]:>6}{s["errors"]:>6}{s["throughput_rps"]:>8.2f}'
+              f'{s["p50_ms"]:>9.1f}{s["p95_ms"]:>9.1f}{s["p99_ms"]:>9.1f}'
+              f'{s.get("db_ms_mean", 0):>9.1f}{s.get("upstream_ms_mean", 0):>10.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ChatPersona 端到端压测')
+    parser.add_argument('--target', default=None, help='压测已运行的实例（默认在进程内启动模拟服务和应用）')
+    parser.add_argument('--username', default='admin', help='登录用户名 (默认: admin)')
+    parser.add_argument('--password', default='admin123', help='登录密码 (默认: admin123)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='逗号分隔的场景 (默认: 全部)')
+    parser.add_argument('--concurrency', type=int, default=4, help='并发用户数 (默认: 4)')
+    parser.add_argument('--iterations', type=int, default=5, help='每个并发用户执行的轮数 (默认: 5)')
+    parser.add_argument('--warmup', type=int, default=1, help='不计入统计的预热轮数 (默认: 1)')
+    parser.add_argument('--repeat-inputs', action='store_true', help='每轮使用相同输入，用于测量缓存命中时的表现')
+    parser.add_argument('--timeout', type=float, default=120, help='单个请求超时（秒）')
+    parser.add_argument('--latency', default='lognormal:-1.5,0.4', help='模拟服务的文本生成延迟分布')
+    parser.add_argument('--stream-chunk-delay', default='fixed:0.02', help='模拟服务的流式分段延迟分布')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟服务的错误率')
+    parser.add_argument('--image-latency', default='fixed:1', help='模拟服务的图像任务完成时间分布')
+    parser.add_argument('--image-poll-interval', type=float, default=0.25, help='应用轮询图像任务的间隔（秒）')
+    parser.add_argument('--format', default='mixed', choices=['auto', 'text', 'message', 'mixed'],
+                        help='模拟服务的响应格式 (默认: mixed)')
+    parser.add_argument('--output', default=None, help='结果JSON路径 (默认: benchmark-<时间>.json)')
+    parser.add_argument('--baseline', default=None, help='基线结果JSON，用于比较p95退化')
+    parser.add_argument('--regression-threshold', type=float, default=0.2, help='p95退化阈值 (默认: 0.2)')
+    args = parser.parse_args()
+
+    scenario_names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in scenario_names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'未知场景: {", ".join(unknown)}')
+
+    base_url = args.target.rstrip('/') if args.target else start_local_stack(args)
+
+    # 准备：登录并配置 API Key（模拟服务接受任意 Key），取得可用角色
+    setup = BenchmarkClient(base_url, Recorder(), args.timeout)
+    setup.login(args.username, args.password)
+    if not args.target:
+        setup.http.post(f'{base_url}/profile', json={'email': 'bench@example.com', 'api_key': 'sk-benchmark',
+                                                     'profile_info': ''}, timeout=args.timeout)
+    characters = setup.call('GET', '/api/characters', record=False) or []
+    if len(characters) < 4:
+        print('❌ 至少需要4个可用角色')
+        sys.exit(1)
+    scenarios = Scenarios(characters, args.repeat_inputs)
+
+    recorder = Recorder()
+
+    def worker(worker_index):
+        client = BenchmarkClient(base_url, recorder, args.timeout)
+        client.login(args.username, args.password)
+        for iteration in range(args.warmup + args.iterations):
+            record = iteration >= args.warmup
+            for name in scenario_names:
+                scenarios.get(name)(client, record)
+
+    print(f'🚀 场景: {", ".join(scenario_names)}  并发: {args.concurrency}  轮数: {args.iterations}'
+          f'（预热 {args.warmup}）')
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(worker, i) for i in range(args.concurrency)]:
+            future.result()
+    wall_seconds = time.perf_counter() - started
+
+    routes = recorder.summarize(wall_seconds)
+    print_table(routes)
+    total = sum(s['count'] for s in routes.values())
+    print(f'\n总计 {total} 个请求，耗时 {wall_seconds:.1f}s，整体吞吐 {total / wall_seconds:.2f} rps')
+
+    result = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_revision': git_revision(),
+            'target': args.target or 'local-mock',
+            'scenarios': scenario_names,
+            'concurrency': args.concurrency,
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+            'repeat_inputs': args.repeat_inputs,
+            'mock': None if args.target else {
+                'latency': args.latency,
+                'stream_chunk_delay': args.stream_chunk_delay,
+                'error_rate': args.error_rate,
+                'image_latency': args.image_latency,
+                'format': args.format
+            },
+            'wall_seconds': round(wall_seconds, 3)
+        },
+        'routes': routes
+    }
+    output = args.output or f'benchmark-{time.strftime("%Y%m%d-%H%M%S")}.json'
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'📄 结果已写入 {output}')
+
+    if args.baseline:
+        regressions = compare_with_baseline(routes, args.baseline, args.regression_threshold)
+        if regressions:
+            print(f'❌ {len(regressions)} 个路由的p95超过阈值')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+群聊会话存储
+
+chat_sessions 表记录每个会话的归属用户、话题和最后活跃时间，会话列表按
+(user_id, last_message_at) 索引查询；消息按 (session_id, id) 做 keyset 分页，
+翻页成本与页码无关。
+
+长时间不活跃的会话会被批量归档：消息从 chat_history 移到 chat_history_archive，
+保持热表较小。归档后的会话仍可读取历史，继续聊天时新消息写回 chat_history。
+"""
+
+
+def touch_session(cursor, session_id, user_id, topic, added_messages=1):
+    """记录会话活动：首次出现时创建会话（归属当前用户），之后更新最后活跃时间和消息数"""
+    cursor.execute('''
+        INSERT INTO chat_sessions (session_id, user_id, topic, message_count)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (session_id) DO UPDATE SET
+            last_message_at = CURRENT_TIMESTAMP,
+            message_count = message_count + excluded.message_count
+    ''', (session_id, user_id, topic, added_messages))
+
+
+def count_messages(cursor, session_id, added_messages):
+    """在已有会话上累加消息数"""
+    cursor.execute('''
+        UPDATE chat_sessions
+        SET message_count = message_count + ?, last_message_at = CURRENT_TIMESTAMP
+        WHERE session_id = ?
+    ''', (added_messages, session_id))
+
+
+def get_session(cursor, session_id, user_id):
+    """读取属于该用户的会话，不存在或不属于该用户时返回None"""
+    cursor.execute('''
+        SELECT session_id, topic, created_at, last_message_at, message_count, archived_at
+        FROM chat_sessions WHERE session_id = ? AND user_id = ?
+    ''', (session_id, user_id))
+    row = cursor.fetchone()
+    return _session_dict(row) if row else None
+
+
+def list_sessions(cursor, user_id, limit=20, before=None):
+    """按最后活跃时间倒序列出用户的会话
+
+    before 为上一页返回的 next_cursor（"最后活跃时间|会话ID"），返回 (会话列表, next_cursor)。
+    """
+    params = [user_id]
+    keyset = ''
+    if before:
+        before_time, _, before_session = before.partition('|')
+        keyset = 'AND (last_message_at, session_id) < (?, ?)'
+        params += [before_time, before_session]
+
+    cursor.execute(f'''
+        SELECT session_id, topic, created_at, last_message_at, message_count, archived_at
+        FROM chat_sessions
+        WHERE user_id = ? {keyset}
+        ORDER BY last_message_at DESC, session_id DESC
+        LIMIT ?
+    ''', (*params, limit + 1))
+    rows = cursor.fetchall()
+
+    sessions = [_session_dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = sessions[-1]
+        next_cursor = f"{last['last_message_at']}|{last['session_id']}"
+    return sessions, next_cursor
+
+
+def list_messages(cursor, session, limit=50, before_id=None):
+    """按消息ID倒序取一页消息，返回 (按时间正序的消息列表, next_before_id)"""
+    before_id = before_id or (1 << 62)
+    columns = 'h.id, h.character_id, h.sender, h.message, h.timestamp, c.name'
+    if session['archived']:
+        # 归档过的会话，历史可能同时分布在归档表和热表中
+        cursor.execute(f'''
+            SELECT {columns} FROM (
+                SELECT id, session_id, character_id, message, sender, timestamp FROM chat_history
+                WHERE session_id = ? AND id < ?
+                UNION ALL
+                SELECT id, session_id, character_id, message, sender, timestamp FROM chat_history_archive
+                WHERE session_id = ? AND id < ?
+            ) h
+            LEFT JOIN characters c ON c.id = h.character_id
+            ORDER BY h.id DESC
+            LIMIT ?
+        ''', (session['session_id'], before_id, session['session_id'], before_id, limit + 1))
+    else:
+        cursor.execute(f'''
+            SELECT {columns} FROM chat_history h
+            LEFT JOIN characters c ON c.id = h.character_id
+            WHERE h.session_id = ? AND h.id < ?
+            ORDER BY h.id DESC
+            LIMIT ?
+        ''', (session['session_id'], before_id, limit + 1))
+    rows = cursor.fetchall()
+
+    messages = [{
+        'id': row[0],
+        'character_id': row[1],
+        'character_name': row[5] if row[1] else None,
+        'sender': row[2],
+        'message': row[3],
+        'timestamp': row[4]
+    } for row in rows[:limit]]
+    next_before_id = messages[-1]['id'] if len(rows) > limit else None
+    messages.reverse()
+    return messages, next_before_id
+
+
+def archive_sessions(conn, max_age_days, batch_size=200):
+    """把超过 max_age_days 天未活跃的会话的消息批量移入归档表，返回归档的会话数
+
+    每批会话在一个短事务中完成复制、删除和标记，避免长时间持有写锁。
+    """
+    cursor = conn.cursor()
+    archived = 0
+    while True:
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute('''
+                SELECT session_id FROM chat_sessions
+                WHERE last_message_at < datetime('now', ?)
+                  AND (archived_at IS NULL OR archived_at < last_message_at)
+                LIMIT ?
+            ''', (f'-{int(max_age_days)} days', batch_size))
+            session_ids = [row[0] for row in cursor.fetchall()]
+            if not session_ids:
+                conn.commit()
+                return archived
+
+            placeholders = ','.join('?' * len(session_ids))
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO chat_history_archive (id, session_id, character_id, message, sender, timestamp)
+                SELECT id, session_id, character_id, message, sender, timestamp
+                FROM chat_history WHERE session_id IN ({placeholders})
+            ''', session_ids)
+            cursor.execute(f'DELETE FROM chat_history WHERE session_id IN ({placeholders})', session_ids)
+            cursor.execute(f'''
+                UPDATE chat_sessions SET archived_at = CURRENT_TIMESTAMP
+                WHERE session_id IN ({placeholders})
+            ''', session_ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        archived += len(session_ids)
+        if len(session_ids) < batch_size:
+            return archived
+
+
+def delete_user_sessions(cursor, user_id):
+    """删除用户的全部会话及其消息（热表、归档表和摘要）"""
+    owned = 'SELECT session_id FROM chat_sessions WHERE user_id = ?'
+    cursor.execute(f'DELETE FROM chat_history WHERE session_id IN ({owned})', (user_id,))
+    cursor.execute(f'DELETE FROM chat_history_archive WHERE session_id IN ({owned})', (user_id,))
+    cursor.execute(f'DELETE FROM chat_summaries WHERE session_id IN ({owned})', (user_id,))
+    cursor.execute('DELETE FROM chat_sessions WHERE user_id = ?', (user_id,))
+
+
+def _session_dict(row):
+    return {
+        'session_id': row[0],
+        'topic': row[1],
+        'created_at': row[2],
+        'last_message_at': row[3],
+        'message_count': row[4],
+        'archived': row[5] is not None
+    }
@@ -9,10 +9,20 @@ class Config:
     
     # 数据库配置
     DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chatpersona.db')
+    DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))  # 等待数据库锁的最长时间（毫秒）
+    DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))  # 每个连接的页缓存大小（KB）
+    DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))  # 内存映射读取的最大字节数
     
     # 阿里云百炼API配置
     QWEN_API_KEY = os.environ.get('QWEN_API_KEY') or 'sk-8963ec64f16a4bd8a9a91221d6049f20'  # 用户提供的API Key
-    QWEN_API_URL = 'https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation'
+    # 接口地址可通过环境变量覆盖，例如指向本地模拟服务：DASHSCOPE_BASE_URL=http://127.0.0.1:8090
+    DASHSCOPE_BASE_URL = (os.environ.get('DASHSCOPE_BASE_URL') or 'https://dashscope.aliyuncs.com').rstrip('/')
+    QWEN_API_URL = os.environ.get('QWEN_API_URL') or \
+        f'{DASHSCOPE_BASE_URL}/api/v1/services/aigc/text-generation/generation'
+    IMAGE_SYNTHESIS_URL = os.environ.get('IMAGE_SYNTHESIS_URL') or \
+        f'{DASHSCOPE_BASE_URL}/api/v1/services/aigc/text2image/image-synthesis'
+    TASK_QUERY_URL = os.environ.get('TASK_QUERY_URL') or f'{DASHSCOPE_BASE_URL}/api/v1/tasks/{{task_id}}'
+    IMAGE_TASK_POLL_INTERVAL = float(os.environ.get('IMAGE_TASK_POLL_INTERVAL', 2))  # 图像任务轮询间隔（秒）
     DEFAULT_MODEL = 'qwen-plus'
     
     # 安全检测模型配置
@@ -39,6 +49,46 @@ class Config:
     MAX_CHAT_HISTORY = 100  # 最大聊天历史记录数
     MAX_CHARACTERS_PER_CHAT = 10  # 单次聊天最大角色数
     
+    # 并发配置
+    CHAT_MAX_CONCURRENCY_PER_REQUEST = int(os.environ.get('CHAT_MAX_CONCURRENCY_PER_REQUEST', 5))  # 单次请求内同时生成回复的角色数
+    CHAT_STREAM_IDLE_TIMEOUT = float(os.environ.get('CHAT_STREAM_IDLE_TIMEOUT', 180))  # 流式聊天超过该秒数没有任何事件时，剩余角色使用备用回复
+    LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 32))  # 进程内LLM调用最大并发数
+    HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 32))  # 每个上游地址保持的keep-alive连接数
+    
+    # 登录用户缓存配置（默认为0：不跨请求缓存，每个请求仍只查询一次）
+    # 缓存只在本进程内失效，开启后其他 worker 中被禁用或降级的用户在有效期内仍保留原权限
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 0))  # 缓存有效期（秒）
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1000))  # 最多缓存的用户数
+    
+    # 角色列表缓存配置：按用户缓存序列化后的 /api/characters 响应，角色变更时失效
+    CHARACTERS_CACHE_TTL = float(os.environ.get('CHARACTERS_CACHE_TTL', 300))  # 缓存有效期（秒）；角色变更通过数据库中的版本号立即对所有进程生效
+    CHARACTERS_CACHE_SIZE = int(os.environ.get('CHARACTERS_CACHE_SIZE', 1000))  # 最多缓存的用户数
+    
+    # 对话上下文配置：摘要之后的历史消息按 token 预算裁剪，较早的消息合并为滚动摘要
+    CHAT_CONTEXT_TOKEN_BUDGET = int(os.environ.get('CHAT_CONTEXT_TOKEN_BUDGET', 1500))  # 每次调用的输入token上限（估算值）
+    CHAT_CONTEXT_MAX_MESSAGES = int(os.environ.get('CHAT_CONTEXT_MAX_MESSAGES', 10))  # 最近多少条消息保持原文、不并入摘要
+    CHAT_SUMMARY_BATCH_SIZE = int(os.environ.get('CHAT_SUMMARY_BATCH_SIZE', 10))  # 最近消息之前累计多少条未摘要消息后更新摘要（有消息因预算被裁掉时立即更新）
+    CHAT_SUMMARY_MAX_CHARS = int(os.environ.get('CHAT_SUMMARY_MAX_CHARS', 300))  # 摘要的目标长度（字）
+    
+    # 群聊会话归档配置：超过天数未活跃的会话消息移入归档表（为0时不归档）
+    CHAT_ARCHIVE_AFTER_DAYS = int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', 30))
+    CHAT_ARCHIVE_INTERVAL = int(os.environ.get('CHAT_ARCHIVE_INTERVAL', 3600))  # 自动归档的最短间隔（秒）
+    CHAT_ARCHIVE_BATCH_SIZE = int(os.environ.get('CHAT_ARCHIVE_BATCH_SIZE', 200))  # 每个事务归档的会话数
+    
+    # 用户统计批量写入配置（间隔为0时每次直接写库）
+    USER_STATS_FLUSH_INTERVAL = float(os.environ.get('USER_STATS_FLUSH_INTERVAL', 5))  # 最长写入间隔（秒）
+    USER_STATS_FLUSH_THRESHOLD = int(os.environ.get('USER_STATS_FLUSH_THRESHOLD', 200))  # 累计多少次计数后立即写入
+    
+    # 游戏状态配置：默认每次直接读写数据库；间隔大于0时游戏常驻内存并定时写回，只能用于单进程部署
+    GAME_STATE_FLUSH_INTERVAL = float(os.environ.get('GAME_STATE_FLUSH_INTERVAL', 0))  # 最长写入间隔（秒），也是进程崩溃时最多丢失的进度
+    GAME_STATE_IDLE_TTL = int(os.environ.get('GAME_STATE_IDLE_TTL', 1800))  # 多久未访问的游戏移出内存（秒）
+    
+    # 压测配置：在响应头 Server-Timing 中输出每个请求的数据库和上游调用耗时
+    SERVER_TIMING = os.environ.get('SERVER_TIMING', 'False').lower() == 'true'
+    
+    # 共享缓存配置（多 worker 部署时设置为同一路径，留空则只使用进程内缓存）
+    SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH')
+    
     # 风险控制配置
     TOPIC_SIMILARITY_THRESHOLD = 0.6  # 话题相似度阈值
     PERSONA_CONSISTENCY_THRESHOLD = 0.7  # 人格一致性阈值
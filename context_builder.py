@@ -0,0 +1,166 @@
+"""
+对话上下文构建
+
+- estimate_tokens：按字符粗略估算 token 数（中日韩字符约 1 token/字，其余约 4 字符/token）
+- fit_messages：始终保留 system 消息和当前消息，从最新的历史开始往前加入，直到超出 token 预算
+- ConversationSummarizer：把较早的对话增量合并进每个 session_id 的滚动摘要，
+  摘要保存在 chat_summaries 表中，并在后台线程中更新，不增加聊天请求的延迟。
+  尚未并入摘要的消息都放进上下文（只受 token 预算限制）；有消息因预算被裁掉时立即更新摘要，
+  保证每条消息要么在上下文中，要么已经在摘要里
+"""
+
+import math
+import re
+import threading
+
+CJK_PATTERN = re.compile('[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的角色标记等固定开销
+
+
+def estimate_tokens(text):
+    """粗略估算文本的 token 数"""
+    if not text:
+        return 0
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def message_tokens(message):
+    return estimate_tokens(message.get('content', '')) + MESSAGE_OVERHEAD_TOKENS
+
+
+def max_fitting_messages(budget):
+    """token 预算内最多能放下的消息条数（每条至少占 MESSAGE_OVERHEAD_TOKENS），用作查询历史的上限"""
+    return max(1, budget // MESSAGE_OVERHEAD_TOKENS)
+
+
+def fit_messages(system_message, history, current_message=None, budget=1500):
+    """在 token 预算内组装消息列表，返回 (消息列表, 被丢弃的历史条数)
+
+    system_message 和 current_message 总是保留；history 按时间正序传入，优先保留最新的部分。
+    """
+    used = message_tokens(system_message)
+    if current_message:
+        used += message_tokens(current_message)
+
+    kept = []
+    for message in reversed(history):
+        cost = message_tokens(message)
+        if used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+
+    messages = [system_message] + kept
+    if current_message:
+        messages.append(current_message)
+    return messages, len(history) - len(kept)
+
+
+class ConversationSummarizer:
+    """按 session_id 维护滚动摘要"""
+
+    def __init__(self, get_connection, complete, submit, batch_size=10, max_chars=300):
+        self.get_connection = get_connection
+        self.complete = complete  # (messages, api_key) -> 文本或None
+        self.submit = submit  # 在后台执行无参任务
+        self.batch_size = batch_size
+        self.max_chars = max_chars
+        self._lock = threading.Lock()
+        self._running = set()
+
+    @staticmethod
+    def load(cursor, session_id):
+        """返回 (摘要文本, 已摘要到的 chat_history.id)，没有摘要时为 ('', 0)"""
+        cursor.execute('SELECT summary, summarized_until_id FROM chat_summaries WHERE session_id = ?',
+                       (session_id,))
+        result = cursor.fetchone()
+        return (result[0], result[1]) if result else ('', 0)
+
+    def maybe_refresh(self, cursor, session_id, summarized_until_id, keep_recent, api_key, force=False):
+        """最近 keep_recent 条之前的未摘要消息达到 batch_size 条时，在后台更新摘要
+
+        force=True（有消息因 token 预算没有放进上下文）时，只要有这样的消息就立即更新。
+        """
+        cursor.execute('SELECT COUNT(*) FROM chat_history WHERE session_id = ? AND id > ?',
+                       (session_id, summarized_until_id))
+        pending = cursor.fetchone()[0] - keep_recent
+        if pending < (1 if force else self.batch_size):
+            return False
+
+        with self._lock:
+            if session_id in self._running:
+                return False
+            self._running.add(session_id)
+        self.submit(lambda: self._refresh(session_id, keep_recent, api_key, 1 if force else self.batch_size))
+        return True
+
+    def _refresh(self, session_id, keep_recent, api_key, min_rows):
+        try:
+            conn = self.get_connection()
+            try:
+                cursor = conn.cursor()
+                summary, summarized_until_id = self.load(cursor, session_id)
+                cursor.execute('''
+                    SELECT h.id, h.message, h.sender, c.name
+                    FROM chat_history h
+                    LEFT JOIN characters c ON c.id = h.character_id
+                    WHERE h.session_id = ? AND h.id > ?
+                    ORDER BY h.id
+                ''', (session_id, summarized_until_id))
+                rows = cursor.fetchall()
+            finally:
+                conn.close()
+
+            rows = rows[:len(rows) - keep_recent] if keep_recent else rows
+            if len(rows) < min_rows:
+                return
+
+            new_summary = self.complete(self._summary_messages(summary, rows), api_key)
+            if not new_summary:
+                return
+            new_summary = new_summary.strip()[:self.max_chars * 2]
+            self._save(session_id, summarized_until_id, new_summary, rows[-1][0])
+        except Exception as e:
+            print(f"更新对话摘要失败 {session_id}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(session_id)
+
+    def _summary_messages(self, summary, rows):
+        lines = []
+        for _, message, sender, char_name in rows:
+            speaker = '用户' if sender == 'user' else (char_name or sender or '其他角色')
+            lines.append(f"{speaker}：{message}")
+        return [
+            {'role': 'system', 'content': '你是一名对话记录员，负责把多角色群聊压缩成简洁的摘要。'},
+            {'role': 'user', 'content': f"""已有摘要：
+{summary or '（无）'}
+
+新增对话：
+{chr(10).join(lines)}
+
+请把新增对话合并进已有摘要，保留讨论的话题、用户透露的重要信息、各角色的主要观点和尚未结束的问题。
+摘要不超过{self.max_chars}字，只输出摘要本身。"""}
+        ]
+
+    def _save(self, session_id, old_until_id, summary, until_id):
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            if old_until_id:
+                # 只在摘要没有被其他进程更新过时写入
+                cursor.execute('''
+                    UPDATE chat_summaries
+                    SET summary = ?, summarized_until_id = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE session_id = ? AND summarized_until_id = ?
+                ''', (summary, until_id, session_id, old_until_id))
+            else:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO chat_summaries (session_id, summary, summarized_until_id)
+                    VALUES (?, ?, ?)
+                ''', (session_id, summary, until_id))
+            conn.commit()
+        finally:
+            conn.close()
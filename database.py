@@ -0,0 +1,244 @@
+"""
+SQLite 连接管理
+
+每个线程为每个数据库文件保持一个长期存活的连接，请求内的所有 helper 和路由共用它，
+不再为每次查询重新打开数据库。连接打开时设置：
+- journal_mode=WAL：读写互不阻塞
+- synchronous=NORMAL：WAL 模式下安全且写入更快
+- cache_size / mmap_size：加大页缓存并使用内存映射读取
+- busy_timeout：由本模块在 Python 层实现，以便统计锁等待次数和时长
+
+调用方沿用原有写法：get_db_connection() 取得连接，用完 conn.close()。close() 只是
+归还连接；最外层归还时如果还有未提交的事务则回滚，与关闭连接时的行为一致。
+
+同一线程里嵌套调用 get_db_connection() 时，内层拿到的是同一个连接，但处在一个
+SAVEPOINT 中：内层的 commit() 只释放自己的保存点，rollback() 和未提交就 close()
+只撤销保存点之后的修改，外层事务由最外层调用方提交或回滚。需要自己管理事务
+（BEGIN IMMEDIATE、分批提交）的代码，如数据库初始化和迁移，使用 open_dedicated()
+打开的独立连接。
+"""
+
+import sqlite3
+import threading
+import time
+
+import request_timing
+
+BUSY_MESSAGES = ('database is locked', 'database is busy', 'database table is locked')
+
+
+def is_busy_error(error):
+    return isinstance(error, sqlite3.OperationalError) and any(msg in str(error) for msg in BUSY_MESSAGES)
+
+
+class DatabaseStats:
+    """连接与锁等待计数（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connection_opens = 0
+        self.open_seconds = 0.0
+        self.acquires = 0
+        self.reuses = 0
+        self.rollbacks = 0
+        self.lock_waits = 0
+        self.lock_wait_seconds = 0.0
+        self.lock_timeouts = 0
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'connection_opens': self.connection_opens,
+                'open_ms_total': round(self.open_seconds * 1000, 2),
+                'acquires': self.acquires,
+                'reuses': self.reuses,
+                'rollbacks': self.rollbacks,
+                'lock_waits': self.lock_waits,
+                'lock_wait_ms_total': round(self.lock_wait_seconds * 1000, 2),
+                'lock_timeouts': self.lock_timeouts
+            }
+
+
+class ManagedCursor(request_timing.TimedCursor):
+    """遇到数据库锁时按 busy_timeout 等待重试的游标"""
+
+    def execute(self, *args, **kwargs):
+        return self.connection.retry_busy(super().execute, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self.connection.retry_busy(super().executemany, *args, **kwargs)
+
+
+class ManagedConnection(request_timing.TimedConnection):
+    """由 ConnectionManager 持有的持久连接，close() 只归还不关闭"""
+
+    manager = None
+    depth = 0  # 当前线程中尚未归还的 get_db_connection() 次数
+    dedicated = False  # open_dedicated() 打开的独立连接，close() 时真正关闭
+
+    def cursor(self, factory=ManagedCursor):
+        return super().cursor(factory)
+
+    def _savepoint(self):
+        return f'nested_{self.depth}'
+
+    def begin_nested(self):
+        """嵌套取得连接时调用：为内层调用方开启一个保存点"""
+        self.depth += 1
+        self.execute(f'SAVEPOINT {self._savepoint()}')
+
+    def commit(self):
+        if self.depth > 1:
+            # 内层提交：并入外层事务，并为后续修改重新开启保存点
+            name = self._savepoint()
+            if self.in_transaction:
+                self.execute(f'RELEASE {name}')
+            self.execute(f'SAVEPOINT {name}')
+            return None
+        return self.retry_busy(super().commit)
+
+    def rollback(self):
+        if self.depth > 1:
+            # 内层回滚：只撤销保存点之后的修改，保存点保留
+            if self.in_transaction:
+                self.execute(f'ROLLBACK TO {self._savepoint()}')
+            return None
+        return super().rollback()
+
+    def close(self):
+        if self.dedicated:
+            sqlite3.Connection.close(self)
+            return
+        if self.depth > 1:
+            # 内层归还：撤销未提交的修改并释放保存点
+            name = self._savepoint()
+            if self.in_transaction:
+                self.execute(f'ROLLBACK TO {name}')
+                self.execute(f'RELEASE {name}')
+            self.depth -= 1
+            return
+        self.depth = max(0, self.depth - 1)
+        if self.depth == 0:
+            self.reset()
+
+    def reset(self):
+        """丢弃未提交的事务，让连接回到可复用的干净状态"""
+        self.depth = 0
+        if self.in_transaction:
+            super().rollback()
+            self.manager.stats.incr('rollbacks')
+
+    def retry_busy(self, operation, *args, **kwargs):
+        """执行操作，数据库被锁时退避重试，直到超过 busy_timeout
+
+        只在事务开始时重试：执行前连接不在事务中（包括 BEGIN IMMEDIATE 和自动开启事务的
+        第一条写语句）。已经在事务中时遇到锁，说明要把读事务升级为写事务而其他连接已经
+        或即将写入，读到的快照会过期（SQLITE_BUSY_SNAPSHOT），重试不会成功，直接抛出，
+        由调用方回滚后重新执行。
+        """
+        retryable = not self.in_transaction
+        started = None
+        delay = 0.001
+        try:
+            while True:
+                try:
+                    return operation(*args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    if not is_busy_error(e) or not retryable:
+                        raise
+                    if self.in_transaction:
+                        # 自动开启的事务中还没有执行成功的语句，回滚后重新开始
+                        sqlite3.Connection.rollback(self)
+                    now = time.perf_counter()
+                    if started is None:
+                        started = now
+                        self.manager.stats.incr('lock_waits')
+                    remaining = self.manager.busy_timeout - (now - started)
+                    if remaining <= 0:
+                        self.manager.stats.incr('lock_timeouts')
+                        raise
+                    time.sleep(min(delay, remaining))
+                    delay = min(delay * 2, 0.05)
+        finally:
+            if started is not None:
+                waited = time.perf_counter() - started
+                self.manager.stats.incr('lock_wait_seconds', waited)
+                request_timing.record('db_lock_wait', waited)
+
+
+class ConnectionManager:
+    """按线程和数据库路径复用 SQLite 连接"""
+
+    def __init__(self, config):
+        self.config = config
+        self.stats = DatabaseStats()
+        self._local = threading.local()
+
+    @property
+    def busy_timeout(self):
+        return self.config['DB_BUSY_TIMEOUT_MS'] / 1000
+
+    def _connections(self):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        return connections
+
+    def _open(self, path):
+        started = time.perf_counter()
+        with request_timing.timed('db'):
+            # timeout=0：锁等待由 ManagedConnection.retry_busy 负责，便于统计
+            conn = sqlite3.connect(path, timeout=0, factory=ManagedConnection)
+            conn.manager = self
+            pragmas = [
+                'PRAGMA synchronous=NORMAL',
+                f"PRAGMA cache_size=-{int(self.config['DB_CACHE_SIZE_KB'])}",
+                f"PRAGMA mmap_size={int(self.config['DB_MMAP_SIZE'])}",
+                'PRAGMA temp_store=MEMORY'
+            ]
+            if path != ':memory:':
+                pragmas.insert(0, 'PRAGMA journal_mode=WAL')
+            for pragma in pragmas:
+                conn.execute(pragma).fetchall()
+        self.stats.incr('connection_opens')
+        self.stats.incr('open_seconds', time.perf_counter() - started)
+        return conn
+
+    def acquire(self):
+        """取得当前线程的连接，首次使用时打开"""
+        path = self.config['DATABASE_PATH']
+        connections = self._connections()
+        conn = connections.get(path)
+        if conn is None:
+            conn = connections[path] = self._open(path)
+        else:
+            self.stats.incr('reuses')
+        self.stats.incr('acquires')
+        if conn.depth > 0:
+            conn.begin_nested()
+        else:
+            conn.depth = 1
+        return conn
+
+    def open_dedicated(self):
+        """打开一个不与线程共享的独立连接，close() 时真正关闭"""
+        conn = self._open(self.config['DATABASE_PATH'])
+        conn.dedicated = True
+        conn.depth = 1
+        return conn
+
+    def release(self):
+        """请求结束时调用：回滚当前线程中遗留的未提交事务"""
+        for conn in self._connections().values():
+            conn.reset()
+
+    def close_thread(self):
+        """真正关闭当前线程的所有连接"""
+        connections = self._connections()
+        for conn in connections.values():
+            sqlite3.Connection.close(conn)
+        connections.clear()
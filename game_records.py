@@ -0,0 +1,72 @@
+"""
+谁是卧底对局明细
+
+每局游戏的玩家、每轮描述和每张投票分别存放在 game_players、game_descriptions、
+game_votes 三张表中，按 (session_id, round) 建索引。描述和投票只追加不修改，
+每次写入的大小与对局进行到第几轮无关；game_sessions.game_state 中只保留当前轮次、
+淘汰名单和胜负等核心状态的快照。
+
+同一角色在同一轮重新生成描述时追加新行，读取时以最新的一条为准。
+"""
+
+
+def insert_players(cursor, session_id, characters, undercover_index):
+    """记录本局的玩家（开局时写入一次）"""
+    cursor.executemany('''
+        INSERT INTO game_players (session_id, player_index, character_id, character_name, is_undercover)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [
+        (session_id, index, character.get('id'), character.get('name'), index == undercover_index)
+        for index, character in enumerate(characters)
+    ])
+
+
+def add_descriptions(cursor, session_id, round_number, descriptions):
+    """追加一轮中若干角色的描述，descriptions 为 {角色索引: 描述}"""
+    cursor.executemany('''
+        INSERT INTO game_descriptions (session_id, round, player_index, description)
+        VALUES (?, ?, ?, ?)
+    ''', [(session_id, round_number, index, text) for index, text in descriptions.items()])
+
+
+def load_descriptions(cursor, game_state, session_id, up_to_round):
+    """读取第 1 到 up_to_round 轮的描述
+
+    返回按轮次排列的列表，每轮是按角色索引排列的描述信息（未发言的位置为None），
+    格式与原来 game_state['descriptions'] 相同。
+    """
+    characters = game_state['characters']
+    undercover_index = game_state['undercover_index']
+    rounds = [[None] * len(characters) for _ in range(up_to_round)]
+    cursor.execute('''
+        SELECT round, player_index, description FROM game_descriptions
+        WHERE session_id = ? AND round BETWEEN 1 AND ?
+        ORDER BY id
+    ''', (session_id, up_to_round))
+    for round_number, index, text in cursor.fetchall():
+        if index < len(characters):
+            rounds[round_number - 1][index] = {
+                'character_name': characters[index]['name'],
+                'description': text,
+                'is_undercover': index == undercover_index
+            }
+    return rounds
+
+
+def add_votes(cursor, session_id, round_number, votes, source):
+    """追加一轮的投票，votes 为 (投票者索引, 被投票者索引, 投票原文) 列表
+
+    用户投票的投票者索引为None；无法解析出投票对象时被投票者索引为None。
+    """
+    cursor.executemany('''
+        INSERT INTO game_votes (session_id, round, voter_index, target_index, vote_text, source)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(session_id, round_number, voter, target, text, source) for voter, target, text in votes])
+
+
+def mark_eliminated(cursor, session_id, player_index, round_number):
+    """记录玩家在第几轮被淘汰（每个玩家最多一次）"""
+    cursor.execute('''
+        UPDATE game_players SET eliminated_round = ?
+        WHERE session_id = ? AND player_index = ? AND eliminated_round IS NULL
+    ''', (round_number, session_id, player_index))
@@ -0,0 +1,286 @@
+"""
+谁是卧底游戏状态存储
+
+flush_interval 为 0 时（应用默认）每次访问都在按局加的锁内从 game_sessions 读取状态，
+修改后立即写回，多进程部署也能看到最新状态。写入时读取、修改和写回在同一个
+BEGIN IMMEDIATE 事务中完成，代码块内通过 get_connection() 写入的其他数据（如投票记录）
+作为嵌套连接并入这个事务，与状态快照一起提交；写入失败或代码块抛出异常时全部回滚，
+异常继续抛给调用方。
+
+flush_interval 大于 0 时启用写缓冲：进行中的游戏以解析后的字典常驻内存（结构与
+game_sessions.game_state 中的 JSON 相同），修改只标记为脏，由后台线程每 flush_interval 秒
+把有变化的游戏以紧凑 JSON 快照批量写回，游戏步骤不再每次都解析和序列化整局状态。
+内存中的状态只对本进程可见，只能在单进程部署（如 gunicorn --workers 1）中启用；
+进程崩溃时最多丢失最后一个写入间隔内的进度，重启后游戏从最近的快照恢复。
+这种模式下代码块内写入的其他数据各自立即提交，不与延后写回的快照同属一个事务。
+"""
+
+import atexit
+import copy
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class LiveGame:
+    """内存中的一局游戏"""
+
+    __slots__ = ('session_id', 'state', 'lock', 'dirty', 'last_access')
+
+    def __init__(self, session_id, state):
+        self.session_id = session_id
+        self.state = state
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.last_access = time.time()
+
+
+class GameStateStore:
+    """按 session_id 管理游戏状态，定时把修改过的游戏写回数据库（线程安全）"""
+
+    LOCK_STRIPES = 64  # 直接读写数据库时按 session_id 分片的锁数量
+
+    def __init__(self, get_connection, flush_interval=0, idle_ttl=1800):
+        self.get_connection = get_connection
+        self.flush_interval = flush_interval
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._games = {}
+        self._stripes = [threading.RLock() for _ in range(self.LOCK_STRIPES)]
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.loads = 0
+        self.hits = 0
+        self.flushes = 0
+        self.snapshots_written = 0
+        self.snapshot_bytes = 0
+        self.evictions = 0
+        self.failures = 0
+        atexit.register(self.flush)
+
+    @property
+    def write_behind(self):
+        return self.flush_interval > 0
+
+    @staticmethod
+    def dumps(state):
+        return json.dumps(state, ensure_ascii=False, separators=(',', ':'))
+
+    def create(self, session_id, state, max_rounds, on_insert=None):
+        """新建一局游戏：立即写入数据库（保证重启后可以恢复），并放入内存
+
+        on_insert(cursor) 在同一事务中写入与这局游戏关联的其他数据。
+        """
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO game_sessions (session_id, game_state, current_round, max_rounds)
+                VALUES (?, ?, ?, ?)
+            ''', (session_id, self.dumps(state), state.get('current_round', 1), max_rounds))
+            if on_insert:
+                on_insert(cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        if self.write_behind:
+            with self._lock:
+                self._games[session_id] = LiveGame(session_id, state)
+
+    def _load(self, session_id, conn=None):
+        own_conn = conn is None
+        if own_conn:
+            conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT game_state FROM game_sessions WHERE session_id = ?', (session_id,))
+            result = cursor.fetchone()
+        finally:
+            if own_conn:
+                conn.close()
+        with self._lock:
+            self.loads += 1
+        return LiveGame(session_id, json.loads(result[0])) if result else None
+
+    def _get(self, session_id):
+        with self._lock:
+            game = self._games.get(session_id)
+            if game is not None:
+                self.hits += 1
+                game.last_access = time.time()
+                return game
+
+        game = self._load(session_id)
+        if game is None:
+            return None
+        with self._lock:
+            # 并发加载同一局时以先放入的为准
+            return self._games.setdefault(session_id, game)
+
+    @contextmanager
+    def open(self, session_id, write=False):
+        """持有该局游戏的锁访问状态，游戏不存在时得到None
+
+        write=True 时，正常退出后保存状态：直接读写数据库时在同一事务中写回并提交，
+        写入失败时抛出异常；写缓冲模式下标记为已修改。代码块抛出异常时，直接读写
+        数据库的事务整体回滚，写缓冲模式下内存中的状态恢复为进入代码块之前的样子，
+        之前尚未写回的修改仍会照常写回。
+        """
+        if not self.write_behind:
+            # 在锁内读取、修改并写回，同一进程内同一局的请求依次处理；
+            # 写入时用 BEGIN IMMEDIATE 先拿到数据库写锁，多进程同时修改同一局也不会互相覆盖
+            with self._stripes[hash(session_id) % self.LOCK_STRIPES]:
+                conn = self.get_connection()
+                try:
+                    if write and not conn.in_transaction:
+                        conn.execute('BEGIN IMMEDIATE')
+                    game = self._load(session_id, conn)
+                    yield game.state if game is not None else None
+                    if write and game is not None:
+                        rows = [self._row(game)]
+                        try:
+                            self._update(conn.cursor(), rows)
+                            conn.commit()
+                        except Exception:
+                            with self._lock:
+                                self.failures += 1
+                            raise
+                        self._count_written(rows)
+                except BaseException:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.close()
+            return
+
+        game = self._get(session_id)
+        if game is None:
+            yield None
+            return
+
+        with game.lock:
+            backup = copy.deepcopy(game.state) if write else None
+            try:
+                yield game.state
+            except BaseException:
+                if write:
+                    # 只撤销本次代码块的修改，保留之前尚未写回的修改
+                    game.state = backup
+                raise
+            if write:
+                game.dirty = True
+                self._ensure_thread()
+
+    def snapshot(self, session_id):
+        """返回该局游戏状态的副本，供不持锁的长时间操作（如调用大模型）读取"""
+        with self.open(session_id) as state:
+            return copy.deepcopy(state) if state is not None else None
+
+    def _ensure_thread(self):
+        # fork 出的子进程不会继承父进程的线程，需要重新启动
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='game-state-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+            self._evict_idle()
+
+    def flush(self):
+        """把所有修改过的游戏快照在一个事务中写回数据库，返回写入的游戏数"""
+        with self._lock:
+            dirty = [game for game in self._games.values() if game.dirty]
+        if not dirty:
+            return 0
+        return self._write(dirty)
+
+    def _write(self, games):
+        with self._flush_lock:
+            rows = []
+            written = []
+            for game in games:
+                # 正在被请求使用的游戏（例如持锁等待大模型回复）留到下一次写入
+                if not game.lock.acquire(blocking=False):
+                    continue
+                try:
+                    rows.append(self._row(game))
+                    game.dirty = False
+                    written.append(game)
+                finally:
+                    game.lock.release()
+            if not rows:
+                return 0
+
+            conn = self.get_connection()
+            try:
+                self._update(conn.cursor(), rows)
+                conn.commit()
+            except Exception as e:
+                print(f"游戏状态写入失败，稍后重试: {e}")
+                conn.rollback()
+                for game in written:
+                    game.dirty = True
+                with self._lock:
+                    self.failures += 1
+                return 0
+            finally:
+                conn.close()
+
+            self._count_written(rows)
+            return len(rows)
+
+    def _row(self, game):
+        return self.dumps(game.state), game.state.get('current_round', 1), game.session_id
+
+    @staticmethod
+    def _update(cursor, rows):
+        cursor.executemany('''
+            UPDATE game_sessions SET game_state = ?, current_round = ?
+            WHERE session_id = ?
+        ''', rows)
+
+    def _count_written(self, rows):
+        with self._lock:
+            self.flushes += 1
+            self.snapshots_written += len(rows)
+            self.snapshot_bytes += sum(len(row[0].encode('utf-8')) for row in rows)
+
+    def _evict_idle(self):
+        """移除长时间未访问且已写回的游戏"""
+        cutoff = time.time() - self.idle_ttl
+        with self._lock:
+            idle = [session_id for session_id, game in self._games.items()
+                    if not game.dirty and game.last_access < cutoff]
+            for session_id in idle:
+                del self._games[session_id]
+            self.evictions += len(idle)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'live_games': len(self._games),
+                'dirty_games': sum(1 for game in self._games.values() if game.dirty),
+                'hits': self.hits,
+                'loads': self.loads,
+                'flushes': self.flushes,
+                'snapshots_written': self.snapshots_written,
+                'snapshot_bytes': self.snapshot_bytes,
+                'evictions': self.evictions,
+                'failures': self.failures,
+                'flush_interval': self.flush_interval
+            }
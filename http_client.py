@@ -0,0 +1,161 @@
+"""
+进程级共享的HTTP客户端
+
+所有对阿里云百炼（DashScope）的请求都通过这里发出：每个 base URL
+（scheme://host:port）对应一个长期存活的 requests.Session，复用 keep-alive
+连接，避免每次调用都重新进行 TCP 和 TLS 握手。同时按 base URL 统计请求数
+和新建连接数，用于观察连接复用情况。
+"""
+
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import request_timing
+
+DEFAULT_POOL_SIZE = 32
+
+
+class ConnectionStats:
+    """单个 base URL 的请求与连接计数（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.errors = 0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_new_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                # 没有新建连接的请求即复用了连接池中的连接
+                'reused_connections': max(0, self.requests - self.new_connections),
+                'errors': self.errors
+            }
+
+
+def _counting_pool_class(base_class, stats):
+    """生成在新建连接时计数的 urllib3 连接池类"""
+
+    class CountingConnectionPool(base_class):
+        def _new_conn(self):
+            stats.record_new_connection()
+            return super()._new_conn()
+
+    return CountingConnectionPool
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """在 urllib3 连接池上统计新建连接数的适配器"""
+
+    def __init__(self, stats, **kwargs):
+        # HTTPAdapter.__init__ 会调用 init_poolmanager，需先设置 stats
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool_class(HTTPConnectionPool, self._stats),
+            'https': _counting_pool_class(HTTPSConnectionPool, self._stats)
+        }
+
+
+class HTTPClient:
+    """按 base URL 复用 Session 的线程安全HTTP客户端"""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE):
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._stats = {}
+
+    @staticmethod
+    def base_url(url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _session_for(self, url):
+        base_url = self.base_url(url)
+        session = self._sessions.get(base_url)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(base_url)
+                if session is None:
+                    stats = ConnectionStats()
+                    adapter = CountingHTTPAdapter(
+                        stats,
+                        pool_connections=1,
+                        pool_maxsize=self.pool_size,
+                        max_retries=0  # 重试由调用方的重试策略负责
+                    )
+                    session = requests.Session()
+                    session.mount(base_url + '/', adapter)
+                    self._stats[base_url] = stats
+                    self._sessions[base_url] = session
+        return session, self._stats[base_url]
+
+    def request(self, method, url, **kwargs):
+        session, stats = self._session_for(url)
+        stats.record_request()
+        started = time.perf_counter()
+        try:
+            return session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            stats.record_error()
+            raise
+        finally:
+            # 流式响应此时只收到响应头，完整耗时由读取方记录
+            if not kwargs.get('stream'):
+                request_timing.record('upstream', time.perf_counter() - started)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """返回 {base_url: 计数字典}"""
+        with self._lock:
+            items = list(self._stats.items())
+        return {base_url: stats.snapshot() for base_url, stats in items}
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._stats.clear()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client(pool_size=None):
+    """获取进程级共享客户端，首次调用时按 pool_size 创建"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HTTPClient(pool_size or DEFAULT_POOL_SIZE)
+    return _client
@@ -0,0 +1,418 @@
+"""
+大模型调用网关
+
+所有对阿里云百炼文本生成接口的调用都经过 LLMGateway。网关本身只负责
+组织调用流程，缓存、重试、超时、回复清理和指标统计都是可替换的策略对象：
+
+    gateway = LLMGateway(app.config, get_http_client,
+                         cache=ResponseCachePolicy(api_cache),
+                         retry=RetryPolicy(),
+                         timeout=TimeoutPolicy(app.config),
+                         cleaner=ResponseCleaner(),
+                         metrics=GatewayMetrics(),
+                         single_flight=SingleFlight())
+    text = gateway.complete(messages, api_key, retries=3, retry_delay=0.5)
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+import request_timing
+
+# 不同类型请求的缓存时间配置（秒）
+CACHE_DURATIONS = {
+    'character_generation': 1800,    # 角色生成：30分钟
+    'chat_response': 900,           # 聊天回复：15分钟
+    'game_content': 1800,           # 游戏内容：30分钟
+    'security_check': 7200,         # 安全检测：2小时
+    'system_prompt': 3600,          # 系统提示：1小时
+    'default': 900                  # 默认：15分钟
+}
+
+# 缓存大小限制
+CACHE_LIMITS = {
+    'api_cache': 500,              # API缓存：500条
+    'security_cache': 1000,        # 安全缓存：1000条
+}
+
+# 缓存字节数限制（按键和值的UTF-8长度估算）
+CACHE_BYTE_LIMITS = {
+    'api_cache': 8 * 1024 * 1024,       # API缓存：8MB
+    'security_cache': 1024 * 1024,      # 安全缓存：1MB
+}
+
+
+def get_cache_type_and_duration(messages, context_hint=None):
+    """根据消息内容和上下文提示确定缓存类型和时间"""
+    if context_hint:
+        # 如果有明确的上下文提示，直接使用
+        return context_hint, CACHE_DURATIONS.get(context_hint, CACHE_DURATIONS['default'])
+
+    # 分析消息内容确定缓存类型
+    message_text = ' '.join([msg.get('content', '') for msg in messages if isinstance(msg, dict)])
+    message_lower = message_text.lower()
+
+    # 角色生成相关
+    if any(keyword in message_lower for keyword in ['角色', '人物', '性格', '描述', 'character', 'personality']):
+        return 'character_generation', CACHE_DURATIONS['character_generation']
+
+    # 游戏内容相关
+    if any(keyword in message_lower for keyword in ['游戏', '卧底', '投票', 'game', 'undercover', 'vote']):
+        return 'game_content', CACHE_DURATIONS['game_content']
+
+    # 系统提示相关
+    if any(keyword in message_lower for keyword in ['系统', 'system', '规则', 'rule']):
+        return 'system_prompt', CACHE_DURATIONS['system_prompt']
+
+    # 默认为聊天回复
+    return 'chat_response', CACHE_DURATIONS['chat_response']
+
+
+def get_enhanced_cache_key(messages, model, temperature, cache_type):
+    """生成增强的缓存键，包含缓存类型信息"""
+    base_content = json.dumps(messages, sort_keys=True).encode() + model.encode() + str(temperature).encode()
+    cache_key = hashlib.md5(base_content).hexdigest()
+    return f"{cache_type}:{cache_key}"
+
+
+def parse_generation_output(result):
+    """从文本生成接口的响应中取出回复文本，兼容 output.text 和 output.choices 两种格式"""
+    output = result.get('output') if isinstance(result, dict) else None
+    if not isinstance(output, dict):
+        return None
+
+    if 'text' in output:
+        # 旧格式
+        return output['text']
+    if output.get('choices'):
+        # 新格式
+        choice = output['choices'][0]
+        if 'message' in choice and 'content' in choice['message']:
+            return choice['message']['content']
+    return None
+
+
+class ResponseCachePolicy:
+    """按缓存类型设置过期时间的响应缓存策略
+
+    store 为 LRUTTLCache 或 TieredCache，每个条目的 TTL 取自 CACHE_DURATIONS 中对应的缓存类型，
+    写入共享缓存时同样按该 TTL 过期。
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def key_for(self, messages, model, temperature, cache_type_hint=None):
+        cache_type, duration = get_cache_type_and_duration(messages, cache_type_hint)
+        return get_enhanced_cache_key(messages, model, temperature, cache_type), duration
+
+    def get(self, key, duration):
+        return self.store.get(key)
+
+    def put(self, key, value, duration):
+        self.store.put(key, value, ttl=duration)
+
+    def stats(self):
+        return self.store.stats()
+
+
+class RetryPolicy:
+    """失败（或回复未通过校验）时的重试策略"""
+
+    def __init__(self, max_attempts=1, delay=0.5):
+        self.max_attempts = max_attempts
+        self.delay = delay
+
+    def attempts(self, max_attempts=None, delay=None):
+        """依次产出尝试序号，两次尝试之间按 delay 等待"""
+        max_attempts = max(1, max_attempts or self.max_attempts)
+        delay = self.delay if delay is None else delay
+        for attempt in range(max_attempts):
+            if attempt > 0 and delay:
+                time.sleep(delay)
+            yield attempt, attempt == max_attempts - 1
+
+
+class TimeoutPolicy:
+    """按模型确定上游调用超时，显式传入的超时优先"""
+
+    def __init__(self, config):
+        self.config = config
+
+    def timeout_for(self, model, timeout=None):
+        if timeout:
+            return timeout
+        if model == self.config['SECURITY_MODEL']:
+            return self.config['SECURITY_CHECK_TIMEOUT']
+        return self.config['API_TIMEOUT']
+
+
+class ResponseCleaner:
+    """清理模型回复，去除首尾空白和常见的AI回复前缀"""
+
+    DEFAULT_PREFIXES = ('我的描述是：', '我想说：', '描述：', '我觉得：', '我认为：', '答：', '回答：')
+
+    def __init__(self, prefixes=DEFAULT_PREFIXES):
+        self.prefixes = prefixes
+
+    def clean(self, text):
+        text = (text or '').strip()
+        for prefix in self.prefixes:
+            if text.startswith(prefix):
+                text = text[len(prefix):].strip()
+                break
+        return text
+
+
+class SingleFlight:
+    """合并相同键的并发调用：同一时刻只有第一个调用真正执行，其余调用等待并共享它的结果"""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """执行 fn 或等待相同 key 的进行中调用，返回 (结果, 是否为共享结果)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class GatewayMetrics:
+    """网关调用指标（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.upstream_requests = 0
+        self.upstream_failures = 0
+        self.retries = 0
+        self.exhausted = 0
+        self.upstream_seconds = 0.0
+        self.by_model = {}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def record_upstream(self, model, seconds, ok):
+        with self._lock:
+            self.upstream_requests += 1
+            self.upstream_seconds += seconds
+            if not ok:
+                self.upstream_failures += 1
+            self.by_model[model] = self.by_model.get(model, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'cache_hits': self.cache_hits,
+                'coalesced': self.coalesced,
+                'upstream_requests': self.upstream_requests,
+                'upstream_failures': self.upstream_failures,
+                'retries': self.retries,
+                'exhausted': self.exhausted,
+                'upstream_seconds': round(self.upstream_seconds, 3),
+                'avg_upstream_ms': round(self.upstream_seconds * 1000 / self.upstream_requests, 1)
+                if self.upstream_requests else 0,
+                'by_model': dict(self.by_model)
+            }
+
+
+class LLMGateway:
+    """大模型调用的唯一入口"""
+
+    def __init__(self, config, get_http_client, cache, retry, timeout, cleaner, metrics, single_flight):
+        self.config = config
+        self.get_http_client = get_http_client
+        self.cache = cache
+        self.retry = retry
+        self.timeout = timeout
+        self.cleaner = cleaner
+        self.metrics = metrics
+        self.single_flight = single_flight
+
+    def _request_body(self, messages, model, stream=False):
+        parameters = {
+            'temperature': self.config['TEMPERATURE'],
+            'max_tokens': self.config['MAX_TOKENS']
+        }
+        if stream:
+            parameters['result_format'] = 'message'
+            parameters['incremental_output'] = True  # 每个事件只包含新增的文本
+        else:
+            parameters['stream'] = False  # 确保非流式响应以提高速度
+        return {
+            'model': model,
+            'input': {
+                'messages': messages
+            },
+            'parameters': parameters
+        }
+
+    def _call_upstream(self, messages, api_key, model, timeout):
+        """发送一次非流式请求，返回清理后的回复文本，失败返回None"""
+        headers = {
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+            'Connection': 'keep-alive'  # 启用连接复用
+        }
+        started = time.perf_counter()
+        response_text = None
+        try:
+            response = self.get_http_client().post(
+                self.config['QWEN_API_URL'],
+                headers=headers,
+                json=self._request_body(messages, model),
+                timeout=timeout
+            )
+            if response.status_code == 200:
+                result = response.json()
+                response_text = parse_generation_output(result)
+                if not response_text:
+                    print(f"API响应结构异常: {result}")
+                else:
+                    response_text = self.cleaner.clean(response_text)
+                    if not response_text:
+                        print("清理后内容为空")
+            else:
+                print(f"API调用失败: {response.status_code}, 响应: {response.text}")
+        except Exception as e:
+            print(f"API调用异常: {str(e)}")
+        finally:
+            self.metrics.record_upstream(model, time.perf_counter() - started, bool(response_text))
+        return response_text or None
+
+    def complete(self, messages, api_key=None, model=None, timeout=None, cache_type_hint=None,
+                 retries=None, retry_delay=None, validate=None, label='API'):
+        """调用文本生成接口，返回清理后的回复文本；所有尝试都失败时返回None
+
+        retries 为最多尝试次数；validate 用于校验回复内容，未通过时按失败重试。
+        只有通过校验的回复才写入缓存；重试时不读缓存，直接请求上游。
+        """
+        api_key = api_key or self.config['QWEN_API_KEY']
+        model = model or self.config['DEFAULT_MODEL']
+        timeout = self.timeout.timeout_for(model, timeout)
+        cache_key, duration = self.cache.key_for(messages, model, self.config['TEMPERATURE'], cache_type_hint)
+        self.metrics.incr('calls')
+
+        for attempt, is_last in self.retry.attempts(retries, retry_delay):
+            if attempt > 0:
+                self.metrics.incr('retries')
+
+            # 缓存中的回复已经校验过；重试说明上一次的回复不可用，不再读缓存
+            response_text = self.cache.get(cache_key, duration) if attempt == 0 else None
+            fetched = response_text is None
+            shared = False
+            if not fetched:
+                self.metrics.incr('cache_hits')
+            else:
+                # 相同缓存键的并发请求只发一次上游调用，共享同一个结果
+                response_text, shared = self.single_flight.do(
+                    cache_key, lambda: self._call_upstream(messages, api_key, model, timeout))
+                if shared:
+                    self.metrics.incr('coalesced')
+
+            if response_text and (validate is None or validate(response_text)):
+                # 共享结果由发起上游调用的请求写入缓存
+                if fetched and not shared:
+                    self.cache.put(cache_key, response_text, duration)
+                return response_text
+            if not is_last:
+                print(f"{label}第{attempt + 1}次调用失败，准备重试...")
+
+        self.metrics.incr('exhausted')
+        return None
+
+    def stream(self, messages, api_key=None, model=None, cache_type_hint=None):
+        """流式调用文本生成接口，按到达顺序逐段产出增量文本
+
+        命中缓存时一次性产出完整回复；调用失败时不产出任何内容，由调用方决定降级方式。
+        """
+        api_key = api_key or self.config['QWEN_API_KEY']
+        model = model or self.config['DEFAULT_MODEL']
+        cache_key, duration = self.cache.key_for(messages, model, self.config['TEMPERATURE'], cache_type_hint)
+        self.metrics.incr('calls')
+
+        cached = self.cache.get(cache_key, duration)
+        if cached is not None:
+            self.metrics.incr('cache_hits')
+            yield cached
+            return
+
+        headers = {
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream',
+            'X-DashScope-SSE': 'enable'
+        }
+
+        chunks = []
+        started = time.perf_counter()
+        try:
+            with self.get_http_client().post(self.config['QWEN_API_URL'], headers=headers,
+                                             json=self._request_body(messages, model, stream=True),
+                                             timeout=self.timeout.timeout_for(model), stream=True) as response:
+                if response.status_code != 200:
+                    print(f"流式API调用失败: {response.status_code}, 响应: {response.text}")
+                    return
+
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith('data:'):
+                        continue
+                    delta = parse_generation_output(json.loads(line[5:]))
+                    if delta:
+                        chunks.append(delta)
+                        yield delta
+        except Exception as e:
+            print(f"流式API调用异常: {str(e)}")
+            return
+        finally:
+            elapsed = time.perf_counter() - started
+            self.metrics.record_upstream(model, elapsed, bool(chunks))
+            request_timing.record('upstream', elapsed)
+
+        # 完整回复写入缓存，供非流式调用复用
+        response_text = self.cleaner.clean(''.join(chunks))
+        if response_text:
+            self.cache.put(cache_key, response_text, duration)
+
+    def stats(self):
+        stats = self.metrics.snapshot()
+        stats['cache'] = self.cache.stats()
+        stats['in_flight'] = self.single_flight.in_flight()
+        return stats
@@ -0,0 +1,492 @@
+"""
+数据库结构迁移
+
+每个迁移有一个递增的版本号，执行后记录在 schema_migrations 表中；启动时只执行
+尚未应用的迁移。新增表、列或索引时在 MIGRATIONS 末尾追加一项，不要修改已发布的迁移。
+
+多个进程同时启动时，每个迁移在 BEGIN IMMEDIATE 事务中执行，并在拿到写锁后
+重新检查版本，保证只执行一次。
+"""
+
+import json
+import sqlite3
+
+
+def _create_tables(cursor):
+    """初始表结构"""
+    # 创建角色表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS characters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            personality TEXT NOT NULL,
+            description TEXT,
+            system_prompt TEXT NOT NULL,
+            avatar_type TEXT DEFAULT 'initial',
+            avatar_value TEXT,
+            user_id INTEGER,
+            is_default BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    # 创建聊天记录表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            character_id INTEGER,
+            message TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (character_id) REFERENCES characters (id)
+        )
+    ''')
+
+    # 创建API配置表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_config (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_session TEXT,
+            api_key TEXT,
+            model_name TEXT DEFAULT 'qwen-plus',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 创建游戏词库表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS game_words (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            public_word TEXT NOT NULL,
+            undercover_word TEXT NOT NULL,
+            difficulty TEXT DEFAULT 'medium',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 创建游戏记录表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS game_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            game_state TEXT NOT NULL,
+            current_round INTEGER DEFAULT 1,
+            max_rounds INTEGER DEFAULT 3,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 创建ChatSanctuary会话表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sanctuary_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            user_session TEXT,
+            original_emotion TEXT NOT NULL,
+            character_ids TEXT NOT NULL,
+            conversation_rounds INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 创建心情图册表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sanctuary_images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_session TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            image_url TEXT NOT NULL,
+            prompt TEXT,
+            original_emotion TEXT NOT NULL,
+            ai_messages TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 创建用户表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            role TEXT DEFAULT 'user',
+            is_active BOOLEAN DEFAULT 1,
+            api_key TEXT,
+            model_config TEXT,
+            access_count INTEGER DEFAULT 0,
+            model_call_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_login TIMESTAMP,
+            profile_info TEXT
+        )
+    ''')
+
+    # 创建登录失败记录表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS login_failures (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ip_address TEXT NOT NULL,
+            username TEXT,
+            failure_count INTEGER DEFAULT 1,
+            blocked_until TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 创建用户会话表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            session_token TEXT UNIQUE NOT NULL,
+            ip_address TEXT,
+            user_agent TEXT,
+            expires_at TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    # 创建模型配置表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS model_configs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            config_name TEXT NOT NULL,
+            llm_model TEXT DEFAULT 'qwen-plus',
+            security_model TEXT DEFAULT 'deepseek-v3',
+            image_model TEXT DEFAULT 'wanx2.1-t2i-turbo',
+            is_default BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 创建系统配置表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS system_config (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            config_key TEXT UNIQUE NOT NULL,
+            config_value TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _table_columns(cursor, table):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return {row[1] for row in cursor.fetchall()}
+
+
+def _add_character_columns(cursor):
+    """为早期版本创建的角色表补充头像和归属列"""
+    columns = _table_columns(cursor, 'characters')
+    for name, definition in [
+        ('avatar_type', "TEXT DEFAULT 'initial'"),
+        ('avatar_value', 'TEXT'),
+        ('user_id', 'INTEGER'),
+        ('is_default', 'BOOLEAN DEFAULT 0')
+    ]:
+        if name not in columns:
+            cursor.execute(f'ALTER TABLE characters ADD COLUMN {name} {definition}')
+
+
+def _create_hot_query_indexes(cursor):
+    """为高频查询建立二级索引"""
+    # 聊天历史：WHERE session_id = ? ORDER BY timestamp DESC
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_history_session_time ON chat_history (session_id, timestamp)')
+    # 角色列表：WHERE is_default = 1 OR user_id = ?（两个索引配合 OR 优化）
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_characters_default ON characters (is_default, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_characters_user ON characters (user_id, created_at)')
+    # 游戏状态：WHERE session_id = ?
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_game_sessions_session ON game_sessions (session_id)')
+    # 心情图册：WHERE user_session = ? ORDER BY created_at DESC
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sanctuary_images_user ON sanctuary_images (user_session, created_at)')
+    # 登录失败：WHERE ip_address = ? AND blocked_until ...
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_login_failures_ip ON login_failures (ip_address, blocked_until)')
+    # API配置：WHERE user_session = ?
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_config_user_session ON api_config (user_session)')
+
+
+def _create_chat_summaries(cursor):
+    """对话滚动摘要表，以及按消息 id 读取会话历史的索引"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            session_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            summarized_until_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # 聊天历史：WHERE session_id = ? AND id > ? ORDER BY id DESC
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_history_session_id ON chat_history (session_id, id)')
+
+
+def _create_chat_sessions(cursor):
+    """群聊会话表（带归属用户）和聊天记录归档表，并从已有聊天记录回填会话"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            session_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            topic TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_message_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            archived_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    # 会话列表：WHERE user_id = ? ORDER BY last_message_at DESC, session_id DESC
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_sessions_user ON chat_sessions (user_id, last_message_at, session_id)')
+    # 归档：WHERE last_message_at < ?
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_sessions_last_message ON chat_sessions (last_message_at)')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_history_archive (
+            id INTEGER PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            character_id INTEGER,
+            message TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            timestamp TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_history_archive_session ON chat_history_archive (session_id, id)')
+
+    # 已有的聊天记录没有归属信息，回填的会话 user_id 为空，只参与归档
+    cursor.execute('''
+        INSERT OR IGNORE INTO chat_sessions (session_id, created_at, last_message_at, message_count)
+        SELECT session_id, MIN(timestamp), MAX(timestamp), COUNT(*)
+        FROM chat_history GROUP BY session_id
+    ''')
+
+
+def _create_fulltext_indexes(cursor):
+    """聊天记录和角色库的 FTS5 全文索引（trigram 分词，支持中文子串检索），由触发器保持同步
+
+    SQLite 未编译 FTS5 或版本低于 3.34（不支持 trigram）时跳过，搜索退回到 LIKE 查询。
+    """
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS chat_history_fts USING fts5(
+                message, content='chat_history', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        print(f"当前SQLite不支持FTS5 trigram分词，跳过全文索引: {e}")
+        return
+
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS characters_fts USING fts5(
+            name, personality, description, system_prompt,
+            content='characters', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+
+    for statement in (
+        '''CREATE TRIGGER IF NOT EXISTS chat_history_fts_insert AFTER INSERT ON chat_history BEGIN
+               INSERT INTO chat_history_fts (rowid, message) VALUES (new.id, new.message);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS chat_history_fts_delete AFTER DELETE ON chat_history BEGIN
+               INSERT INTO chat_history_fts (chat_history_fts, rowid, message) VALUES ('delete', old.id, old.message);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS chat_history_fts_update AFTER UPDATE OF message ON chat_history BEGIN
+               INSERT INTO chat_history_fts (chat_history_fts, rowid, message) VALUES ('delete', old.id, old.message);
+               INSERT INTO chat_history_fts (rowid, message) VALUES (new.id, new.message);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS characters_fts_insert AFTER INSERT ON characters BEGIN
+               INSERT INTO characters_fts (rowid, name, personality, description, system_prompt)
+               VALUES (new.id, new.name, new.personality, new.description, new.system_prompt);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS characters_fts_delete AFTER DELETE ON characters BEGIN
+               INSERT INTO characters_fts (characters_fts, rowid, name, personality, description, system_prompt)
+               VALUES ('delete', old.id, old.name, old.personality, old.description, old.system_prompt);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS characters_fts_update
+           AFTER UPDATE OF name, personality, description, system_prompt ON characters BEGIN
+               INSERT INTO characters_fts (characters_fts, rowid, name, personality, description, system_prompt)
+               VALUES ('delete', old.id, old.name, old.personality, old.description, old.system_prompt);
+               INSERT INTO characters_fts (rowid, name, personality, description, system_prompt)
+               VALUES (new.id, new.name, new.personality, new.description, new.system_prompt);
+           END'''
+    ):
+        cursor.execute(statement)
+
+    # 为已有数据建立索引
+    cursor.execute("INSERT INTO chat_history_fts (chat_history_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO characters_fts (characters_fts) VALUES ('rebuild')")
+
+
+def _fulltext_ready(cursor):
+    cursor.execute('''
+        SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'table' AND name IN ('chat_history_fts', 'characters_fts')
+    ''')
+    return cursor.fetchone()[0] == 2
+
+
+def ensure_fulltext_indexes(conn):
+    """全文索引缺失时补建，返回全文索引是否可用
+
+    v6 迁移在 SQLite 不支持 FTS5 trigram 时跳过建表但仍记为已应用；每次启动调用一次，
+    SQLite 升级后即可补建全文索引，不需要新的迁移版本。
+    """
+    cursor = conn.cursor()
+    if current_version(cursor) < 6:
+        return False  # 由 v6 迁移负责创建
+    if _fulltext_ready(cursor):
+        return True
+
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        if not _fulltext_ready(cursor):
+            _create_fulltext_indexes(cursor)
+            if _fulltext_ready(cursor):
+                print("已补建聊天记录与角色库全文索引")
+        ready = _fulltext_ready(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return ready
+
+
+def _create_game_records(cursor):
+    """谁是卧底的玩家、描述、投票明细表，并从已有游戏状态 JSON 回填"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS game_players (
+            session_id TEXT NOT NULL,
+            player_index INTEGER NOT NULL,
+            character_id INTEGER,
+            character_name TEXT,
+            is_undercover BOOLEAN NOT NULL DEFAULT 0,
+            eliminated_round INTEGER,
+            PRIMARY KEY (session_id, player_index)
+        )
+    ''')
+    # 按角色统计胜率等分析查询
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_game_players_character ON game_players (character_id)')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS game_descriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            round INTEGER NOT NULL,
+            player_index INTEGER NOT NULL,
+            description TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_game_descriptions_round ON game_descriptions (session_id, round)')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS game_votes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            round INTEGER NOT NULL,
+            voter_index INTEGER,
+            target_index INTEGER,
+            vote_text TEXT,
+            source TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_game_votes_round ON game_votes (session_id, round)')
+
+    # 回填已有游戏的玩家和描述；旧数据没有记录淘汰轮次，已淘汰的玩家记为第0轮
+    cursor.execute('SELECT session_id, game_state FROM game_sessions')
+    for session_id, raw_state in cursor.fetchall():
+        try:
+            state = json.loads(raw_state)
+            characters = state['characters']
+            undercover_index = state['undercover_index']
+        except (TypeError, ValueError, KeyError):
+            continue
+        eliminated = set(state.get('eliminated') or [])
+        cursor.executemany('''
+            INSERT OR IGNORE INTO game_players
+                (session_id, player_index, character_id, character_name, is_undercover, eliminated_round)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [
+            (session_id, index, character.get('id'), character.get('name'),
+             index == undercover_index, 0 if index in eliminated else None)
+            for index, character in enumerate(characters)
+        ])
+        cursor.executemany('''
+            INSERT INTO game_descriptions (session_id, round, player_index, description)
+            VALUES (?, ?, ?, ?)
+        ''', [
+            (session_id, round_index + 1, index, desc_info['description'])
+            for round_index, round_descriptions in enumerate(state.get('descriptions') or [])
+            for index, desc_info in enumerate(round_descriptions)
+            if desc_info and desc_info.get('description')
+        ])
+
+
+# (版本号, 说明, 迁移函数)，版本号必须递增
+MIGRATIONS = [
+    (1, '初始表结构', _create_tables),
+    (2, '角色表头像与归属列', _add_character_columns),
+    (3, '高频查询索引', _create_hot_query_indexes),
+    (4, '对话滚动摘要', _create_chat_summaries),
+    (5, '群聊会话与聊天记录归档', _create_chat_sessions),
+    (6, '聊天记录与角色库全文索引', _create_fulltext_indexes),
+    (7, '谁是卧底对局明细表', _create_game_records),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _ensure_migrations_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def current_version(cursor):
+    """返回已应用的最高迁移版本，未迁移过的数据库返回 0"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'schema_migrations'")
+    if not cursor.fetchone():
+        return 0
+    cursor.execute('SELECT MAX(version) FROM schema_migrations')
+    return cursor.fetchone()[0] or 0
+
+
+def migrate(conn):
+    """执行所有尚未应用的迁移，返回本次应用的版本号列表"""
+    cursor = conn.cursor()
+    if current_version(cursor) >= LATEST_VERSION:
+        return []
+
+    applied = []
+    for version, name, migration in MIGRATIONS:
+        # 写锁内重新检查版本，避免多个进程重复执行同一迁移
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            _ensure_migrations_table(cursor)
+            if current_version(cursor) >= version:
+                conn.commit()
+                continue
+            migration(cursor)
+            cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)', (version, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"数据库迁移 v{version} 已应用: {name}")
+        applied.append(version)
+
+    if applied:
+        # 新建索引后更新查询规划器的统计信息
+        cursor.execute('PRAGMA optimize')
+    return applied
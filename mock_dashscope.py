@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+阿里云百炼（DashScope）本地模拟服务
+
+用于离线压测和开发调试，只依赖标准库。实现了应用用到的三个接口：
+    POST /api/v1/services/aigc/text-generation/generation   文本生成（普通 / SSE 流式）
+    POST /api/v1/services/aigc/text2image/image-synthesis    创建图像生成异步任务
+    GET  /api/v1/tasks/<task_id>                              查询任务状态
+另外提供：
+    GET  /mock/images/<task_id>.svg                           任务生成的占位图像
+    GET  /mock/stats                                          模拟服务的请求计数
+
+使用方法:
+    python mock_dashscope.py --port 8090 --latency lognormal:-1.2,0.5 --error-rate 0.02
+    DASHSCOPE_BASE_URL=http://127.0.0.1:8090 python run.py
+
+延迟分布写法（单位：秒）:
+    fixed:0.3             固定延迟
+    uniform:0.1,0.8       均匀分布
+    normal:0.4,0.1        正态分布（均值, 标准差），小于0按0处理
+    lognormal:-1.0,0.5    对数正态分布（mu, sigma）
+    exp:0.4               指数分布（均值）
+"""
+
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+GENERATION_PATH = '/api/v1/services/aigc/text-generation/generation'
+IMAGE_SYNTHESIS_PATH = '/api/v1/services/aigc/text2image/image-synthesis'
+TASK_PATH_PREFIX = '/api/v1/tasks/'
+IMAGE_PATH_PREFIX = '/mock/images/'
+
+
+def parse_latency(spec):
+    """把延迟分布写法解析为无参采样函数"""
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(',') if v.strip()]
+
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(values[0], values[1])
+    if kind == 'exp':
+        return lambda: random.expovariate(1.0 / values[0])
+    raise ValueError(f"不支持的延迟分布: {spec}")
+
+
+class MockState:
+    """模拟服务的配置、异步任务和计数"""
+
+    def __init__(self, latency, stream_chunk_delay, error_rate, image_latency, image_error_rate,
+                 result_format, stream_chunk_size, vote_style='strict'):
+        self.latency = latency
+        self.stream_chunk_delay = stream_chunk_delay
+        self.error_rate = error_rate
+        self.image_latency = image_latency
+        self.image_error_rate = image_error_rate
+        self.result_format = result_format
+        self.stream_chunk_size = stream_chunk_size
+        self.vote_style = vote_style
+        self._format_cycle = itertools.cycle(['text', 'message'])
+        self._lock = threading.Lock()
+        self.tasks = {}  # task_id -> {'ready_at', 'failed', 'prompt'}
+        self.counters = {
+            'generation': 0,
+            'generation_stream': 0,
+            'image_tasks': 0,
+            'task_queries': 0,
+            'injected_errors': 0
+        }
+
+    def incr(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def pick_format(self, parameters):
+        """确定响应格式：auto 时遵循请求的 result_format，mixed 时两种格式交替返回"""
+        if self.result_format == 'auto':
+            return 'message' if parameters.get('result_format') == 'message' else 'text'
+        if self.result_format == 'mixed':
+            with self._lock:
+                return next(self._format_cycle)
+        return self.result_format
+
+    def create_task(self, prompt):
+        task_id = uuid.uuid4().hex
+        with self._lock:
+            self.tasks[task_id] = {
+                'ready_at': time.time() + self.image_latency(),
+                'failed': random.random() < self.image_error_rate,
+                'prompt': prompt
+            }
+            self.counters['image_tasks'] += 1
+        return task_id
+
+    def get_task(self, task_id):
+        with self._lock:
+            self.counters['task_queries'] += 1
+            return self.tasks.get(task_id)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['pending_tasks'] = sum(1 for t in self.tasks.values() if t['ready_at'] > time.time())
+        return stats
+
+
+# vote_style 为 mixed 时随机使用的投票回复写法（最后两种不符合要求的格式）
+MIXED_VOTE_REPLIES = [
+    '投票给：{target}，理由：描述有些含糊，和大家不太一样',
+    '投票：{target}，感觉描述的角度很奇怪',
+    '选择：{target}。理由是前后说法对不上',
+    '我投{target}，这个描述太笼统了',
+    '我觉得{target}最可疑，说法和大家不太一样',
+    '这一轮我还没有想好要选谁'
+]
+
+
+def mock_reply(messages, vote_style='strict'):
+    """根据提示词内容生成格式上可被应用解析的模拟回复
+
+    vote_style 为 mixed 时，投票回复随机使用多种写法（包括无法解析的），用于测试投票解析。
+    """
+    prompt = '\n'.join(m.get('content', '') for m in messages if isinstance(m, dict))
+    last = messages[-1].get('content', '') if messages else ''
+
+    # 提示词注入检测
+    if "'安全'或'危险'" in prompt:
+        return '安全'
+
+    # 谁是卧底投票
+    if '格式：投票给：' in prompt:
+        match = re.search(r'可投票的角色：(.+)', prompt)
+        candidates = [name.strip() for name in match.group(1).split(',') if name.strip()] if match else []
+        target = random.choice(candidates) if candidates else '未知'
+        if vote_style == 'mixed':
+            return random.choice(MIXED_VOTE_REPLIES).format(target=target)
+        return f'投票给：{target}，理由：描述有些含糊，和大家不太一样'
+
+    # 词汇对生成
+    if 'public_word' in prompt and 'undercover_word' in prompt:
+        pairs = [
+            {'public_word': '牛奶', 'undercover_word': '豆浆'},
+            {'public_word': '饺子', 'undercover_word': '包子'},
+            {'public_word': '眼镜', 'undercover_word': '墨镜'}
+        ]
+        return json.dumps(pairs, ensure_ascii=False)
+
+    # 树洞图像提示词分析
+    if '"title"' in prompt and '"blessings"' in prompt:
+        return json.dumps({
+            'title': '心灵花园',
+            'prompt': 'a peaceful garden with soft sunlight, blooming flowers, warm colors',
+            'blessings': ['愿你的心如花园般宁静美好', '每一天都有温暖的阳光陪伴你']
+        }, ensure_ascii=False)
+
+    snippet = re.sub(r'\s+', ' ', last)[:20]
+    return f'（模拟回复）关于“{snippet}”，我想说这真是个有意思的话题，我们继续聊聊吧。'
+
+
+class MockDashScopeHandler(BaseHTTPRequestHandler):
+    """DashScope 接口的模拟实现"""
+
+    protocol_version = 'HTTP/1.1'  # 支持 keep-alive，便于观察客户端的连接复用
+    state = None  # 由 create_server 注入
+    quiet = True
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+    # ---- 响应工具 ----
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, code, message):
+        self.send_json({'code': code, 'message': message, 'request_id': uuid.uuid4().hex}, status)
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        return json.loads(raw or b'{}')
+
+    def check_auth(self):
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self.send_error_json(401, 'InvalidApiKey', 'No API-key provided.')
+            return False
+        return True
+
+    def inject_error(self):
+        """按配置的错误率返回限流或服务端错误"""
+        if random.random() >= self.state.error_rate:
+            return False
+        self.state.incr('injected_errors')
+        if random.random() < 0.5:
+            self.send_error_json(429, 'Throttling.RateQuota', 'Requests rate limit exceeded, please try again later.')
+        else:
+            self.send_error_json(500, 'InternalError', 'An internal error has occured, please try again later.')
+        return True
+
+    # ---- 路由 ----
+
+    def do_POST(self):
+        try:
+            body = self.read_json()
+        except ValueError:
+            self.send_error_json(400, 'InvalidParameter', 'Request body is not valid JSON.')
+            return
+
+        if not self.check_auth():
+            return
+        if self.path == GENERATION_PATH:
+            self.handle_generation(body)
+        elif self.path == IMAGE_SYNTHESIS_PATH:
+            self.handle_image_synthesis(body)
+        else:
+            self.send_error_json(404, 'NotFound', f'Unknown path: {self.path}')
+
+    def do_GET(self):
+        if self.path == '/mock/stats':
+            self.send_json(self.state.stats())
+        elif self.path.startswith(TASK_PATH_PREFIX):
+            if self.check_auth():
+                self.handle_task_query(self.path[len(TASK_PATH_PREFIX):])
+        elif self.path.startswith(IMAGE_PATH_PREFIX):
+            self.handle_image(self.path[len(IMAGE_PATH_PREFIX):])
+        else:
+            self.send_error_json(404, 'NotFound', f'Unknown path: {self.path}')
+
+    def handle_generation(self, body):
+        messages = body.get('input', {}).get('messages', [])
+        parameters = body.get('parameters', {})
+        stream = self.headers.get('X-DashScope-SSE') == 'enable' or \
+            'text/event-stream' in self.headers.get('Accept', '')
+
+        time.sleep(self.state.latency())
+        if self.inject_error():
+            return
+
+        text = mock_reply(messages, self.state.vote_style)
+        result_format = self.state.pick_format(parameters)
+        usage = {'input_tokens': sum(len(m.get('content', '')) for m in messages), 'output_tokens': len(text)}
+
+        if not stream:
+            self.state.incr('generation')
+            if result_format == 'message':
+                output = {'choices': [{'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': text}}]}
+            else:
+                output = {'text': text, 'finish_reason': 'stop'}
+            self.send_json({'output': output, 'usage': usage, 'request_id': uuid.uuid4().hex})
+            return
+
+        self.state.incr('generation_stream')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        incremental = parameters.get('incremental_output', False)
+        size = self.state.stream_chunk_size
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        request_id = uuid.uuid4().hex
+        sent = ''
+        for index, piece in enumerate(pieces, 1):
+            sent += piece
+            content = piece if incremental else sent
+            finish_reason = 'stop' if index == len(pieces) else 'null'
+            if result_format == 'message':
+                output = {'choices': [{'finish_reason': finish_reason,
+                                       'message': {'role': 'assistant', 'content': content}}]}
+            else:
+                output = {'text': content, 'finish_reason': finish_reason}
+            data = json.dumps({'output': output, 'usage': usage, 'request_id': request_id}, ensure_ascii=False)
+            self.write_chunk(f"id:{index}\nevent:result\n:HTTP_STATUS/200\ndata:{data}\n\n".encode('utf-8'))
+            if index < len(pieces):
+                time.sleep(self.state.stream_chunk_delay())
+        self.write_chunk(b'')
+
+    def handle_image_synthesis(self, body):
+        if self.headers.get('X-DashScope-Async') != 'enable':
+            self.send_error_json(403, 'AccessDenied', 'current user api does not support synchronous calls')
+            return
+
+        time.sleep(self.state.latency())
+        if self.inject_error():
+            return
+
+        task_id = self.state.create_task(body.get('input', {}).get('prompt', ''))
+        self.send_json({
+            'output': {'task_id': task_id, 'task_status': 'PENDING'},
+            'request_id': uuid.uuid4().hex
+        })
+
+    def handle_task_query(self, task_id):
+        task = self.state.get_task(task_id)
+        if task is None:
+            self.send_error_json(404, 'InvalidParameter', f'task_id {task_id} not found')
+            return
+
+        output = {'task_id': task_id}
+        if task['ready_at'] > time.time():
+            output['task_status'] = 'RUNNING'
+        elif task['failed']:
+            output.update(task_status='FAILED', code='InternalError', message='模拟的图像生成失败')
+        else:
+            host = self.headers.get('Host', f'127.0.0.1:{self.server.server_port}')
+            output.update(task_status='SUCCEEDED',
+                          results=[{'url': f'http://{host}{IMAGE_PATH_PREFIX}{task_id}.svg'}])
+        self.send_json({'output': output, 'request_id': uuid.uuid4().hex})
+
+    def handle_image(self, name):
+        body = ('<svg width="512" height="512" xmlns="http://www.w3.org/2000/svg">'
+                '<rect width="100%" height="100%" fill="#fde2e4"/>'
+                f'<text x="50%" y="50%" text-anchor="middle" font-size="20">{name[:12]}</text>'
+                '</svg>').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/svg+xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def create_server(host='127.0.0.1', port=8090, latency='fixed:0.3', stream_chunk_delay='fixed:0.05',
+                  error_rate=0.0, image_latency='fixed:4', image_error_rate=0.0, result_format='auto',
+                  stream_chunk_size=4, vote_style='strict', quiet=True):
+    """创建模拟服务（未启动），port 为 0 时自动分配端口"""
+    state = MockState(
+        latency=parse_latency(latency),
+        stream_chunk_delay=parse_latency(stream_chunk_delay),
+        error_rate=error_rate,
+        image_latency=parse_latency(image_latency),
+        image_error_rate=image_error_rate,
+        result_format=result_format,
+        stream_chunk_size=stream_chunk_size,
+        vote_style=vote_style
+    )
+    handler = type('ConfiguredMockHandler', (MockDashScopeHandler,), {'state': state, 'quiet': quiet})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    return server
+
+
+def start_in_thread(**kwargs):
+    """在后台线程启动模拟服务，返回 (server, base_url)，供压测脚本内嵌使用"""
+    server = create_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f'http://{host}:{port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='阿里云百炼（DashScope）本地模拟服务')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址 (默认: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8090, help='监听端口 (默认: 8090)')
+    parser.add_argument('--latency', default='fixed:0.3', help='文本生成首包延迟分布 (默认: fixed:0.3)')
+    parser.add_argument('--stream-chunk-delay', default='fixed:0.05', help='流式输出每段之间的延迟分布')
+    parser.add_argument('--stream-chunk-size', type=int, default=4, help='流式输出每段的字数 (默认: 4)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='文本生成和任务创建的错误率 0~1')
+    parser.add_argument('--image-latency', default='fixed:4', help='图像任务从创建到完成的时间分布')
+    parser.add_argument('--image-error-rate', type=float, default=0.0, help='图像任务失败率 0~1')
+    parser.add_argument('--format', dest='result_format', default='auto',
+                        choices=['auto', 'text', 'message', 'mixed'],
+                        help='文本生成响应格式：auto 遵循请求参数，mixed 两种格式交替 (默认: auto)')
+    parser.add_argument('--vote-style', default='strict', choices=['strict', 'mixed'],
+                        help='谁是卧底投票回复的写法：strict 总是符合要求的格式，mixed 混合多种写法 (默认: strict)')
+    parser.add_argument('--seed', type=int, default=None, help='随机数种子，便于复现')
+    parser.add_argument('--verbose', action='store_true', help='打印每个请求的访问日志')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    server = create_server(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        stream_chunk_delay=args.stream_chunk_delay,
+        error_rate=args.error_rate,
+        image_latency=args.image_latency,
+        image_error_rate=args.image_error_rate,
+        result_format=args.result_format,
+        stream_chunk_size=args.stream_chunk_size,
+        vote_style=args.vote_style,
+        quiet=not args.verbose
+    )
+    print(f"🧪 DashScope 模拟服务已启动: http://{args.host}:{server.server_port}")
+    print(f"   应用端设置 DASHSCOPE_BASE_URL=http://{args.host}:{server.server_port} 即可接入")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n👋 模拟服务已停止")
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
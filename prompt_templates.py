@@ -0,0 +1,243 @@
+"""
+提示词模板注册表
+
+每个模板分为两部分：
+- 静态前缀：角色设定和固定规则，只依赖角色本身，按角色编译一次后缓存复用
+- 动态后缀：话题、词语、轮次、其他角色发言等每次调用都会变化的内容
+
+前缀总是放在系统提示的最前面且内容逐字节稳定，同一角色的多次调用共享相同的开头，
+上游的前缀/上下文缓存才能生效。注册表统计每次调用的提示词字节数，以及其中有多少
+字节来自已缓存的前缀。
+"""
+
+import threading
+
+from response_cache import LRUTTLCache
+
+DIALOGUE_RULE = '禁止使用叙述性描述（如"我点点头"、"我看着"等）'
+
+
+class PromptTemplate:
+    """由静态前缀和动态后缀组成的提示词模板（str.format 语法）"""
+
+    def __init__(self, name, prefix, suffix=''):
+        self.name = name
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def compile_prefix(self, **static):
+        return self.prefix.format(**static)
+
+    def render_suffix(self, **dynamic):
+        return self.suffix.format(**dynamic)
+
+
+class PromptRegistry:
+    """模板注册表：缓存每个角色编译好的前缀，并统计提示词字节数"""
+
+    def __init__(self, max_prefixes=512, prefix_ttl=24 * 3600):
+        self._templates = {}
+        self._prefixes = LRUTTLCache(max_prefixes, default_ttl=prefix_ttl)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def register(self, template):
+        self._templates[template.name] = template
+        with self._lock:
+            self._stats[template.name] = {
+                'calls': 0, 'prompt_bytes': 0, 'reused_bytes': 0, 'prefix_compiles': 0
+            }
+        return template
+
+    def render(self, name, static, **dynamic):
+        """渲染系统提示：static 为编译前缀用的参数（如角色设定），dynamic 为后缀参数"""
+        template = self._templates[name]
+        key = (name, tuple(sorted(static.items())))
+        prefix = self._prefixes.get(key)
+        reused = prefix is not None
+        if not reused:
+            prefix = template.compile_prefix(**static)
+            self._prefixes.put(key, prefix)
+
+        prompt = prefix + template.render_suffix(**dynamic)
+        prompt_bytes = len(prompt.encode('utf-8'))
+        with self._lock:
+            stats = self._stats[name]
+            stats['calls'] += 1
+            stats['prompt_bytes'] += prompt_bytes
+            if reused:
+                stats['reused_bytes'] += len(prefix.encode('utf-8'))
+            else:
+                stats['prefix_compiles'] += 1
+        return prompt
+
+    def stats(self):
+        with self._lock:
+            templates = {}
+            for name, stats in self._stats.items():
+                calls = stats['calls']
+                templates[name] = dict(
+                    stats,
+                    avg_prompt_bytes=round(stats['prompt_bytes'] / calls, 1) if calls else 0,
+                    reuse_ratio=round(stats['reused_bytes'] / stats['prompt_bytes'], 4) if stats['prompt_bytes'] else 0
+                )
+        return {'templates': templates, 'prefix_cache': self._prefixes.stats()}
+
+
+CHAT = PromptTemplate('chat', '''{system_prompt}
+
+【重要对话规则】
+
+1. 禁止使用叙述性描述（如'我点点头'、'我看着'、'我想起'等）
+2. 用你的独特语气和性格表达
+3. 保持角色一致性，基于之前的对话历史自然参与讨论
+4. 回复控制在100字左右，保持简洁而有趣''', '''
+
+当前话题：{topic}{summary_section}''')
+
+DESCRIBE_UNDERCOVER = PromptTemplate('describe_undercover', '''{character_prompt}
+
+你是本局游戏的卧底。
+你不知道其他人的词是什么，只知道它可能是同类事物（如：同属"文具"、同属"食物"等）。
+
+**重要约束**：
+1. **绝对禁止**直接说出你的目标词或其任何变形
+2. **绝对禁止**使用目标词的拼音、首字母、谐音
+3. **绝对禁止**明确描述外观、颜色、质地等精确特征
+4. **绝对禁止**明确说出类别名称
+
+你的目标是：在维持角色性格的基础上，尽可能模糊描述你拿到的词，**不要暴露关键特征**，但要让别人觉得你和他们是同一类。
+
+**参考策略**：
+- 如果前面有人发言，要从**不同角度**描述，避免重复相同的表达方式
+- 可以描述使用感受、使用情境、联想印象、童年记忆、情感体验
+- 保持模糊性：用"那种感觉"、"某种体验"等模糊表达
+- 情绪化表达：引发共鸣但不暴露具体信息
+- 保持你的角色性格和语气习惯
+- ''' + DIALOGUE_RULE + '''
+
+**要求**：请直接说出你的描述，用1句自然的话语表达（35~50字），不要重复他人的角度，保持你的角色特色。''', '''
+
+你拿到的词是：「{target_word}」。{context_info}
+''')
+
+DESCRIBE_CIVILIAN = PromptTemplate('describe_civilian', '''{character_prompt}
+
+你是本局游戏的平民。
+
+**重要约束**：
+1. **绝对禁止**直接说出目标词或其任何变形
+2. **绝对禁止**使用目标词的拼音、首字母、谐音
+3. **绝对禁止**明确描述外观、材质等过于明显的特征
+4. **绝对禁止**暗示字数、读音、发音结构
+
+你需要在不暴露关键词的前提下，以**角色性格风格**进行表达，帮助同阵营的人理解你指的是什么，同时迷惑卧底。
+
+**参考策略**：
+- 如果前面有人发言，要从**不同角度**描述，避免重复
+- 情境化：在哪些时候会用到它，但要模糊表达
+- 联想型：它让你想到什么东西或回忆，但不要太直接
+- 抽象感受：它给你带来的情绪或氛围
+- 功能暗示：用模糊的方式暗示用途，但不要太明显
+
+**重要对话规则**：
+- ''' + DIALOGUE_RULE + '''
+
+**要求**：请直接说出你的描述，用1句符合角色性格的自然话语（35~50字），避免重复他人的表达方式。''', '''
+
+你拿到的关键词是：「{target_word}」。{context_info}
+''')
+
+VOTE_FORMAT = '''
+
+请选择一个角色进行投票，并简要说明理由（30字以内）。
+格式：投票给：[角色名]，理由：[理由]'''
+
+VOTE_UNDERCOVER = PromptTemplate('vote_undercover', '''{character_prompt}
+
+你是本局游戏的卧底。现在是投票环节，你需要巧妙地引导投票，避免自己被淘汰。
+
+**卧底投票要求**：
+1. 绝对不能暴露自己的卧底身份
+2. 投票理由要符合平民的思维逻辑
+3. 避免投票过于明显或过于隐蔽
+4. 保持角色性格的一致性
+5. 可以适当误导其他玩家的判断
+6. 在必要时可以牺牲一个平民来保护自己
+7. 投票理由中不要包含任何一方的目标词''', '''
+
+你的目标词是「{undercover_word}」。
+平民们的目标词是「{public_word}」。
+
+本轮所有人的描述：
+{descriptions_text}
+
+可投票的角色：{candidates}
+
+**你的卧底策略**：{undercover_strategy}
+**你的伪装风格**：{disguise_style}
+**你的风险控制**：{risk_control}''' + VOTE_FORMAT)
+
+VOTE_CIVILIAN = PromptTemplate('vote_civilian', '''{character_prompt}
+
+你是本局游戏的平民。现在是投票环节，你需要分析所有人的描述，找出最可能是卧底的人。
+
+**投票要求**：
+1. 根据你的个人判断和下面的策略进行独立分析
+2. 每个平民的怀疑对象可能不同，这很正常
+3. 结合你的角色性格和思维方式进行判断
+4. 不要完全跟随他人的选择，保持独立思考
+5. 可以适当考虑心理博弈和反向思维
+6. 在不确定时，可以选择相对安全的投票策略
+7. 投票理由中不要包含你拿到的目标词''', '''
+
+你的目标词是「{public_word}」。
+卧底的目标词是「{undercover_word}」（你不知道这个词）。
+
+本轮所有人的描述：
+{descriptions_text}
+
+可投票的角色：{candidates}
+
+**你的分析方式**：{analysis_angle}
+**你的投票策略**：{strategy_hint}
+**你的风险偏好**：{risk_preference}
+**你的信心状态**：{confidence_level}''' + VOTE_FORMAT)
+
+SANCTUARY = PromptTemplate('sanctuary', '''{base_system_prompt}
+
+你现在是ChatSanctuary心灵小屋的陪伴者，和其他AI角色一起陪伴一位正在经历情绪困扰的用户。
+
+【核心任务】
+1. 深度理解用户的情绪根源和具体困扰
+2. 提供实用的解决建议或应对策略
+3. 与其他AI角色协作，形成一致的支持方案
+4. 针对其他角色的观点表达同意/补充/不同看法
+
+【回应要求】
+- 如果是第1-2轮：重点共情和理解，挖掘问题核心
+- 如果是第3-5轮：提供具体建议和解决方案
+- 如果是第6-8轮：总结共识，给出最终建议和赠语
+
+【互动规则】
+- 认真阅读其他角色的发言，避免重复
+- 可以说"我同意XX的观点"或"我觉得还可以..."来呼应其他角色
+- 保持你的角色特色，但要专业和治愈导向
+- 每次回复50-80字，要有实质内容
+- 可以偶尔自然地称呼用户的名字，但不要每次都提及，保持对话自然流畅
+- 如果是最后几轮对话，可以给用户一些温暖的赠语或祝福
+- ''' + DIALOGUE_RULE, '''
+
+【本次对话】
+用户{user_name}分享了他们的情绪困扰："{emotion}"
+现在是第{round_number}轮对话。
+
+请给出你的专业建议：''')
+
+
+def create_registry(max_prefixes=512):
+    """创建注册了应用全部模板的注册表"""
+    registry = PromptRegistry(max_prefixes)
+    for template in (CHAT, DESCRIBE_UNDERCOVER, DESCRIBE_CIVILIAN, VOTE_UNDERCOVER, VOTE_CIVILIAN, SANCTUARY):
+        registry.register(template)
+    return registry
@@ -0,0 +1,106 @@
+"""
+请求级耗时统计
+
+每个请求开始时创建一个 RequestTiming，并放入 contextvar；数据库访问和上游调用
+通过 record() 把耗时累加到当前请求上。请求结束时以 Server-Timing 响应头输出，
+供压测脚本（benchmark.py）按路由统计数据库耗时和上游耗时。
+
+在线程池中执行的任务需要用 contextvars.copy_context().run 包装，才能把耗时
+记到发起它的请求上（见 app.run_concurrently）。
+"""
+
+import contextvars
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar('request_timing', default=None)
+
+
+class RequestTiming:
+    """单个请求内各类耗时的累加器（线程安全，并发任务可同时写入）"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.seconds = {}
+        self.counts = {}
+
+    def add(self, category, seconds):
+        with self._lock:
+            self.seconds[category] = self.seconds.get(category, 0.0) + seconds
+            self.counts[category] = self.counts.get(category, 0) + 1
+
+    def server_timing(self):
+        """生成 Server-Timing 头：各类别累计耗时（毫秒）和次数，以及请求总耗时"""
+        with self._lock:
+            items = [f"{name};dur={seconds * 1000:.2f};desc=\"{self.counts[name]}\""
+                     for name, seconds in sorted(self.seconds.items())]
+        items.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.2f}")
+        return ', '.join(items)
+
+
+def start():
+    """为当前请求开始计时，返回用于 finish() 的令牌"""
+    return _current.set(RequestTiming())
+
+
+def current():
+    return _current.get()
+
+
+def finish(token):
+    timing = _current.get()
+    _current.reset(token)
+    return timing
+
+
+def record(category, seconds):
+    """把一段耗时记到当前请求上，不在请求中时忽略"""
+    timing = _current.get()
+    if timing is not None:
+        timing.add(category, seconds)
+
+
+@contextmanager
+def timed(category):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(category, time.perf_counter() - started)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """统计执行和取数耗时的游标"""
+
+    def execute(self, *args, **kwargs):
+        with timed('db'):
+            return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        with timed('db'):
+            return super().executemany(*args, **kwargs)
+
+    def fetchone(self):
+        with timed('db'):
+            return super().fetchone()
+
+    def fetchall(self):
+        with timed('db'):
+            return super().fetchall()
+
+
+class TimedConnection(sqlite3.Connection):
+    """游标和提交都计入数据库耗时的连接，通过 sqlite3.connect(..., factory=TimedConnection) 使用"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args, **kwargs):
+        return self.cursor().execute(*args, **kwargs)
+
+    def commit(self):
+        with timed('db'):
+            return super().commit()
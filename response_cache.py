@@ -0,0 +1,293 @@
+"""
+响应缓存
+
+LRUTTLCache 是进程内的一级缓存，OrderedDict 按最近使用顺序保存条目，get/put 都是 O(1)：
+- 每个条目单独记录过期时间（由写入时的 ttl 决定），读取时才检查是否过期（惰性过期）
+- 同时限制条目数和估算的字节数，超限时从最久未使用的一端淘汰
+
+SharedSQLiteCache 是可选的跨进程二级缓存，TieredCache 把两者组合在一起。
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_size(key, value):
+    """估算一个缓存条目占用的字节数"""
+    if isinstance(value, str):
+        value_size = len(value.encode('utf-8'))
+    elif isinstance(value, (tuple, list)):
+        value_size = sum(len(str(item).encode('utf-8')) for item in value)
+    else:
+        value_size = len(repr(value).encode('utf-8'))
+    return len(str(key).encode('utf-8')) + value_size
+
+
+class LRUTTLCache:
+    """线程安全的 LRU + TTL 缓存"""
+
+    def __init__(self, max_entries, max_bytes=None, default_ttl=900):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _remove(self, key):
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at, _ = entry
+            if expires_at <= time.time():
+                # 惰性过期：只在读到时删除
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        size = estimate_size(key, value)
+        expires_at = time.time() + (ttl if ttl is not None else self.default_ttl)
+
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+
+            # 从最久未使用的一端淘汰，直到满足条目数和字节数限制
+            while self._data and (len(self._data) > self.max_entries or
+                                  (self.max_bytes and self._bytes > self.max_bytes)):
+                oldest_key = next(iter(self._data))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expirations': self.expirations,
+                'evictions': self.evictions
+            }
+
+
+class SharedSQLiteCache:
+    """多进程共享的二级缓存，存放在独立的 SQLite 文件中（WAL 模式）
+
+    同一台机器上的所有 worker 共用一个文件；条目按 (namespace, key) 存储，
+    过期时间建有索引，读取时只返回未过期的条目，并定期批量清理过期数据。
+    值以 JSON 形式保存。
+
+    连接按线程懒创建并记录创建时的进程号；gunicorn --preload 等场景在 fork 后
+    进程号变化，子进程会丢弃继承来的连接重新打开，不跨进程复用 SQLite 连接。
+    """
+
+    PURGE_INTERVAL = 200  # 每写入多少次清理一次过期条目
+
+    def __init__(self, path, namespace, busy_timeout=5.0):
+        self.path = path
+        self.namespace = namespace
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._init_schema()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # fork 继承来的连接不能在子进程里使用（也不能关闭），直接丢弃
+            conn = self._open()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_schema(self):
+        # 建表使用单独的连接并立即关闭，导入时不留下会被 fork 继承的连接
+        conn = self._open()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    namespace TEXT NOT NULL,
+                    cache_key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, cache_key)
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache (expires_at)')
+        finally:
+            conn.close()
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get_with_expiry(self, key):
+        """返回 (值, 过期时间)，未命中时返回 None"""
+        try:
+            row = self._connect().execute(
+                'SELECT value, expires_at FROM response_cache WHERE namespace = ? AND cache_key = ? AND expires_at > ?',
+                (self.namespace, key, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"共享缓存读取失败: {e}")
+            self._count('errors')
+            return None
+
+        if row is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        value = json.loads(row[0])
+        return (tuple(value) if isinstance(value, list) else value), row[1]
+
+    def get(self, key, default=None):
+        entry = self.get_with_expiry(key)
+        return entry[0] if entry else default
+
+    def put(self, key, value, ttl):
+        try:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO response_cache (namespace, cache_key, value, expires_at) VALUES (?, ?, ?, ?)',
+                (self.namespace, key, json.dumps(value, ensure_ascii=False), time.time() + ttl)
+            )
+            with self._lock:
+                self._writes += 1
+                should_purge = self._writes % self.PURGE_INTERVAL == 0
+            if should_purge:
+                conn.execute('DELETE FROM response_cache WHERE expires_at <= ?', (time.time(),))
+        except sqlite3.Error as e:
+            print(f"共享缓存写入失败: {e}")
+            self._count('errors')
+
+    def delete(self, key):
+        try:
+            self._connect().execute('DELETE FROM response_cache WHERE namespace = ? AND cache_key = ?',
+                                    (self.namespace, key))
+        except sqlite3.Error as e:
+            print(f"共享缓存删除失败: {e}")
+            self._count('errors')
+
+    def clear(self):
+        """删除本命名空间的全部条目，不影响其他命名空间"""
+        try:
+            self._connect().execute('DELETE FROM response_cache WHERE namespace = ?', (self.namespace,))
+        except sqlite3.Error as e:
+            print(f"共享缓存清空失败: {e}")
+            self._count('errors')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'path': self.path,
+                'namespace': self.namespace,
+                'hits': self.hits,
+                'misses': self.misses,
+                'writes': self._writes,
+                'errors': self.errors
+            }
+
+
+class TieredCache:
+    """进程内 LRUTTLCache + 可选的跨进程 SharedSQLiteCache 两级缓存
+
+    读取先查一级缓存，未命中再查二级缓存并按剩余有效期回填一级缓存；
+    写入同时写两级。接口与 LRUTTLCache 一致。
+    """
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def __len__(self):
+        return len(self.local)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        if self.shared is not None:
+            entry = self.shared.get_with_expiry(key)
+            if entry is not None:
+                value, expires_at = entry
+                self.local.put(key, value, ttl=max(0, expires_at - time.time()))
+                return value
+        return default
+
+    def put(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.local.default_ttl
+        self.local.put(key, value, ttl=ttl)
+        if self.shared is not None:
+            self.shared.put(key, value, ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        stats = self.local.stats()
+        if self.shared is not None:
+            stats['shared'] = self.shared.stats()
+        return stats
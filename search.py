@@ -0,0 +1,136 @@
+"""
+聊天记录与角色库的全文搜索
+
+基于 FTS5 虚拟表 chat_history_fts / characters_fts（trigram 分词，见 migrations.py），
+结果按 bm25 相关度排序并分页。trigram 只能匹配不少于 3 个字符的词，更短的关键词
+（以及 SQLite 不支持 FTS5 时）退回到 LIKE 查询，按时间倒序返回。
+
+多个关键词用空格分隔，结果需包含全部关键词。已归档的聊天记录不参与搜索。
+"""
+
+MIN_FTS_TERM_LENGTH = 3  # trigram 分词器能匹配的最短关键词
+CHARACTER_WEIGHTS = (10.0, 3.0, 2.0, 1.0)  # name, personality, description, system_prompt 的 bm25 权重
+
+
+def parse_terms(query):
+    """把搜索输入拆成关键词列表"""
+    return [term for term in (query or '').split() if term]
+
+
+def _fts_query(terms):
+    # 每个关键词作为短语，避免用户输入被当作 FTS5 查询语法
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _like_pattern(term):
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def _use_fts(cursor, table, terms):
+    if any(len(term) < MIN_FTS_TERM_LENGTH for term in terms):
+        return False
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cursor.fetchone() is not None
+
+
+def search_messages(cursor, query, user_id=None, limit=20, offset=0):
+    """搜索聊天记录，user_id 为 None 时搜索所有用户的会话；返回 (结果列表, 是否还有下一页)"""
+    terms = parse_terms(query)
+    if not terms:
+        return [], False
+
+    columns = '''h.id, h.session_id, h.character_id, h.sender, h.message, h.timestamp,
+                 c.name, s.topic'''
+    owner_filter = 's.user_id = ?' if user_id is not None else '1 = 1'
+    owner_params = [user_id] if user_id is not None else []
+
+    if _use_fts(cursor, 'chat_history_fts', terms):
+        cursor.execute(f'''
+            SELECT {columns}
+            FROM chat_history_fts f
+            JOIN chat_history h ON h.id = f.rowid
+            {'JOIN' if user_id is not None else 'LEFT JOIN'} chat_sessions s ON s.session_id = h.session_id
+            LEFT JOIN characters c ON c.id = h.character_id
+            WHERE chat_history_fts MATCH ? AND {owner_filter}
+            ORDER BY f.rank
+            LIMIT ? OFFSET ?
+        ''', (_fts_query(terms), *owner_params, limit + 1, offset))
+    else:
+        like_filter = ' AND '.join("h.message LIKE ? ESCAPE '\\'" for _ in terms)
+        if user_id is not None:
+            # 先按归属找到用户的会话，再通过 (session_id, id) 索引读取消息
+            source = 'chat_sessions s JOIN chat_history h ON h.session_id = s.session_id'
+        else:
+            source = 'chat_history h LEFT JOIN chat_sessions s ON s.session_id = h.session_id'
+        cursor.execute(f'''
+            SELECT {columns}
+            FROM {source}
+            LEFT JOIN characters c ON c.id = h.character_id
+            WHERE {owner_filter} AND {like_filter}
+            ORDER BY h.id DESC
+            LIMIT ? OFFSET ?
+        ''', (*owner_params, *[_like_pattern(term) for term in terms], limit + 1, offset))
+
+    rows = cursor.fetchall()
+    results = [{
+        'id': row[0],
+        'session_id': row[1],
+        'character_id': row[2],
+        'character_name': row[6] if row[2] else None,
+        'sender': row[3],
+        'message': row[4],
+        'timestamp': row[5],
+        'topic': row[7]
+    } for row in rows[:limit]]
+    return results, len(rows) > limit
+
+
+def search_characters(cursor, query, user_id=None, limit=20, offset=0):
+    """搜索角色库：user_id 不为 None 时只搜索默认角色和该用户创建的角色"""
+    terms = parse_terms(query)
+    if not terms:
+        return [], False
+
+    columns = '''c.id, c.name, c.personality, c.description, c.avatar_type, c.avatar_value,
+                 c.is_default, c.user_id, c.created_at'''
+    visibility = '(c.is_default = 1 OR c.user_id = ?)' if user_id is not None else '1 = 1'
+    visibility_params = [user_id] if user_id is not None else []
+
+    if _use_fts(cursor, 'characters_fts', terms):
+        weights = ', '.join(str(weight) for weight in CHARACTER_WEIGHTS)
+        cursor.execute(f'''
+            SELECT {columns}
+            FROM characters_fts f
+            JOIN characters c ON c.id = f.rowid
+            WHERE characters_fts MATCH ? AND {visibility}
+            ORDER BY bm25(characters_fts, {weights})
+            LIMIT ? OFFSET ?
+        ''', (_fts_query(terms), *visibility_params, limit + 1, offset))
+    else:
+        fields = ('c.name', 'c.personality', 'c.description', 'c.system_prompt')
+        like_filter = ' AND '.join(
+            '(' + ' OR '.join(f"{field} LIKE ? ESCAPE '\\'" for field in fields) + ')' for _ in terms
+        )
+        like_params = [_like_pattern(term) for term in terms for _ in fields]
+        cursor.execute(f'''
+            SELECT {columns}
+            FROM characters c
+            WHERE {visibility} AND {like_filter}
+            ORDER BY c.is_default DESC, c.created_at DESC
+            LIMIT ? OFFSET ?
+        ''', (*visibility_params, *like_params, limit + 1, offset))
+
+    rows = cursor.fetchall()
+    results = [{
+        'id': row[0],
+        'name': row[1],
+        'personality': row[2],
+        'description': row[3],
+        'avatar_type': row[4] or 'emoji',
+        'avatar_value': row[5] or row[1][0],
+        'is_default': bool(row[6]),
+        'user_id': row[7],
+        'created_at': row[8]
+    } for row in rows[:limit]]
+    return results, len(rows) > limit
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+谁是卧底无界面对战模拟器
+
+不经过浏览器，直接在进程内并发跑完整局游戏：
+    start → 每个存活角色 describe（或 describe-round）→ ai-vote → process-ai-votes → … 直到 game_over
+默认启动 DashScope 模拟服务（mock_dashscope.py）和使用临时数据库的应用，通过 Flask 测试客户端
+调用接口，既是游戏引擎的压测，也是角色平衡性测试。输出：
+    - 吞吐量：每秒完成的对局数
+    - 各阶段延迟：start / describe / ai_vote / process_ai_votes 的 p50/p95/p99
+    - 数据库写入量：各对局表新增的行数和内容字节数，游戏状态快照的写入次数和字节数
+    - 投票解析成功率：按 VOTE_PATTERNS 中命中的正则统计
+    - 每个角色的胜率（分卧底/平民）和被淘汰次数
+
+使用方法:
+    python tournament.py                                        # 20局，4并发，每局4个角色
+    python tournament.py --games 200 --concurrency 16 --players 5 --latency fixed:0.01
+    python tournament.py --vote-style mixed --output tournament.json
+    python tournament.py --describe-mode round-parallel --seed 42
+
+也可以作为库使用（app 需已配置好数据库和大模型地址）:
+    from tournament import run_tournament
+    result = run_tournament(app, games=50, concurrency=8)
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark import git_revision, percentile
+
+PHASES = ['start', 'describe', 'describe_round', 'ai_vote', 'process_ai_votes']
+DESCRIBE_MODES = ['each', 'round', 'round-parallel']
+GAME_TABLES = {
+    'game_sessions': 'LENGTH(game_state)',
+    'game_players': 'LENGTH(character_name)',
+    'game_descriptions': 'LENGTH(description)',
+    'game_votes': 'LENGTH(vote_text)'
+}
+MAX_VOTE_ATTEMPTS = 3  # 一轮投票全部无法解析时最多重新投票的次数
+
+
+class TournamentRecorder:
+    """收集各阶段耗时、投票解析结果和对局结果（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = {}
+        self.votes = {'total': 0, 'parsed': 0, 'by_pattern': {}}
+        self.games = []
+        self.errors = []
+
+    def phase(self, name, latency_ms):
+        with self._lock:
+            self.phases.setdefault(name, []).append(latency_ms)
+
+    def vote(self, matched_by, parsed):
+        with self._lock:
+            self.votes['total'] += 1
+            self.votes['parsed'] += parsed
+            key = matched_by or 'unmatched'
+            self.votes['by_pattern'][key] = self.votes['by_pattern'].get(key, 0) + 1
+
+    def game(self, result):
+        with self._lock:
+            self.games.append(result)
+
+    def error(self, message):
+        with self._lock:
+            self.errors.append(message)
+
+    def summarize_phases(self):
+        phases = {}
+        for name in PHASES:
+            latencies = sorted(self.phases.get(name, []))
+            if not latencies:
+                continue
+            phases[name] = {
+                'count': len(latencies),
+                'mean_ms': round(sum(latencies) / len(latencies), 2),
+                'p50_ms': round(percentile(latencies, 50), 2),
+                'p95_ms': round(percentile(latencies, 95), 2),
+                'p99_ms': round(percentile(latencies, 99), 2),
+                'max_ms': round(latencies[-1], 2)
+            }
+        return phases
+
+    def summarize_votes(self):
+        total = self.votes['total']
+        return {
+            'total': total,
+            'parsed': self.votes['parsed'],
+            'success_rate': round(self.votes['parsed'] / total, 4) if total else 0,
+            'by_pattern': dict(sorted(self.votes['by_pattern'].items(), key=lambda item: -item[1]))
+        }
+
+
+def character_balance(games):
+    """按角色统计对局数、胜率（分卧底/平民）和被淘汰次数"""
+    stats = {}
+    for game in games:
+        for index, player in enumerate(game['players']):
+            entry = stats.setdefault(player['id'], {
+                'name': player['name'], 'games': 0, 'wins': 0, 'eliminated': 0,
+                'undercover_games': 0, 'undercover_wins': 0, 'civilian_games': 0, 'civilian_wins': 0
+            })
+            is_undercover = index == game['undercover_index']
+            won = (game['winner'] == 'undercover') == is_undercover
+            role = 'undercover' if is_undercover else 'civilian'
+            entry['games'] += 1
+            entry['wins'] += won
+            entry[f'{role}_games'] += 1
+            entry[f'{role}_wins'] += won
+            entry['eliminated'] += index in game['eliminated']
+
+    for entry in stats.values():
+        entry['win_rate'] = round(entry['wins'] / entry['games'], 4)
+        for role in ('undercover', 'civilian'):
+            games = entry[f'{role}_games']
+            entry[f'{role}_win_rate'] = round(entry[f'{role}_wins'] / games, 4) if games else None
+    return dict(sorted(stats.items(), key=lambda item: -item[1]['win_rate']))
+
+
+def measure_writes(app_module):
+    """各对局表当前的行数和内容字节数，以及游戏状态快照的写入统计"""
+    conn = app_module.get_db_connection()
+    try:
+        cursor = conn.cursor()
+        tables = {}
+        for table, payload in GAME_TABLES.items():
+            cursor.execute(f'SELECT COUNT(*), COALESCE(SUM({payload}), 0) FROM {table}')
+            rows, payload_bytes = cursor.fetchone()
+            tables[table] = {'rows': rows, 'payload_bytes': payload_bytes}
+    finally:
+        conn.close()
+    store = app_module.game_store.stats()
+    return {
+        'tables': tables,
+        'snapshots_written': store['snapshots_written'],
+        'snapshot_bytes': store['snapshot_bytes']
+    }
+
+
+def diff_writes(before, after):
+    tables = {
+        table: {key: after['tables'][table][key] - before['tables'][table][key] for key in ('rows', 'payload_bytes')}
+        for table in GAME_TABLES
+    }
+    return {
+        'tables': tables,
+        'rows_total': sum(t['rows'] for t in tables.values()),
+        'snapshots_written': after['snapshots_written'] - before['snapshots_written'],
+        'snapshot_bytes': after['snapshot_bytes'] - before['snapshot_bytes']
+    }
+
+
+class GameRunner:
+    """用独立的测试客户端（会话）跑完整局游戏"""
+
+    def __init__(self, app, parse_vote, recorder, describe_mode, difficulty, username, password):
+        self.client = app.test_client()
+        self.parse_vote = parse_vote
+        self.recorder = recorder
+        self.describe_mode = describe_mode
+        self.difficulty = difficulty
+        response = self.client.post('/login', json={'username': username, 'password': password})
+        if response.status_code != 200 or not response.get_json().get('success'):
+            raise RuntimeError(f'登录失败: {response.status_code}')
+
+    def call(self, phase, path, payload, stream=False):
+        """调用接口并记录耗时，返回 (状态码, JSON 或 SSE 原文)"""
+        started = time.perf_counter()
+        response = self.client.post(path, json=payload)
+        body = response.get_data(as_text=True) if stream else response.get_json(silent=True)
+        self.recorder.phase(phase, (time.perf_counter() - started) * 1000)
+        return response.status_code, body
+
+    def play(self, players):
+        """跑完一局游戏，返回对局结果；接口出错时抛出 RuntimeError"""
+        status, started = self.call('start', '/api/game/start', {
+            'characters': players, 'difficulty': self.difficulty, 'max_rounds': len(players)
+        })
+        if status != 200:
+            raise RuntimeError(f'start 返回 {status}: {started}')
+        session_id = started['session_id']
+        eliminated = []
+
+        # 每轮淘汰一人，最多 len(players) - 2 轮就会结束
+        for round_number in range(1, len(players)):
+            alive = [i for i in range(len(players)) if i not in eliminated]
+            self.describe(session_id, alive)
+
+            for _ in range(MAX_VOTE_ATTEMPTS):
+                status, voted = self.call('ai_vote', '/api/game/ai-vote', {'session_id': session_id})
+                if status != 200:
+                    raise RuntimeError(f'ai-vote 返回 {status}: {voted}')
+                vote_results = voted.get('vote_results', [])
+                game_view = {'characters': players, 'eliminated': eliminated}
+                for vote in vote_results:
+                    index, _, matched_by = self.parse_vote(vote['vote_response'], game_view)
+                    self.recorder.vote(matched_by, index is not None)
+
+                status, processed = self.call('process_ai_votes', '/api/game/process-ai-votes', {
+                    'session_id': session_id, 'vote_results': vote_results
+                })
+                if status == 200:
+                    break
+                if status != 400:
+                    raise RuntimeError(f'process-ai-votes 返回 {status}: {processed}')
+            else:
+                raise RuntimeError(f'连续 {MAX_VOTE_ATTEMPTS} 次投票都无法解析')
+
+            eliminated.append(processed['eliminated_character']['index'])
+            if processed['game_over']:
+                return {
+                    'session_id': session_id,
+                    'players': [{'id': p['id'], 'name': p['name']} for p in players],
+                    'undercover_index': started['undercover_index'],
+                    'winner': processed['winner'],
+                    'rounds': round_number,
+                    'eliminated': eliminated
+                }
+        raise RuntimeError(f'{len(players) - 1} 轮后游戏仍未结束')
+
+    def describe(self, session_id, alive):
+        if self.describe_mode == 'each':
+            for index in alive:
+                status, body = self.call('describe', '/api/game/describe',
+                                         {'session_id': session_id, 'character_index': index})
+                if status != 200:
+                    raise RuntimeError(f'describe 返回 {status}: {body}')
+        else:
+            status, body = self.call('describe_round', '/api/game/describe-round', {
+                'session_id': session_id, 'parallel': self.describe_mode == 'round-parallel'
+            }, stream=True)
+            if status != 200 or 'event: end' not in body:
+                raise RuntimeError(f'describe-round 返回 {status}')
+
+
+def run_tournament(app, games=20, concurrency=4, players=4, describe_mode='each', difficulty='medium',
+                   character_ids=None, seed=None, username='admin', password='admin123'):
+    """并发跑 games 局游戏，返回吞吐量、阶段延迟、写入量、投票解析和角色胜率统计"""
+    import app as app_module
+
+    rng = random.Random(seed)
+    recorder = TournamentRecorder()
+
+    setup = app.test_client()
+    setup.post('/login', json={'username': username, 'password': password})
+    setup.post('/api/set-api-key', json={'api_key': 'sk-tournament'})
+    pool = setup.get('/api/characters').get_json() or []
+    if character_ids:
+        pool = [c for c in pool if c['id'] in character_ids]
+    if len(pool) < players:
+        raise ValueError(f'可用角色只有 {len(pool)} 个，少于每局的 {players} 个')
+    lineups = [[{'id': c['id'], 'name': c['name'], 'personality': c.get('personality') or ''}
+                for c in rng.sample(pool, players)] for _ in range(games)]
+
+    local = threading.local()
+
+    def play(lineup):
+        if not hasattr(local, 'runner'):
+            local.runner = GameRunner(app, app_module.parse_vote, recorder, describe_mode, difficulty,
+                                      username, password)
+        try:
+            recorder.game(local.runner.play(lineup))
+        except Exception as e:
+            recorder.error(str(e))
+            print(f'对局失败: {e}')
+
+    app_module.game_store.flush()
+    writes_before = measure_writes(app_module)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(play, lineups))
+    wall_seconds = time.perf_counter() - started
+    app_module.game_store.flush()
+    writes = diff_writes(writes_before, measure_writes(app_module))
+
+    finished = recorder.games
+    winners = [game['winner'] for game in finished]
+    return {
+        'games': {
+            'requested': games,
+            'finished': len(finished),
+            'failed': len(recorder.errors),
+            'games_per_second': round(len(finished) / wall_seconds, 3) if wall_seconds else 0,
+            'wall_seconds': round(wall_seconds, 3),
+            'avg_rounds': round(sum(game['rounds'] for game in finished) / len(finished), 2) if finished else 0,
+            'undercover_win_rate': round(winners.count('undercover') / len(winners), 4) if winners else 0
+        },
+        'phases': recorder.summarize_phases(),
+        'db_writes': writes,
+        'votes': recorder.summarize_votes(),
+        'characters': character_balance(finished),
+        'errors': recorder.errors[:20]
+    }
+
+
+def start_local_app(args):
+    """启动模拟服务，返回使用临时数据库的应用"""
+    import mock_dashscope
+
+    _, mock_url = mock_dashscope.start_in_thread(
+        port=0,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        vote_style=args.vote_style
+    )
+
+    # 配置在导入时读取环境变量，因此需在导入 app 之前设置
+    os.environ['DASHSCOPE_BASE_URL'] = mock_url
+    os.environ.setdefault('FLASK_CONFIG', 'production')
+
+    from app import app, init_db
+
+    app.config['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='chatpersona-tournament-'), 'tournament.db')
+    init_db()
+    print(f'🧪 模拟服务: {mock_url}  临时数据库: {app.config["DATABASE_PATH"]}')
+    return app
+
+
+def print_report(result):
+    games = result['games']
+    print(f'\n对局: 完成 {games["finished"]}/{games["requested"]}（失败 {games["failed"]}），'
+          f'耗时 {games["wall_seconds"]:.1f}s，吞吐 {games["games_per_second"]:.2f} 局/秒，'
+          f'平均 {games["avg_rounds"]} 轮，卧底胜率 {games["undercover_win_rate"]:.1%}')
+
+    print(f'\n{"阶段":<20}{"次数":>8}{"mean":>10}{"p50":>10}{"p95":>10}{"p99":>10}{"max":>10}')
+    print('-' * 78)
+    for name, s in result['phases'].items():
+        print(f'{name:<20}{s["count"]:>8}{s["mean_ms"]:>10.1f}{s["p50_ms"]:>10.1f}'
+              f'{s["p95_ms"]:>10.1f}{s["p99_ms"]:>10.1f}{s["max_ms"]:>10.1f}')
+
+    writes = result['db_writes']
+    print(f'\n数据库写入: 新增 {writes["rows_total"]} 行，游戏状态快照 {writes["snapshots_written"]} 次 / '
+          f'{writes["snapshot_bytes"]} 字节')
+    for table, t in writes['tables'].items():
+        print(f'  {table:<20}{t["rows"]:>8} 行{t["payload_bytes"]:>12} 字节')
+
+    votes = result['votes']
+    print(f'\n投票解析: {votes["parsed"]}/{votes["total"]}（{votes["success_rate"]:.1%}）')
+    for pattern, count in votes['by_pattern'].items():
+        print(f'  {pattern:<30}{count:>8}')
+
+    print(f'\n{"角色":<16}{"对局":>6}{"胜率":>8}{"卧底局":>8}{"卧底胜率":>10}{"平民胜率":>10}{"被淘汰":>8}')
+    print('-' * 66)
+    for entry in result['characters'].values():
+        undercover = f'{entry["undercover_win_rate"]:.0%}' if entry['undercover_win_rate'] is not None else '-'
+        civilian = f'{entry["civilian_win_rate"]:.0%}' if entry['civilian_win_rate'] is not None else '-'
+        print(f'{entry["name"]:<16}{entry["games"]:>6}{entry["win_rate"]:>8.0%}{entry["undercover_games"]:>8}'
+              f'{undercover:>10}{civilian:>10}{entry["eliminated"]:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='谁是卧底无界面对战模拟器')
+    parser.add_argument('--games', type=int, default=20, help='对局数 (默认: 20)')
+    parser.add_argument('--concurrency', type=int, default=4, help='同时进行的对局数 (默认: 4)')
+    parser.add_argument('--players', type=int, default=4, choices=range(3, 7), help='每局角色数 3-6 (默认: 4)')
+    parser.add_argument('--characters', default=None, help='逗号分隔的角色ID，每局从中随机选取 (默认: 全部可用角色)')
+    parser.add_argument('--describe-mode', default='each', choices=DESCRIBE_MODES,
+                        help='描述方式：each 逐个调用 describe，round / round-parallel 调用 describe-round (默认: each)')
+    parser.add_argument('--difficulty', default='medium', help='词库难度 (默认: medium)')
+    parser.add_argument('--seed', type=int, default=None, help='随机数种子（角色选取和模拟服务），便于复现')
+    parser.add_argument('--latency', default='fixed:0.05', help='模拟服务的文本生成延迟分布 (默认: fixed:0.05)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟服务的错误率')
+    parser.add_argument('--vote-style', default='strict', choices=['strict', 'mixed'],
+                        help='模拟服务的投票回复写法，mixed 用于测试投票解析 (默认: strict)')
+    parser.add_argument('--output', default=None, help='结果JSON路径 (默认: tournament-<时间>.json)')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    character_ids = [int(i) for i in args.characters.split(',') if i.strip()] if args.characters else None
+
+    app = start_local_app(args)
+    print(f'🚀 对局: {args.games}  并发: {args.concurrency}  每局角色: {args.players}  描述方式: {args.describe_mode}')
+    try:
+        result = run_tournament(app, games=args.games, concurrency=args.concurrency, players=args.players,
+                                describe_mode=args.describe_mode, difficulty=args.difficulty,
+                                character_ids=character_ids, seed=args.seed)
+    except ValueError as e:
+        print(f'❌ {e}')
+        sys.exit(1)
+    print_report(result)
+
+    result['meta'] = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_revision': git_revision(),
+        'games': args.games,
+        'concurrency': args.concurrency,
+        'players': args.players,
+        'describe_mode': args.describe_mode,
+        'seed': args.seed,
+        'mock': {'latency': args.latency, 'error_rate': args.error_rate, 'vote_style': args.vote_style}
+    }
+    output = args.output or f'tournament-{time.strftime("%Y%m%d-%H%M%S")}.json'
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'📄 结果已写入 {output}')
+
+
+if __name__ == '__main__':
+    main()
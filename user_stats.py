@@ -0,0 +1,127 @@
+"""
+用户统计计数的批量写入
+
+页面访问和模型调用次数先在内存中按用户累加，由后台线程定时（或累计到阈值时）
+在一个事务里批量写入 users 表，页面请求不再为计数同步提交一次 UPDATE。
+进程退出时通过 atexit 写入剩余计数。
+"""
+
+import atexit
+import os
+import threading
+from datetime import datetime
+
+
+class UserStatsBuffer:
+    """按用户聚合 access_count / model_call_count 增量的写缓冲（线程安全）"""
+
+    def __init__(self, get_connection, flush_interval=5.0, flush_threshold=200):
+        self.get_connection = get_connection
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}  # user_id -> [access_increment, model_call_increment, last_seen]
+        self._pending_events = 0
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.events = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.failures = 0
+        atexit.register(self.flush)
+
+    def add(self, user_id, access_increment=0, model_call_increment=0):
+        # last_login 与原来的 datetime('now') 一致，使用UTC时间
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            entry = self._pending.setdefault(user_id, [0, 0, now])
+            entry[0] += access_increment
+            entry[1] += model_call_increment
+            entry[2] = now
+            self._pending_events += 1
+            self.events += 1
+            reached_threshold = self._pending_events >= self.flush_threshold
+
+        if self.flush_interval <= 0:
+            self.flush()  # 未启用批量写入时直接写库
+            return
+
+        self._ensure_thread()
+        if reached_threshold:
+            self._wakeup.set()
+
+    def _ensure_thread(self):
+        # fork 出的子进程不会继承父进程的线程，需要重新启动
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='user-stats-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """把累积的增量在一个事务中写入 users 表，返回写入的用户数"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                pending, self._pending = self._pending, {}
+                self._pending_events = 0
+
+            rows = [(access, model_calls, last_seen, user_id)
+                    for user_id, (access, model_calls, last_seen) in pending.items()]
+            conn = self.get_connection()
+            try:
+                conn.cursor().executemany('''
+                    UPDATE users
+                    SET access_count = access_count + ?,
+                        model_call_count = model_call_count + ?,
+                        last_login = ?
+                    WHERE id = ?
+                ''', rows)
+                conn.commit()
+            except Exception as e:
+                print(f"用户统计批量写入失败，稍后重试: {e}")
+                conn.rollback()
+                self._restore(pending)
+                with self._lock:
+                    self.failures += 1
+                return 0
+            finally:
+                conn.close()
+
+            with self._lock:
+                self.flushes += 1
+                self.rows_written += len(rows)
+            return len(rows)
+
+    def _restore(self, pending):
+        """写入失败时把增量合并回缓冲区"""
+        with self._lock:
+            for user_id, (access, model_calls, last_seen) in pending.items():
+                entry = self._pending.setdefault(user_id, [0, 0, last_seen])
+                entry[0] += access
+                entry[1] += model_calls
+                entry[2] = max(entry[2], last_seen)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'events': self.events,
+                'pending_users': len(self._pending),
+                'pending_events': self._pending_events,
+                'flushes': self.flushes,
+                'rows_written': self.rows_written,
+                'failures': self.failures,
+                'flush_interval': self.flush_interval,
+                'flush_threshold': self.flush_threshold
+            }